@@ -0,0 +1,177 @@
+# Micro-benchmark for the dynamodb marshalling codec in lambda_layer/ddb_codec.py.
+#
+# usage: python bench_ddb_codec.py [--records N] [--repeat R]
+#
+# Compares encode_item/decode_item against the recursive add_ddb_format/remove_ddb_format
+# functions they replaced, on spelunk-shaped records.
+
+import argparse
+import io
+import json
+import os
+import sys
+import timeit
+import contextlib
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'lambda_layer'))
+
+from ddb_codec import encode_item, decode_item
+
+###################################################################
+#
+# The previous implementation, kept here as the baseline
+#
+###################################################################
+
+def legacy_remove_ddb_format(ddb_obj, this_is_metadata=False):
+    if not isinstance(ddb_obj, dict) and this_is_metadata:
+        raise ValueError(f'Expected ddb_obj to be a metadata dict, got {type(ddb_obj)}')
+
+    if isinstance(ddb_obj, dict):
+        def convert_ddb_num(strval):
+            try:
+                return int(strval)
+            except ValueError:
+                return float(strval)
+
+        if this_is_metadata:
+            if len(ddb_obj) != 1:
+                raise ValueError(f'Bad format for metadata: {ddb_obj}')
+
+            key = list(ddb_obj.keys())[0]
+
+            if key == 'S':
+                return ddb_obj[key]
+            elif key == 'N':
+                return convert_ddb_num(ddb_obj[key])
+            elif key == 'B':
+                return ddb_obj[key]
+            elif key == 'BOOL':
+                return ddb_obj[key]
+            elif key == 'NULL':
+                return None
+            elif key == 'M':
+                return legacy_remove_ddb_format(ddb_obj[key], this_is_metadata=False)
+            elif key == 'L':
+                return legacy_remove_ddb_format(ddb_obj[key], this_is_metadata=False)
+            elif key == 'SS':
+                return set(ddb_obj[key])
+            elif key == 'NS':
+                return set([convert_ddb_num(x) for x in ddb_obj[key]])
+            elif key == 'BS':
+                return set(ddb_obj[key])
+            else:
+                raise ValueError(f'Unknown key in ddb metadata: {key}')
+        else:
+            return {k: legacy_remove_ddb_format(v, this_is_metadata=True) for k, v in ddb_obj.items()}
+    elif isinstance(ddb_obj, list):
+        return [legacy_remove_ddb_format(x, this_is_metadata=True) for x in ddb_obj]
+    else:
+        return ddb_obj
+
+def legacy_add_ddb_format(obj, add_to_this_level=False, log=True):
+    if log:
+        print(f'add_ddb_format: {json.dumps(obj, indent=2)}')
+    if add_to_this_level:
+        if isinstance(obj, dict):
+            return {"M": {k: legacy_add_ddb_format(v, True, log) for k, v in obj.items()}}
+        elif isinstance(obj, (list, set, tuple)):
+            return {"L": [legacy_add_ddb_format(x, True, log) for x in obj]}
+        elif isinstance(obj, str):
+            return {"S": obj}
+        elif isinstance(obj, bool):
+            return {"BOOL": obj}
+        elif isinstance(obj, (int, float)):
+            return {"N": str(obj)}
+        elif isinstance(obj, bytes):
+            return {"B": obj}
+        elif obj is None:
+            return {"NULL": True}
+        else:
+            raise ValueError(f'Unsupported type in obj: {type(obj)}')
+    else:
+        if isinstance(obj, dict):
+            return {k: legacy_add_ddb_format(v, True, log) for k, v in obj.items()}
+        elif isinstance(obj, (list, set, tuple)):
+            return [legacy_add_ddb_format(x, True, log) for x in obj]
+        else:
+            raise ValueError(f'Expected container type but got {type(obj)}')
+
+###################################################################
+#
+# Realistic records
+#
+###################################################################
+
+def make_spelunk_rec(i):
+    now = 1680000000 + i
+    message = '\n'.join(
+        f'  File "/opt/youtube.py", line {n}, in get_youtube_summary_url' for n in range(40)
+    )
+    return {
+        'pkey': f'S*{i:040x}',
+        'id': f'{i:040x}',
+        'version': 1,
+        'name': f'How to build things, part {i}',
+        'overview': f'How to build things, part {i}',
+        'type': 'youtube',
+        'created_at': now,
+        'updated_at': now,
+        'lenses': {
+            'source': {
+                'status': 'ready',
+                'url': f'https://www.youtube.com/watch?v=HhHzCfrqs{i % 100:02d}',
+                'type': 'youtube'
+            },
+            'transcript': {
+                'status': 'ready',
+                'started_at': now,
+            },
+            'summary': {
+                'status': 'error',
+                'started_at': now,
+                'message': message,
+                'chunks': [
+                    {'heading': f'Summary of section beginning at 0:{n * 10:02d}:00', 'start': n * 600.5, 'tokens': 480}
+                    for n in range(15)
+                ]
+            }
+        }
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the dynamodb marshalling codec.')
+    parser.add_argument('--records', type=int, default=200, help='Number of records per run.')
+    parser.add_argument('--repeat', type=int, default=5, help='Number of runs; the best is reported.')
+    args = parser.parse_args()
+
+    recs = [make_spelunk_rec(i) for i in range(args.records)]
+    encoded = [encode_item(rec) for rec in recs]
+
+    # sanity check: both implementations agree
+    assert [decode_item(x) for x in encoded] == recs
+    assert [legacy_remove_ddb_format(x) for x in encoded] == recs
+    assert [legacy_add_ddb_format(rec, log=False) for rec in recs] == encoded
+
+    def legacy_encode_logged():
+        # as shipped, add_ddb_format json dumped every value it visited
+        with contextlib.redirect_stdout(io.StringIO()):
+            for rec in recs:
+                legacy_add_ddb_format(rec)
+
+    cases = [
+        ('encode: legacy (with its logging)', legacy_encode_logged),
+        ('encode: legacy (logging removed)', lambda: [legacy_add_ddb_format(rec, log=False) for rec in recs]),
+        ('encode: encode_item', lambda: [encode_item(rec) for rec in recs]),
+        ('decode: legacy', lambda: [legacy_remove_ddb_format(x) for x in encoded]),
+        ('decode: decode_item', lambda: [decode_item(x) for x in encoded]),
+    ]
+
+    print(f'{args.records} spelunk records, best of {args.repeat} runs')
+    for name, f in cases:
+        best = min(timeit.repeat(f, number=1, repeat=args.repeat))
+        print(f'{name:40s} {best * 1e6 / args.records:10.1f} us/record')
+
+# standard calling of main function
+if __name__ == "__main__":
+    main()
@@ -3,13 +3,24 @@ import sys
 sys.path.append('/opt')
 
 import json
-from spelunk import get_spelunk_rec, spelunk_rec_needs_transcript, update_spelunk_rec, C_STATUS_ERROR, C_STATUS_READY, C_STATUS_UNDERWAY, spelunk_rec_needs_summary
+from spelunk import get_spelunk_status, spelunk_rec_needs_processing, spelunk_rec_needs_lens, SpelunkLensLease, C_STATUS_ERROR, C_STATUS_READY, \
+    reap_stuck_spelunks, alias_legacy_spelunks, index_unsettled_spelunks
 from shared import exc_to_string
+from metrics import flush_metrics_after
+from enqueue import flush_enqueued_after
 from youtube import get_youtube_transcript_url, get_youtube_summary_url
 import datetime
 import os
-import time
 
+# one off jobs, run by invoking this lambda with {"op": <name>, "detail": {<kwargs>}}
+# (deploy.py --backfill does that). they return counts.
+C_DIRECT_OPS = {
+    'alias_legacy_spelunks': alias_legacy_spelunks,
+    'index_unsettled_spelunks': index_unsettled_spelunks,
+}
+
+@flush_metrics_after
+@flush_enqueued_after
 def lambda_handler(event, context):
     print ("Stub Received event: " + json.dumps(event, indent=2))   
 
@@ -30,75 +41,44 @@ def lambda_handler(event, context):
                 if op == 'process_spelunk':
                     spelunk_id = detail['spelunk_id'] if 'spelunk_id' in detail else None
 
-                    spelunk_rec = get_spelunk_rec(spelunk_id)
+                    # only the lens statuses are needed to decide whether there's work to do.
+                    # claiming a lens returns the full record.
+                    spelunk_rec = get_spelunk_status(spelunk_id)
 
                     if not spelunk_rec:
                         print (f'Spelunk {spelunk_id} not found, skipping')
-                        return
+                        continue
                     
-                    needs_processing = spelunk_rec_needs_transcript(spelunk_rec) or spelunk_rec_needs_summary(spelunk_rec)
-
-                    if not needs_processing:
+                    if not spelunk_rec_needs_processing(spelunk_rec):
                         print (f'Spelunk {spelunk_id} does not need processing, skipping')
-                        return
-
-                    if spelunk_rec_needs_transcript(spelunk_rec):
-                        try:
-                            # first let's change the status to underway, and add a "started_at" timestamp
-                            spelunk_rec['lenses']['transcript']['status'] = C_STATUS_UNDERWAY
-                            spelunk_rec['lenses']['transcript']['started_at'] = int(time.time())
-                            update_spelunk_rec(spelunk_rec)
-
-                            # here we need to get the youtube transcript and write it to s3
-                            s3_bucket = os.environ['bucket_name']
-
-                            # don't need the transcript url here, but this will force create if it doesn't exist
-                            get_youtube_transcript_url(spelunk_rec, s3_bucket)
+                        continue
 
-                            # update the spelunk record to indicate that the transcript is ready
-                            spelunk_rec['lenses']['transcript']['status'] = C_STATUS_READY
+                    s3_bucket = os.environ['bucket_name']
 
-                            update_spelunk_rec(spelunk_rec)
-                        except Exception as e:
-                            print ('Failed to process spelunk: ' + exc_to_string(e))
+                    for lens_name, create_lens in (('transcript', get_youtube_transcript_url), ('summary', get_youtube_summary_url)):
+                        if not spelunk_rec_needs_lens(spelunk_rec, lens_name):
+                            continue
 
-                            spelunk_rec['lenses']['transcript']['status'] = C_STATUS_ERROR
-                            spelunk_rec['lenses']['transcript']['message'] = exc_to_string(e)
+                        # the lease (heartbeated while we work) makes sure only one worker computes the lens at a time
+                        with SpelunkLensLease(spelunk_id, lens_name) as lease:
+                            if lease.spelunk_rec is None:
+                                print (f'Spelunk {spelunk_id} {lens_name} is being processed elsewhere, skipping')
+                                continue
 
                             try:
-                                update_spelunk_rec(spelunk_rec)
-                            except Exception as e:
-                                print ('Failed to update spelunk record for error: ' + exc_to_string(e))
-                                raise e
-                    
-                    if spelunk_rec_needs_summary(spelunk_rec):
-                        try:
-                            # first let's change the status to underway, and add a "started_at" timestamp
-                            spelunk_rec['lenses']['summary']['status'] = C_STATUS_UNDERWAY
-                            spelunk_rec['lenses']['summary']['started_at'] = int(time.time())
-                            update_spelunk_rec(spelunk_rec)
-
-                            # here we need to get the youtube transcript and write it to s3
-                            s3_bucket = os.environ['bucket_name']
-
-                            # don't need the transcript url here, but this will force create if it doesn't exist
-                            get_youtube_summary_url(spelunk_rec, s3_bucket)
+                                # don't need the url here, but this will force create if it doesn't exist
+                                create_lens(lease.spelunk_rec, s3_bucket)
 
-                            # update the spelunk record to indicate that the transcript is ready
-                            spelunk_rec['lenses']['summary']['status'] = C_STATUS_READY
-
-                            update_spelunk_rec(spelunk_rec)
-                        except Exception as e:
-                            print ('Failed to process spelunk: ' + exc_to_string(e))
-
-                            spelunk_rec['lenses']['summary']['status'] = C_STATUS_ERROR
-                            spelunk_rec['lenses']['summary']['message'] = exc_to_string(e)
-
-                            try:
-                                update_spelunk_rec(spelunk_rec)
+                                # update the spelunk record to indicate that the lens is ready
+                                spelunk_rec = lease.finish(C_STATUS_READY) or spelunk_rec
                             except Exception as e:
-                                print ('Failed to update spelunk record for error: ' + exc_to_string(e))
-                                raise e
+                                print ('Failed to process spelunk: ' + exc_to_string(e))
+
+                                try:
+                                    spelunk_rec = lease.finish(C_STATUS_ERROR, message=exc_to_string(e)) or spelunk_rec
+                                except Exception as e:
+                                    print ('Failed to update spelunk record for error: ' + exc_to_string(e))
+                                    raise e
                 else:
                     print ("Processing failed, Unknown operation: " + op) # can't retry this, it's just a permanent failure
 
@@ -114,8 +94,24 @@ def lambda_handler(event, context):
         }
         print ("Returning: " + json.dumps(retval, indent=2))
         return retval
+    elif event.get('source') == 'aws.events':
+        print ("Scheduled event found. Reaping stuck spelunks.")
+
+        # requeued spelunks are sent when the invocation ends (flush_enqueued_after)
+        counts = reap_stuck_spelunks()
+
+        print ("Reaped: " + json.dumps(counts))
+        return counts
+    elif event.get('op') in C_DIRECT_OPS:
+        op = event['op']
+        print (f"Direct invocation found. Running {op}.")
+
+        counts = C_DIRECT_OPS[op](**(event.get('detail') or {}))
+
+        print (f"{op}: " + json.dumps(counts))
+        return counts
     else:
         return {
             'statusCode': 403,
-            'body': json.dumps('This lambda expects to process SQS messages')
+            'body': json.dumps('This lambda expects to process SQS messages, scheduled events or direct ops')
         }
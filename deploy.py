@@ -11,9 +11,11 @@ from deploy_shared import AddQueueEventSourceMapping, CalculateQueueUrl, CreateO
     GetCloudFrontOriginAccessIdentity, GetRoleArn, get_aws_credentials, get_bucket_name, get_lambda_role_name, \
     get_lambda_role_description, get_queue_name, get_lambda_function_name, get_lambda_function_description, \
     get_table_name, get_secret_name, get_policy_name, get_full_bucket_name, \
-    get_session, get_credentials, \
+    get_session, get_credentials, get_cursor_secret, \
     GetConfigValue, get_background_lambda_function_name, \
-    get_background_lambda_function_description, get_layer_name, get_layer_description
+    get_background_lambda_function_description, get_layer_name, get_layer_description, \
+    CreateOrUpdateScheduleRule, DeleteScheduleRule, get_reaper_rule_name, C_REAPER_SCHEDULE, \
+    InvokeLambdaAsync, C_BACKFILL_OPS
 
 ###################################################################
 ###################################################################
@@ -47,6 +49,8 @@ def CreateInfrastructure(session, credentials, prefix=None):
     print ("* Create the lambda layer")
     CreateOrUpdateLayer(session, get_layer_name(prefix), get_layer_description(prefix), "lambda_layer")
 
+    cursor_secret = get_cursor_secret(credentials)
+
     print ("* Create the lambda function")
     CreateOrUpdateLambda(
         session, 
@@ -60,7 +64,8 @@ def CreateInfrastructure(session, credentials, prefix=None):
             "queue_name": get_queue_name(prefix),
             "queue_url": CalculateQueueUrl(session, get_queue_name(prefix)),
             "domain_name": GetConfigValue(prefix, "domain_name"),
-            "openai_api_key": credentials["openai_api_key"]
+            "openai_api_key": credentials["openai_api_key"],
+            "cursor_secret": cursor_secret
         },
         get_layer_name(prefix)
     )
@@ -78,7 +83,8 @@ def CreateInfrastructure(session, credentials, prefix=None):
             "domain_name": GetConfigValue(prefix, "domain_name"),
             "queue_name": get_queue_name(prefix),
             "queue_url": CalculateQueueUrl(session, get_queue_name(prefix)),
-            "openai_api_key": credentials["openai_api_key"]
+            "openai_api_key": credentials["openai_api_key"],
+            "cursor_secret": cursor_secret
         },
         get_layer_name(prefix)
     )
@@ -86,6 +92,9 @@ def CreateInfrastructure(session, credentials, prefix=None):
     print ("* Create the event source mapping")
     AddQueueEventSourceMapping(session, get_queue_name(prefix), get_background_lambda_function_name(prefix))
 
+    print ("* Create the schedule for the stuck spelunk reaper")
+    CreateOrUpdateScheduleRule(session, get_reaper_rule_name(prefix), get_background_lambda_function_name(prefix), C_REAPER_SCHEDULE)
+
     print ("* Create a Certificate")
     certificate = GetCertificate(session, prefix)
 
@@ -129,6 +138,8 @@ def DeployCode(session, credentials, prefix=None):
     print ("* Create the lambda layer")
     CreateOrUpdateLayer(session, get_layer_name(prefix), get_layer_description(prefix), "lambda_layer")
 
+    cursor_secret = get_cursor_secret(credentials)
+
     print ("* Create the lambda function")
     CreateOrUpdateLambda(
         session, 
@@ -142,7 +153,8 @@ def DeployCode(session, credentials, prefix=None):
             "queue_name": get_queue_name(prefix),
             "queue_url": CalculateQueueUrl(session, get_queue_name(prefix)),
             "domain_name": GetConfigValue(prefix, "domain_name"),
-            "openai_api_key": credentials["openai_api_key"]
+            "openai_api_key": credentials["openai_api_key"],
+            "cursor_secret": cursor_secret
         },
         get_layer_name(prefix)
     )
@@ -160,7 +172,8 @@ def DeployCode(session, credentials, prefix=None):
             "domain_name": GetConfigValue(prefix, "domain_name"),
             "queue_name": get_queue_name(prefix),
             "queue_url": CalculateQueueUrl(session, get_queue_name(prefix)),
-            "openai_api_key": credentials["openai_api_key"]
+            "openai_api_key": credentials["openai_api_key"],
+            "cursor_secret": cursor_secret
         },
         get_layer_name(prefix)
     )
@@ -178,6 +191,16 @@ def DeployCode(session, credentials, prefix=None):
     print_lambda_link(function_name)
 
 
+def RunBackfills(session, prefix=None):
+    # one off data migrations for records written by older code. each is safe to run again.
+    print("Running backfills...")
+
+    for op in C_BACKFILL_OPS:
+        print (f"* {op}")
+        InvokeLambdaAsync(session, get_background_lambda_function_name(prefix), {"op": op})
+
+    print ("Started. Watch the background lambda's logs for the counts.")
+
 ###################################################################
 ###################################################################
 #
@@ -189,6 +212,9 @@ def DeployCode(session, credentials, prefix=None):
 def DestroyInfrastructure(session, prefix, delete_data, delete_certificate, delete_zone):
     print("Destroying infrastructure...")
 
+    print("* Deleting the reaper schedule...")
+    DeleteScheduleRule(session, get_reaper_rule_name(prefix))
+
     print("* Deleting the lambda...")
     DeleteLambda(session, get_lambda_function_name(prefix))
 
@@ -238,7 +264,7 @@ def DestroyInfrastructure(session, prefix, delete_data, delete_certificate, dele
     print("done")
 
 def main():
-    # usage: python deploy.py <prefix> [--destroy] [--delete-data] [--delete-cert] [--delete-zone] [--code-only]
+    # usage: python deploy.py <prefix> [--destroy] [--delete-data] [--delete-cert] [--delete-zone] [--code-only] [--backfill]
 
     # use argparse to parse the command line arguments
     parser = argparse.ArgumentParser(description='Deploy the infrastructure.')
@@ -249,6 +275,7 @@ def main():
     parser.add_argument('--delete-cert', action='store_true', help='Delete the certificate.')
     parser.add_argument('--delete-zone', action='store_true', help='Delete the zone.')
     parser.add_argument('--code-only', action='store_true', help='Only deploy the code.')
+    parser.add_argument('--backfill', action='store_true', help='After deploying, run the one off data migrations.')
 
     args = parser.parse_args()
 
@@ -258,6 +285,7 @@ def main():
     delete_cert = args.delete_cert
     delete_zone = args.delete_zone
     code_only = args.code_only
+    backfill = args.backfill
 
     try:
         credentials = get_credentials()
@@ -275,6 +303,9 @@ def main():
             else:
                 CreateInfrastructure(my_session, credentials, prefix)
 
+            if backfill:
+                RunBackfills(my_session, prefix)
+
     except FileNotFoundError as e:
         print("Can't find the credentials.json file.\nCopy the credentials_template.json file and rename it to credentials.json, then fill in your own AWS credentials.")
     except botocore.exceptions.ClientError as e:
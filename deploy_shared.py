@@ -8,6 +8,7 @@ import zipfile
 import os
 import time
 import re
+import secrets
 import shutil
 
 C_APPCODE = 'spl'
@@ -25,6 +26,13 @@ C_SECRET_REF = f'{C_APPCODE}-secret'
 C_POLICY_REF = f'{C_APPCODE}-policy'
 C_CERTIFICATE_REF = f'{C_APPCODE}-certificate'
 C_HZ_REF = f'{C_APPCODE}-hz'
+C_REAPER_RULE_NAME = f'{C_APPCODE}-reaper'
+
+# how often the background lambda looks for stuck spelunks
+C_REAPER_SCHEDULE = 'rate(5 minutes)'
+
+# one off data migrations, run by the blambda when deploying with --backfill
+C_BACKFILL_OPS = ['alias_legacy_spelunks', 'index_unsettled_spelunks']
 
 def get_lambda_function_name(prefix):
     return f"{prefix or 'def'}-{C_LAMBDA_FUNCTION_NAME}"
@@ -44,6 +52,9 @@ def get_background_lambda_function_description(prefix):
 def get_layer_description(prefix):
     return f"Player Layer ({prefix or 'def'})"
 
+def get_reaper_rule_name(prefix):
+    return f"{prefix or 'def'}-{C_REAPER_RULE_NAME}"
+
 def get_queue_name(prefix):
     return f"{prefix or 'def'}-{C_QUEUE_NAME}"
 
@@ -146,6 +157,24 @@ def get_credentials():
 
     return credentials
 
+def save_credentials(credentials):
+    with open('credentials.json', 'w') as f:
+        json.dump(credentials, f, indent=4)
+
+def get_cursor_secret(credentials):
+    # the key pagination cursors are signed with (see lambda_layer/cursor.py).
+    # every deploy must use the same key or outstanding cursors stop working, so if
+    # credentials.json doesn't have one yet, make one and save it there.
+    cursor_secret = credentials.get('cursor_secret')
+
+    if not cursor_secret:
+        cursor_secret = secrets.token_urlsafe(32)
+        credentials['cursor_secret'] = cursor_secret
+        save_credentials(credentials)
+        print ("* Generated a cursor_secret and saved it to credentials.json")
+
+    return cursor_secret
+
 def get_aws_credentials():
     credentials = get_credentials()
 
@@ -1376,6 +1405,58 @@ def AddQueueEventSourceMapping(session, QueueName, LambdaName):
         else:
             raise e
 
+def CreateOrUpdateScheduleRule(session, RuleName, LambdaName, ScheduleExpression):
+    events_client = session.client('events')
+    lambda_client = session.client('lambda')
+
+    print("Creating schedule rule...")
+    rule_arn = events_client.put_rule(
+        Name=RuleName,
+        ScheduleExpression=ScheduleExpression,
+        State='ENABLED',
+        Description=f'Invokes {LambdaName} on a schedule'
+    )['RuleArn']
+
+    lambda_arn = lambda_client.get_function_configuration(
+        FunctionName=LambdaName
+    )['FunctionArn']
+
+    # let the rule invoke the lambda
+    try:
+        lambda_client.add_permission(
+            FunctionName=LambdaName,
+            StatementId=RuleName,
+            Action='lambda:InvokeFunction',
+            Principal='events.amazonaws.com',
+            SourceArn=rule_arn
+        )
+    except botocore.exceptions.ClientError as e:
+        if e.response['Error']['Code'] == 'ResourceConflictException':
+            print("Permission already exists. Skipping...")
+        else:
+            raise e
+
+    events_client.put_targets(
+        Rule=RuleName,
+        Targets=[
+            {
+                'Id': LambdaName,
+                'Arn': lambda_arn
+            }
+        ]
+    )
+
+def InvokeLambdaAsync(session, LambdaName, Payload):
+    # fire and forget, the lambda's logs show how it went
+    lambda_client = session.client('lambda')
+
+    print(f"Invoking {LambdaName} with {json.dumps(Payload)}...")
+    lambda_client.invoke(
+        FunctionName=LambdaName,
+        InvocationType='Event',
+        Payload=json.dumps(Payload).encode('utf-8')
+    )
+
 def CalculateCertificateArn(session, prefix):
     '''
     Calculate the certificate ARN.
@@ -1643,6 +1724,23 @@ def DeleteEventSourceMappings(session, function_name):
             # just skip it
             print(f'failed to delete event source mapping {mapping["UUID"]}, skipping...')
 
+def DeleteScheduleRule(session, rule_name):
+    events_client = session.client('events')
+
+    try:
+        targets = events_client.list_targets_by_rule(Rule=rule_name)['Targets']
+        if targets:
+            events_client.remove_targets(
+                Rule=rule_name,
+                Ids=[target['Id'] for target in targets]
+            )
+        events_client.delete_rule(Name=rule_name)
+    except botocore.exceptions.ClientError as e:
+        if e.response['Error']['Code'] == 'ResourceNotFoundException':
+            print("Schedule rule does not exist. Skipping...")
+        else:
+            raise e
+
 def DeleteQueue(session, queue_name):
     try:
         sqs_client = session.client('sqs')
@@ -1,6 +1,8 @@
 from fastapi import HTTPException
 import base64
 from shared import exc_to_string
+from aio import run_blocking
+from cursor import InvalidCursor
 from accesstoken import get_accesstoken
 from user import get_user_rec
 import requests
@@ -40,11 +42,11 @@ def get_accesstoken_rec_from_header(auth_header):
     return access_token_rec
 
 async def get_resource(id, getf, resource_name, resource_to_apif, Authorization, test_authorization):
-    access_token_rec = get_accesstoken_rec_from_header(Authorization or test_authorization)
+    access_token_rec = await run_blocking(get_accesstoken_rec_from_header, Authorization or test_authorization)
 
     owner_user_id = access_token_rec.get("owner_user_id")
 
-    rec = getf(id)
+    rec = await run_blocking(getf, id)
 
     if not rec:
         raise HTTPException(status_code=404, detail=f"{resource_name} not found")
@@ -55,12 +57,15 @@ async def get_resource(id, getf, resource_name, resource_to_apif, Authorization,
     return resource_to_apif(rec)
 
 async def list_resource(cursor, limit, listf, resource_name, resource_to_apif, to_list_typef, Authorization, test_authorization):
-    access_token_rec = get_accesstoken_rec_from_header(Authorization or test_authorization)
+    access_token_rec = await run_blocking(get_accesstoken_rec_from_header, Authorization or test_authorization)
     owner_user_id = access_token_rec.get("owner_user_id")
 
     limitint = int(limit) if limit else 100
 
-    new_cursor, recs = listf(owner_user_id, cursor, limitint)
+    try:
+        new_cursor, recs = await run_blocking(listf, owner_user_id, cursor, limitint)
+    except InvalidCursor:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
 
     recs = [resource_to_apif(rec) if resource_to_apif else rec for rec in recs]
 
@@ -69,11 +74,11 @@ async def list_resource(cursor, limit, listf, resource_name, resource_to_apif, t
     return list
 
 async def update_resource(id, resource, getf, updatef, resource_name, resource_to_apif, Authorization, test_authorization):
-    access_token_rec = get_accesstoken_rec_from_header(Authorization or test_authorization)
+    access_token_rec = await run_blocking(get_accesstoken_rec_from_header, Authorization or test_authorization)
 
     owner_user_id = access_token_rec.get("owner_user_id")
 
-    rec = getf(id)
+    rec = await run_blocking(getf, id)
 
     if not rec:
         raise HTTPException(status_code=404, detail=f"{resource_name} not found")
@@ -81,16 +86,16 @@ async def update_resource(id, resource, getf, updatef, resource_name, resource_t
     if rec.get("owner_user_id") != owner_user_id:
         raise HTTPException(status_code=401, detail="Invalid credentials")
 
-    rec = updatef(id, resource)
+    rec = await run_blocking(updatef, id, resource)
 
     return resource_to_apif(rec)
 
 async def delete_resource(id, getf, deletef, resource_name, to_delete_typef, Authorization, test_authorization):
-    access_token_rec = get_accesstoken_rec_from_header(Authorization or test_authorization)
+    access_token_rec = await run_blocking(get_accesstoken_rec_from_header, Authorization or test_authorization)
 
     owner_user_id = access_token_rec.get("owner_user_id")
 
-    rec = getf(id)
+    rec = await run_blocking(getf, id)
 
     if not rec:
         raise HTTPException(status_code=404, detail=f"{resource_name} not found")
@@ -99,26 +104,26 @@ async def delete_resource(id, getf, deletef, resource_name, to_delete_typef, Aut
         raise HTTPException(status_code=401, detail="Invalid credentials")
 
     # delete the credential
-    deletef(id)
+    await run_blocking(deletef, id)
 
     # return the credential
     return to_delete_typef(id)
 
 async def create_resource(createf, resource_to_apif, checkf=None, Authorization=None, test_authorization=None, **kwargs):
-    access_token_rec = get_accesstoken_rec_from_header(Authorization or test_authorization)
+    access_token_rec = await run_blocking(get_accesstoken_rec_from_header, Authorization or test_authorization)
 
     owner_user_id = access_token_rec.get("owner_user_id")
 
     # let's check that the user actually exists and is not disabled
-    user_rec = get_user_rec(owner_user_id)
+    user_rec = await run_blocking(get_user_rec, owner_user_id)
 
     if not (user_rec and not user_rec.get("disabled")):
         raise HTTPException(status_code=404, detail="User not found")
 
     if checkf:
-        checkf(owner_user_id, **kwargs)
+        await run_blocking(checkf, owner_user_id, **kwargs)
 
-    rec = createf(owner_user_id, **kwargs)
+    rec = await run_blocking(createf, owner_user_id, **kwargs)
 
     # return the credential
     return resource_to_apif(rec)
@@ -2,13 +2,54 @@
 import sys
 sys.path.append('/opt')
 
-from fastapi import FastAPI
+from fastapi import FastAPI, Request
+from starlette.background import BackgroundTask
 import mangum
+import time
 
 from spelunk_handler import spelunk_router
+from metrics import flush_metrics, record_timing
+from enqueue import flush_enqueued, pending_count
+from aio import run_blocking
 
 app = FastAPI()
 
+def flush_invocation():
+    # one invocation per request under mangum, so this is the end of the invocation.
+    # send the ops the request queued for the blambda, in batches. ops that can't be sent
+    # are undone by their on_failed (a spelunk's enqueue lease is released), so the
+    # client's next poll queues them again.
+    count = pending_count()
+    if count:
+        started = time.perf_counter()
+        failed = flush_enqueued()
+        record_timing(
+            'FlushEnqueued', 'lambda_handler.flush_middleware', (time.perf_counter() - started) * 1000,
+            item_count=count, error=bool(failed)
+        )
+    flush_metrics()
+
+async def flush_invocation_async(background=None):
+    try:
+        if background is not None:
+            await background()
+    finally:
+        await run_blocking(flush_invocation)
+
+@app.middleware("http")
+async def flush_middleware(request: Request, call_next):
+    try:
+        response = await call_next(request)
+    except Exception:
+        await flush_invocation_async()
+        raise
+
+    # flushed once the response body has been sent. a server that streams responses (uvicorn)
+    # has answered the client by then; mangum only returns when the app is done, so under
+    # lambda the flush still counts against the request, and FlushEnqueued shows by how much.
+    response.background = BackgroundTask(flush_invocation_async, response.background)
+    return response
+
 # app.include_router(authn_router, prefix="/authn", tags=["authn"])
 app.include_router(spelunk_router, prefix="/api/v1/spelunk", tags=["spelunk"])
 
@@ -1,8 +1,10 @@
 from fastapi import APIRouter, FastAPI, Request, HTTPException, Header
 from typing import Optional
 from pydantic import BaseModel
-from spelunk import get_spelunk_by_id, create_spelunk_rec_from_url, Spelunk, get_spelunk_rec, spelunk_rec_needs_processing, add_temporary_urls_to_spelunk_rec
-from shared import process_op_in_blambda
+from spelunk import Spelunk, SpelunkStatus, spelunk_rec_needs_processing, get_spelunk_rec_async, create_spelunk_rec_from_url_async, \
+    sign_spelunk_lens_urls_async, add_signed_urls_to_spelunk_rec, get_spelunk_status_async, spelunk_status_to_api, \
+    enqueue_spelunk_processing_async
+import asyncio
 import os
 
 spelunk_router = APIRouter()
@@ -14,33 +16,57 @@ class SpelunkCreate(BaseModel):
 async def create_spelunk(values: SpelunkCreate) -> Spelunk:
     s3_bucket = os.environ['bucket_name']
 
-    spelunk_rec = create_spelunk_rec_from_url(values.url)
+    spelunk_rec = await create_spelunk_rec_from_url_async(values.url)
 
     if spelunk_rec:
+        spelunk_id = spelunk_rec['id']
+
         if spelunk_rec_needs_processing(spelunk_rec):
-            spelunk_id = spelunk_rec['id']
-            process_op_in_blambda(spelunk_id, 'process_spelunk', {"spelunk_id": spelunk_id})
-    
-        spelunk_rec = add_temporary_urls_to_spelunk_rec(spelunk_rec, s3_bucket)
+            _, (transcript_url, summary_url) = await asyncio.gather(
+                enqueue_spelunk_processing_async(spelunk_rec),
+                sign_spelunk_lens_urls_async(spelunk_id, s3_bucket)
+            )
+        else:
+            transcript_url, summary_url = await sign_spelunk_lens_urls_async(spelunk_id, s3_bucket)
+
+        spelunk_rec = add_signed_urls_to_spelunk_rec(spelunk_rec, transcript_url, summary_url)
 
         return Spelunk(**spelunk_rec)
     else:
         raise HTTPException(status_code=500, detail="Failed to create spelunk")
  
+@spelunk_router.get("/{spelunk_id}/status")
+async def get_spelunk_status(spelunk_id: str) -> SpelunkStatus:
+    # cheap endpoint for polling: just the lens statuses, no urls
+    status_rec = await get_spelunk_status_async(spelunk_id)
+
+    if status_rec:
+        # queued at most once per lease, however often the client polls
+        if spelunk_rec_needs_processing(status_rec):
+            await enqueue_spelunk_processing_async(status_rec)
+
+        return spelunk_status_to_api(status_rec)
+    else:
+        raise HTTPException(status_code=404, detail="Spelunk not found")
+
 @spelunk_router.get("/{spelunk_id}")
 async def get_spelunk(spelunk_id: str) -> Spelunk:
     s3_bucket = os.environ['bucket_name']
 
-    spelunk_rec = get_spelunk_rec(spelunk_id)
+    # spelunk_id may be an alias, so the urls are signed for the id of the record it resolves to
+    spelunk_rec = await get_spelunk_rec_async(spelunk_id, use_cache=True)
 
     if spelunk_rec:
         if spelunk_rec_needs_processing(spelunk_rec):
-            process_op_in_blambda(spelunk_id, 'process_spelunk', {"spelunk_id": spelunk_id})
+            _, (transcript_url, summary_url) = await asyncio.gather(
+                enqueue_spelunk_processing_async(spelunk_rec),
+                sign_spelunk_lens_urls_async(spelunk_rec['id'], s3_bucket)
+            )
+        else:
+            transcript_url, summary_url = await sign_spelunk_lens_urls_async(spelunk_rec['id'], s3_bucket)
 
-        spelunk_rec = add_temporary_urls_to_spelunk_rec(spelunk_rec, s3_bucket)
+        spelunk_rec = add_signed_urls_to_spelunk_rec(spelunk_rec, transcript_url, summary_url)
 
         return Spelunk(**spelunk_rec)
     else:
         raise HTTPException(status_code=404, detail="Spelunk not found")
-
-
@@ -0,0 +1,55 @@
+'''
+This file lets async code (like the FastAPI handlers) call the blocking layer functions
+without stalling the event loop.
+
+Blocking calls run on one shared, bounded thread pool, so a burst of requests can't start
+an unbounded number of threads:
+    rec = await run_blocking(get_spelunk_rec, spelunk_id)
+
+Independent calls can then run concurrently, so a handler waits for the slowest of them
+rather than the sum:
+    rec, url = await asyncio.gather(run_blocking(f, x), run_blocking(g, y))
+
+Configured with these environment variables:
+    aio_max_workers: threads in the shared pool (default 16)
+'''
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import functools
+import os
+import threading
+
+EXECUTOR = None
+EXECUTOR_LOCK = threading.Lock()
+
+def get_executor():
+    '''
+    Get the shared thread pool, creating it on first use.
+    '''
+    global EXECUTOR
+
+    if EXECUTOR is None:
+        with EXECUTOR_LOCK:
+            if EXECUTOR is None:
+                EXECUTOR = ThreadPoolExecutor(
+                    max_workers=int(os.environ.get('aio_max_workers', 16)),
+                    thread_name_prefix='aio'
+                )
+
+    return EXECUTOR
+
+async def run_blocking(f, *args, **kwargs):
+    '''
+    Run the blocking function f on the shared thread pool, and wait for its result.
+    '''
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_executor(), functools.partial(f, *args, **kwargs))
+
+def to_async(f):
+    '''
+    Make an async variant of a blocking function, which runs it on the shared thread pool.
+    '''
+    @functools.wraps(f)
+    async def wrapper(*args, **kwargs):
+        return await run_blocking(f, *args, **kwargs)
+    return wrapper
@@ -0,0 +1,106 @@
+'''
+This file holds the boto3 clients shared by the layer modules.
+
+Clients are created once per warm Lambda container and reused across invocations,
+so we only pay for endpoint resolution and TLS handshakes on a cold start.
+
+The connection behaviour can be tuned with these environment variables:
+    aws_max_pool_connections: max connections kept open per client (default 50)
+    aws_tcp_keepalive: 'true' to enable TCP keep-alive on pooled connections (default 'true')
+    aws_retry_mode: botocore retry mode, 'legacy', 'standard' or 'adaptive' (default 'standard')
+    aws_max_attempts: max attempts per call including the first one (default 3)
+        (dynamodb calls are retried by ddb.call_dynamodb instead, see C_SERVICE_MAX_ATTEMPTS)
+    aws_connect_timeout: seconds to wait for a connection (default 5)
+    aws_read_timeout: seconds to wait for a response (default 30)
+
+Setting ddb_backend to 'memory' swaps dynamodb for the in-memory engine in ddb_memory.py,
+for tests and benchmarks that shouldn't touch AWS.
+'''
+import os
+import threading
+import boto3
+from botocore.config import Config
+
+# services whose retries are handled by the layer rather than botocore.
+# ddb.call_dynamodb retries throttled calls itself, so that it sees every throttle
+# and can slow down its send rate.
+C_SERVICE_MAX_ATTEMPTS = {
+    'dynamodb': 1
+}
+
+CLIENTS = {}
+CLIENTS_LOCK = threading.Lock()
+
+def env_bool(name, default):
+    value = os.environ.get(name)
+    if value is None:
+        return default
+    return value.strip().lower() in ('1', 'true', 'yes', 'on')
+
+def get_client_config(max_attempts=None):
+    '''
+    Build the botocore config used for every pooled client.
+    '''
+    return Config(
+        max_pool_connections=int(os.environ.get('aws_max_pool_connections', 50)),
+        tcp_keepalive=env_bool('aws_tcp_keepalive', True),
+        connect_timeout=float(os.environ.get('aws_connect_timeout', 5)),
+        read_timeout=float(os.environ.get('aws_read_timeout', 30)),
+        retries={
+            'mode': os.environ.get('aws_retry_mode', 'standard'),
+            'max_attempts': max_attempts or int(os.environ.get('aws_max_attempts', 3))
+        }
+    )
+
+def get_client(service_name):
+    '''
+    Get the shared client for an AWS service, creating it on first use.
+    boto3 clients are thread safe, so the same client is handed to every caller.
+    '''
+    client = CLIENTS.get(service_name)
+
+    if client is None:
+        with CLIENTS_LOCK:
+            client = CLIENTS.get(service_name)
+            if client is None:
+                client = create_client(service_name)
+                CLIENTS[service_name] = client
+
+    return client
+
+def create_client(service_name):
+    '''
+    Create a new client for an AWS service, honouring the ddb_backend switch for dynamodb.
+    '''
+    if service_name == 'dynamodb' and os.environ.get('ddb_backend', 'aws').strip().lower() == 'memory':
+        # only tests and benchmarks use the in-memory engine, so production never loads it
+        from ddb_memory import MemoryDynamoDBClient
+        return MemoryDynamoDBClient()
+
+    config = get_client_config(C_SERVICE_MAX_ATTEMPTS.get(service_name))
+    return boto3.session.Session().client(service_name, config=config)
+
+def set_client(service_name, client):
+    '''
+    Use client for service_name from now on, instead of the one get_client would create.
+    '''
+    with CLIENTS_LOCK:
+        CLIENTS[service_name] = client
+
+def use_memory_dynamodb(**kwargs):
+    '''
+    Switch dynamodb to a fresh in-memory engine (see ddb_memory.py) and return it.
+    kwargs are passed to MemoryDynamoDBClient, e.g. latency_ms=5.
+    '''
+    from ddb_memory import MemoryDynamoDBClient
+
+    client = MemoryDynamoDBClient(**kwargs)
+    set_client('dynamodb', client)
+    return client
+
+def reset_clients():
+    '''
+    Drop all pooled clients. The next get_client call creates fresh ones.
+    '''
+    with CLIENTS_LOCK:
+        CLIENTS.clear()
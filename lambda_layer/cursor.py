@@ -0,0 +1,204 @@
+'''
+This file includes the codec for pagination cursors, the opaque strings handed to API
+clients to fetch the next page of a list.
+
+A cursor carries a query's LastEvaluatedKey. Only the key values are packed, in binary, in
+the order of the table/index key names (the names are implied by the query being resumed),
+the result is compressed when that helps, and it is signed with a truncated HMAC-SHA256, so
+cursors are short, don't expose the key structure, and can't be tampered with to start a
+query somewhere the caller shouldn't. Tampered or malformed cursors raise InvalidCursor
+before anything is sent to dynamodb.
+
+The signature also covers a context string (e.g. the table and index), so a cursor from one
+listing can't be replayed against another.
+
+Configured with these environment variables:
+    cursor_secret: the signing key. A comma separated list rotates keys: the first signs,
+        all of them verify. If unset, a random per-process key is used, so cursors only work
+        within one container; set it for anything deployed.
+'''
+from log import get_logger
+import base64
+import hashlib
+import hmac
+import os
+import secrets
+import zlib
+
+logger = get_logger('cursor')
+
+C_CURSOR_VERSION = 1
+C_SIGNATURE_BYTES = 12
+C_MAX_CURSOR_CHARS = 2048
+
+# header flags
+C_FLAG_NAMES = 0x01
+C_FLAG_COMPRESSED = 0x02
+
+C_TYPE_TAGS = {'S': 1, 'N': 2, 'B': 3}
+C_TAG_TYPES = {tag: type_name for type_name, tag in C_TYPE_TAGS.items()}
+
+FALLBACK_SECRET = secrets.token_bytes(32)
+WARNED_NO_SECRET = False
+
+class InvalidCursor(ValueError):
+    '''
+    Raised when a cursor is malformed, has been tampered with, or was signed for something else.
+    '''
+    pass
+
+def get_cursor_secrets():
+    '''
+    The signing keys, the one to sign with first.
+    '''
+    global WARNED_NO_SECRET
+
+    configured = [secret.strip() for secret in os.environ.get('cursor_secret', '').split(',') if secret.strip()]
+    if not configured:
+        if not WARNED_NO_SECRET:
+            WARNED_NO_SECRET = True
+            logger.warning('cursor_secret is not set, cursors are signed with a per-process key')
+        return [FALLBACK_SECRET]
+    return [secret.encode('utf-8') for secret in configured]
+
+def sign(secret, context, data):
+    message = context.encode('utf-8') + b'\0' + data
+    return hmac.new(secret, message, hashlib.sha256).digest()[:C_SIGNATURE_BYTES]
+
+def pack_varint(value):
+    out = bytearray()
+    while True:
+        byte = value & 0x7f
+        value >>= 7
+        if value:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return bytes(out)
+
+def unpack_varint(data, pos):
+    value = 0
+    shift = 0
+    while True:
+        if pos >= len(data) or shift > 28:
+            raise InvalidCursor('invalid cursor')
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            return value, pos
+        shift += 7
+
+def pack_bytes(value):
+    return pack_varint(len(value)) + value
+
+def unpack_bytes(data, pos):
+    length, pos = unpack_varint(data, pos)
+    if pos + length > len(data):
+        raise InvalidCursor('invalid cursor')
+    return data[pos:pos + length], pos + length
+
+def pack_key(key, key_names):
+    '''
+    Pack a typed key ({name: {'S': value}}) into bytes. Returns (flags, data).
+    If the key's attributes are exactly key_names, only the values are packed.
+    '''
+    with_names = not key_names or set(key) != set(key_names)
+    names = sorted(key) if with_names else key_names
+
+    parts = []
+    for name in names:
+        (type_name, value), = key[name].items()
+        if type_name not in C_TYPE_TAGS:
+            raise ValueError(f'cannot put a {type_name} attribute in a cursor: {name}')
+
+        if with_names:
+            parts.append(pack_bytes(name.encode('utf-8')))
+        raw_value = value if type_name == 'B' else value.encode('utf-8')
+        parts.append(bytes([C_TYPE_TAGS[type_name]]) + pack_bytes(raw_value))
+
+    return (C_FLAG_NAMES if with_names else 0), b''.join(parts)
+
+def unpack_key(flags, data, key_names):
+    key = {}
+    pos = 0
+    index = 0
+
+    while pos < len(data):
+        if flags & C_FLAG_NAMES:
+            raw_name, pos = unpack_bytes(data, pos)
+            name = raw_name.decode('utf-8')
+        else:
+            if not key_names or index >= len(key_names):
+                raise InvalidCursor('invalid cursor')
+            name = key_names[index]
+        index += 1
+
+        if pos >= len(data) or data[pos] not in C_TAG_TYPES:
+            raise InvalidCursor('invalid cursor')
+        type_name = C_TAG_TYPES[data[pos]]
+        raw_value, pos = unpack_bytes(data, pos + 1)
+        key[name] = {type_name: raw_value if type_name == 'B' else raw_value.decode('utf-8')}
+
+    if not flags & C_FLAG_NAMES and key_names and len(key) != len(key_names):
+        raise InvalidCursor('invalid cursor')
+
+    return key
+
+def encode_cursor(last_evaluated_key, key_names=None, context=''):
+    '''
+    Turn a typed LastEvaluatedKey into a signed cursor string (None for no more pages).
+    key_names are the table/index key attributes, in a fixed order (see ddb.default_key_names).
+    context names what the cursor is for; decode_cursor must be given the same.
+    '''
+    if not last_evaluated_key:
+        return None
+
+    flags, data = pack_key(last_evaluated_key, key_names)
+
+    compressed = zlib.compress(data, 9)
+    if len(compressed) < len(data):
+        flags |= C_FLAG_COMPRESSED
+        data = compressed
+
+    body = bytes([(C_CURSOR_VERSION << 4) | flags]) + data
+    signature = sign(get_cursor_secrets()[0], context, body)
+
+    return base64.urlsafe_b64encode(body + signature).decode('ascii').rstrip('=')
+
+def decode_cursor(cursor, key_names=None, context=''):
+    '''
+    Turn a cursor from encode_cursor back into an ExclusiveStartKey.
+    Raises InvalidCursor if it is malformed, tampered with, or was made for another context.
+    '''
+    if not cursor:
+        return None
+
+    if not isinstance(cursor, str) or len(cursor) > C_MAX_CURSOR_CHARS:
+        raise InvalidCursor('invalid cursor')
+
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+    except (ValueError, TypeError):
+        raise InvalidCursor('invalid cursor')
+
+    if len(raw) <= C_SIGNATURE_BYTES:
+        raise InvalidCursor('invalid cursor')
+
+    body, signature = raw[:-C_SIGNATURE_BYTES], raw[-C_SIGNATURE_BYTES:]
+
+    # check the signature before looking inside
+    if not any(hmac.compare_digest(sign(secret, context, body), signature) for secret in get_cursor_secrets()):
+        raise InvalidCursor('invalid cursor')
+
+    header, data = body[0], body[1:]
+    if header >> 4 != C_CURSOR_VERSION:
+        raise InvalidCursor('invalid cursor')
+    flags = header & 0x0f
+
+    try:
+        if flags & C_FLAG_COMPRESSED:
+            data = zlib.decompress(data)
+        return unpack_key(flags, data, key_names)
+    except (zlib.error, UnicodeDecodeError):
+        raise InvalidCursor('invalid cursor')
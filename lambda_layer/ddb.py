@@ -3,111 +3,141 @@ This file includes functions to standardize interacting with dynamodb.
 '''
 from cgi import print_directory
 from curses import keyname
-import boto3
-import json
-import base64
+from clients import get_client, env_bool
+from ddb_codec import encode_item, decode_item, encode_value, decode_value
+from ratelimit import TokenBucket, AdaptiveRateLimiter
+from retry import backoff_sleep
+from cursor import encode_cursor, decode_cursor, InvalidCursor
+from offload import offload_item, offload_paths, restore_item
+from log import get_logger
+from lru import TTLCache
+from metrics import record_ddb_call, metrics_enabled, call_site as find_call_site, C_READ_OPERATIONS
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from botocore.exceptions import ClientError, HTTPClientError, ConnectionError as BotoConnectionError
+from collections import deque
+import copy
+import heapq
+import os
+import queue
+import threading
+import time
 
-def remove_ddb_format(ddb_obj, this_is_metadata=False):
+C_BATCH_GET_MAX_KEYS = 100
+C_BATCH_WRITE_MAX_ITEMS = 25
+C_BATCH_MAX_WORKERS = 8
+C_BATCH_MAX_ATTEMPTS = 8
+C_SCAN_DEFAULT_SEGMENTS = 8
+C_QUERY_MANY_MAX_WORKERS = 8
+C_VERSION_ATTRIBUTE = 'row_version'
+C_TRANSACTION_MAX_ITEMS = 100
+
+logger = get_logger('ddb')
+
+###################################################################
+#
+# Item cache
+#
+# An optional read-through cache for get_item, private to this process (i.e. a warm
+# Lambda container). Writes made through this module invalidate the cached item, but
+# writes from other processes are only seen when the entry expires, so only cache
+# items that rarely change (see the cache_if argument to get_item).
+#
+###################################################################
+
+C_ITEM_CACHE_DEFAULT_TTL = float(os.environ.get('ddb_item_cache_ttl', 60))
+
+ITEM_CACHE = TTLCache(max_size=int(os.environ.get('ddb_item_cache_size', 1000)))
+ITEM_CACHE_TTLS = {}
+
+def set_item_cache_ttl(table_name, ttl_secs):
     '''
-    An object in ddb_format includes metadata about the object.
-    This function removes that metadata.
+    Set how long get_item results for a table stay cached. 0 disables caching for the table.
     '''
+    ITEM_CACHE_TTLS[table_name] = ttl_secs
+    if not ttl_secs:
+        invalidate_cached_table(table_name)
 
-    if not isinstance(ddb_obj, dict) and this_is_metadata:
-        raise ValueError(f'Expected ddb_obj to be a metadata dict, got {type(ddb_obj)}')
+def item_cache_key(table_name, pkey, skey):
+    return (table_name, pkey, skey)
 
-    if isinstance(ddb_obj, dict):
-        def convert_ddb_num(strval):
-            try:
-                return int(strval)
-            except ValueError:
-                return float(strval)
-
-        if this_is_metadata:
-            # there should be a single key in the dict
-            # the key tells us the type of the underlying value
-            # the value is the actual value we want to return, but 
-            # we may have to modify its type
-
-            # check there is only one key
-            if len(ddb_obj) != 1:
-                # bad format
-                raise ValueError(f'Bad format for metadata: {ddb_obj}')
-
-            # get the key
-            key = list(ddb_obj.keys())[0]
-
-            if key == 'S':
-                # string
-                return ddb_obj[key]
-            elif key == 'N':
-                # number
-                return convert_ddb_num(ddb_obj[key])
-            elif key == 'B':
-                # binary
-                return ddb_obj[key]
-            elif key == 'BOOL':
-                # boolean
-                return ddb_obj[key]
-            elif key == 'NULL':
-                # null
-                return None
-            elif key == 'M':
-                # map
-                return remove_ddb_format(ddb_obj[key], this_is_metadata=False)
-            elif key == 'L':
-                # list
-                return remove_ddb_format(ddb_obj[key], this_is_metadata=False)
-            elif key == 'SS':
-                # set of strings
-                return set(ddb_obj[key])
-            elif key == 'NS':
-                # set of numbers
-                return set([convert_ddb_num(x) for x in ddb_obj[key]])
-            elif key == 'BS':
-                # set of binaries
-                return set(ddb_obj[key])
-            else:
-                # bad format
-                raise ValueError(f'Unknown key in ddb metadata: {key}')
-        else:
-            # this is not metadata, so it should be a dict
-            # remove the metadata
-            return {k: remove_ddb_format(v, this_is_metadata=True) for k, v in ddb_obj.items()}
+def invalidate_cached_item(table_name, pkey, skey=None):
+    ITEM_CACHE.delete(item_cache_key(table_name, pkey, skey))
+
+def invalidate_cached_table(table_name):
+    ITEM_CACHE.delete_where(lambda key: key[0] == table_name)
+
+def item_cache_stats():
+    '''
+    Hit, miss, eviction and expiration counts for the item cache.
+    '''
+    return ITEM_CACHE.stats()
+
+def clear_item_cache():
+    ITEM_CACHE.clear()
+
+class VersionConflictError(Exception):
+    '''
+    A versioned write found that the stored item had moved on from the expected version
+    (or that another condition on the write failed).
+    '''
+    pass
+
+class TransactionCanceledError(Exception):
+    '''
+    A transaction was cancelled. reasons has one entry per operation, in the order they were added:
+    {'Code': 'None' | 'ConditionalCheckFailed' | ..., 'Message': ..., 'Item': decoded item or None}
+    The Item is the stored item for failed conditions, when it was asked for.
+    '''
+    def __init__(self, message, reasons):
+        super().__init__(message)
+        self.reasons = reasons
+
+    def failed_indexes(self):
+        return [index for index, reason in enumerate(self.reasons) if reason.get('Code') not in (None, 'None')]
+
+def is_conditional_check_failed(e):
+    return isinstance(e, ClientError) and e.response.get('Error', {}).get('Code') == 'ConditionalCheckFailedException'
+
+def is_invalid_start_key(e):
+    error = e.response.get('Error', {}) if isinstance(e, ClientError) else {}
+    return error.get('Code') == 'ValidationException' and 'starting key' in (error.get('Message') or '')
+
+def remove_ddb_format(ddb_obj, this_is_metadata=False, use_decimal=False):
+    '''
+    An object in ddb_format includes metadata about the object.
+    This function removes that metadata.
+    With use_decimal, non integral numbers are returned as Decimals rather than floats.
+    '''
+    if this_is_metadata:
+        return decode_value(ddb_obj, use_decimal)
+    elif isinstance(ddb_obj, dict):
+        return decode_item(ddb_obj, use_decimal)
     elif isinstance(ddb_obj, list):
-        # this is a list, so we should remove the metadata
-        return [remove_ddb_format(x, this_is_metadata=True) for x in ddb_obj]
+        return [decode_value(x, use_decimal) for x in ddb_obj]
     else:
         # this is a scalar, so we should return it
         return ddb_obj
 
+def item_from_ddb(ddb_item):
+    '''
+    Decode an item read from dynamodb, undoing any attribute offloading (see offload.py).
+    '''
+    return restore_item(remove_ddb_format(ddb_item))
+
 def add_ddb_format(obj, add_to_this_level=False):
-    print(f'add_ddb_format: {json.dumps(obj, indent=2)}')
+    '''
+    Add dynamodb type metadata to an object.
+    By default obj is a container (an item, key or expression values) whose members are converted,
+    with add_to_this_level obj itself is converted.
+    '''
     if add_to_this_level:
-        if isinstance(obj, dict):
-            return {"M": {k: add_ddb_format(v, add_to_this_level=True) for k, v in obj.items()}}
-        elif isinstance(obj, (list, set, tuple)):
-            return {"L": [add_ddb_format(x, add_to_this_level=True) for x in obj]}
-        elif isinstance(obj, str):
-            return {"S": obj}
-        elif isinstance(obj, bool): # must be before int
-            return {"BOOL": obj}
-        elif isinstance(obj, (int, float)):
-            return {"N": str(obj)}
-        elif isinstance(obj, bytes):
-            return {"B": obj}
-        elif obj is None:
-            return {"NULL": True} 
-        else:
-            raise ValueError(f'Unsupported type in obj: {type(obj)}')
+        return encode_value(obj)
+    elif isinstance(obj, dict):
+        return encode_item(obj)
+    elif isinstance(obj, (list, set, tuple)):
+        return [encode_value(x) for x in obj]
     else:
-        if isinstance(obj, dict):
-            return {k: add_ddb_format(v, add_to_this_level=True) for k, v in obj.items()}
-        elif isinstance(obj, (list, set, tuple)):
-            return [add_ddb_format(x, add_to_this_level=True) for x in obj]
-        else:
-            # return obj
-            raise ValueError(f'Expected container type but got {type(obj)}')
+        raise ValueError(f'Expected container type but got {type(obj)}')
 
 def remove_none_attribs(obj):
     '''
@@ -123,16 +153,230 @@ def calculate_key(pkey, skey, pkey_name, skey_name):
         return add_ddb_format({pkey_name: pkey})
     else:
         return add_ddb_format({pkey_name: pkey, skey_name: skey})
-    
+
+###################################################################
+#
+# Calling dynamodb
+#
+# Every request goes through call_dynamodb, which records its table, index, call site,
+# consumed capacity, item count and latency in the per-invocation metrics (see metrics.py).
+# It also paces requests with a per table adaptive rate limiter (see ratelimit.py), and
+# retries throttled requests, so bursts of workers back off together instead of
+# hammering a throttled table.
+#
+###################################################################
+
+C_OPERATION_METHODS = {
+    'GetItem': 'get_item',
+    'Query': 'query',
+    'Scan': 'scan',
+    'PutItem': 'put_item',
+    'UpdateItem': 'update_item',
+    'DeleteItem': 'delete_item',
+    'BatchGetItem': 'batch_get_item',
+    'BatchWriteItem': 'batch_write_item',
+    'TransactWriteItems': 'transact_write_items',
+    'TransactGetItems': 'transact_get_items',
+}
+
+C_THROTTLE_ERROR_CODES = {
+    'ProvisionedThroughputExceededException',
+    'ThrottlingException',
+    'RequestLimitExceeded',
+}
+
+C_TRANSIENT_ERROR_CODES = {
+    'InternalServerError',
+    'ServiceUnavailable',
+}
+
+C_RETRY_THROTTLED = 'throttled'
+C_RETRY_TRANSIENT = 'transient'
+
+# the dynamodb client doesn't retry (see clients.C_SERVICE_MAX_ATTEMPTS), call_dynamodb does
+C_DDB_MAX_ATTEMPTS = int(os.environ.get('ddb_max_attempts', 8))
+
+RATE_LIMITERS = {}
+RATE_LIMITERS_LOCK = threading.Lock()
+
+def get_rate_limiter(table_name, operation):
+    '''
+    The adaptive rate limiter for reads or writes (depending on operation) to a table,
+    or None if the ddb_adaptive_rate env var is 'false'.
+    '''
+    if not env_bool('ddb_adaptive_rate', True):
+        return None
+
+    limiter_key = (table_name, 'read' if operation in C_READ_OPERATIONS else 'write')
+
+    limiter = RATE_LIMITERS.get(limiter_key)
+    if limiter is None:
+        with RATE_LIMITERS_LOCK:
+            limiter = RATE_LIMITERS.get(limiter_key)
+            if limiter is None:
+                limiter = AdaptiveRateLimiter(min_rate=float(os.environ.get('ddb_min_rate', 1)))
+                RATE_LIMITERS[limiter_key] = limiter
+
+    return limiter
+
+def rate_limiter_stats():
+    '''
+    The state of each table's read and write rate limiters.
+    '''
+    return {f'{table_name}:{access}': limiter.stats() for (table_name, access), limiter in list(RATE_LIMITERS.items())}
+
+def throttled(table_name, operation):
+    limiter = get_rate_limiter(table_name, operation)
+    if limiter:
+        limiter.on_throttle()
+
+def retryable_error_kind(e):
+    '''
+    C_RETRY_THROTTLED or C_RETRY_TRANSIENT if a failed call is worth retrying, otherwise None.
+    '''
+    if isinstance(e, ClientError):
+        code = e.response.get('Error', {}).get('Code')
+        if code in C_THROTTLE_ERROR_CODES:
+            return C_RETRY_THROTTLED
+        if code in C_TRANSIENT_ERROR_CODES:
+            return C_RETRY_TRANSIENT
+        return None
+    if isinstance(e, (BotoConnectionError, HTTPClientError)):
+        return C_RETRY_TRANSIENT
+    return None
+
+# frames in these modules are skipped when working out who made a call
+C_CALL_SITE_SKIP_MODULES = {__name__, 'metrics', 'threading', 'concurrent.futures.thread'}
+
+def ddb_call_site():
+    '''
+    The module.function that called into this module. Capture it on the caller's thread,
+    before handing work to a thread pool.
+    '''
+    return find_call_site(C_CALL_SITE_SKIP_MODULES)
+
+def request_table_name(operation, params):
+    if 'TableName' in params:
+        return params['TableName']
+    if operation in ('BatchGetItem', 'BatchWriteItem'):
+        return ','.join(sorted(params.get('RequestItems', {})))
+    table_names = {
+        entry['TableName']
+        for transact_item in params.get('TransactItems', [])
+        for entry in transact_item.values()
+    }
+    return ','.join(sorted(table_names))
+
+def response_item_count(operation, params, response):
+    '''
+    How many items a call read or wrote.
+    '''
+    if operation == 'GetItem':
+        return 1 if response.get('Item') else 0
+    elif operation in ('Query', 'Scan'):
+        return response.get('Count') or 0
+    elif operation == 'BatchGetItem':
+        return sum(len(items) for items in (response.get('Responses') or {}).values())
+    elif operation == 'BatchWriteItem':
+        sent = sum(len(requests) for requests in params['RequestItems'].values())
+        unprocessed = sum(len(requests) for requests in (response.get('UnprocessedItems') or {}).values())
+        return sent - unprocessed
+    elif operation == 'TransactGetItems':
+        return sum(1 for entry in (response.get('Responses') or []) if entry.get('Item'))
+    elif operation == 'TransactWriteItems':
+        return len(params['TransactItems'])
+    else:
+        return 1
+
+def call_dynamodb(operation, params, call_site=None):
+    '''
+    Make a low level dynamodb client call (operation is the API name, e.g. 'GetItem') and record it in the metrics.
+
+    Calls wait on the table's adaptive rate limiter for their kind of access (read or write).
+    Throttled and transient failures are retried with jittered exponential backoff, up to
+    C_DDB_MAX_ATTEMPTS attempts, and throttles slow the limiter down.
+
+    While metrics are on, calls that didn't ask for ConsumedCapacity ask for TOTAL, and it is
+    removed from the response again, so callers see the response they asked for.
+    '''
+    method = getattr(get_client('dynamodb'), C_OPERATION_METHODS[operation])
+
+    table_name = request_table_name(operation, params)
+    limiter = get_rate_limiter(table_name, operation)
+
+    recording = metrics_enabled()
+    added_capacity = recording and params.get('ReturnConsumedCapacity', 'NONE') == 'NONE'
+    if added_capacity:
+        params = {**params, 'ReturnConsumedCapacity': 'TOTAL'}
+
+    index_name = params.get('IndexName')
+    if recording:
+        call_site = call_site or ddb_call_site()
+
+    attempt = 0
+    while True:
+        if limiter:
+            limiter.acquire()
+
+        started_at = time.perf_counter()
+        try:
+            response = method(**params)
+        except Exception as e:
+            retry_kind = retryable_error_kind(e)
+            if recording:
+                record_ddb_call(
+                    operation, table_name, index_name, call_site,
+                    elapsed_ms=(time.perf_counter() - started_at) * 1000, error=True,
+                    throttled=retry_kind == C_RETRY_THROTTLED
+                )
+
+            attempt += 1
+            if retry_kind is None or attempt >= C_DDB_MAX_ATTEMPTS:
+                raise
+
+            if retry_kind == C_RETRY_THROTTLED:
+                throttled(table_name, operation)
+                logger.info('throttled, retrying', operation=operation, table_name=table_name, attempt=attempt)
+
+            backoff_sleep(attempt)
+            continue
+
+        break
+
+    if recording:
+        record_ddb_call(
+            operation, table_name, index_name, call_site,
+            consumed_capacity=response.get('ConsumedCapacity'),
+            item_count=response_item_count(operation, params, response),
+            elapsed_ms=(time.perf_counter() - started_at) * 1000
+        )
+
+    if added_capacity:
+        response.pop('ConsumedCapacity', None)
+
+    return response
+
 def get_item(
     table_name, pkey, skey=None, pkey_name='pkey', skey_name=None, index_name=None, 
     consistent=False, return_consumed_capacity='NONE', projection_expression=None,
-    expression_attribute_names=None
+    expression_attribute_names=None, use_cache=False, cache_if=None
 ):
     '''
     Get an item from dynamodb.
+
+    With use_cache, whole-item reads from the table are served from the in-process item cache
+    when possible. Consistent reads always go to dynamodb, but refresh the cache.
+    If cache_if is given, only items for which cache_if(item) is true are cached.
     '''
-    dynamodb_client = boto3.client('dynamodb')
+    cache_ttl = ITEM_CACHE_TTLS.get(table_name, C_ITEM_CACHE_DEFAULT_TTL)
+    use_cache = use_cache and bool(cache_ttl) and not index_name and not projection_expression
+    cache_key = item_cache_key(table_name, pkey, skey)
+
+    if use_cache and not consistent:
+        cached_item = ITEM_CACHE.get(cache_key)
+        if cached_item is not None:
+            logger.debug('get_item cache hit', table_name=table_name, pkey=pkey, skey=skey)
+            return {'Item': copy.deepcopy(cached_item)}
 
     key = calculate_key(pkey, skey, pkey_name, skey_name)
 
@@ -146,13 +390,16 @@ def get_item(
         'ExpressionAttributeNames': expression_attribute_names
     })
 
-    print(f'params: {json.dumps(params, indent=2)}')
+    logger.debug('get_item', params=params)
+
+    response = call_dynamodb('GetItem', params)
 
-    response = dynamodb_client.get_item(**params)
+    logger.debug('get_item response', response=response)
 
-    print(f'response: {json.dumps(response, indent=2)}')
+    item = item_from_ddb(response.get('Item')) if response.get('Item') else None
 
-    item = remove_ddb_format(response.get('Item')) if response.get('Item') else None
+    if use_cache and item is not None and (cache_if is None or cache_if(item)):
+        ITEM_CACHE.set(cache_key, copy.deepcopy(item), ttl=cache_ttl)
 
     adjusted_response = remove_none_attribs({
         'Item': item,
@@ -174,31 +421,88 @@ def query(
     cursor=None, limit=None
 ):
 
-    print_dict = {
-        "table_name": table_name,
-        "pkey": pkey,
-        "pkey_name": pkey_name,
-        "index_name": index_name,
-        "select": select,
-        "consistent": consistent,
-        "forward": forward,
-        "return_consumed_capacity": return_consumed_capacity,
-        "key_condition_expression": key_condition_expression,
-        "projection_expression": projection_expression,
-        "filter_expression": filter_expression,
-        "expression_attribute_names": expression_attribute_names,
-        "expression_attribute_values": expression_attribute_values,
-        "cursor": cursor,
-        "limit": limit
+    logger.debug(
+        'query',
+        table_name=table_name,
+        pkey=pkey,
+        pkey_name=pkey_name,
+        index_name=index_name,
+        key_condition_expression=key_condition_expression,
+        filter_expression=filter_expression,
+        expression_attribute_values=expression_attribute_values,
+        cursor=cursor,
+        limit=limit
+    )
+
+    query_params = build_query_params(
+        table_name, pkey, pkey_name=pkey_name, index_name=index_name,
+        select=select, consistent=consistent, forward=forward,
+        return_consumed_capacity=return_consumed_capacity,
+        key_condition_expression=key_condition_expression,
+        projection_expression=projection_expression,
+        filter_expression=filter_expression,
+        expression_attribute_names=expression_attribute_names,
+        expression_attribute_values=expression_attribute_values
+    )
+
+    # cursors are checked before anything is sent to dynamodb; a bad one raises InvalidCursor
+    key_names = default_key_names(pkey_name, index_name)
+    cursor_context = query_cursor_context(query_params)
+
+    params = {
+        **query_params,
+        **remove_none_attribs({
+            'Limit': int(limit or 20),
+            'ExclusiveStartKey': decode_cursor(cursor, key_names, cursor_context),
+        })
     }
 
-    print(f'query(): {json.dumps(print_dict, indent=2)}')
+    # execute the query. a cursor that passed its signature check can still hold a key dynamodb
+    # won't start from (e.g. one signed before an index's key changed), which is the caller's fault too
+    try:
+        response = call_dynamodb('Query', params)
+    except ClientError as e:
+        if cursor and is_invalid_start_key(e):
+            raise InvalidCursor('invalid cursor') from e
+        raise
 
-    dynamodb_client = boto3.client('dynamodb')
+    logger.debug('query response', response=response)
 
-    # if we have a cursor, it is the base64 encoded string of the json of last returned item
-    exclusive_start_key = json.loads(base64.b64decode(cursor).decode('utf-8')) if cursor else None
+    cursor = encode_cursor(response.get('LastEvaluatedKey'), key_names, cursor_context)
+    
+    adjusted_response = remove_none_attribs({
+        'Items': [item_from_ddb(x) for x in response['Items']],
+        'Count': response.get('Count'),
+        'ScannedCount': response.get('ScannedCount'),
+        'Cursor': cursor,
+        'ConsumedCapacity': response.get('ConsumedCapacity')
+    })
 
+    return adjusted_response
+
+def query_cursor_context(params):
+    '''
+    What a query's cursors are signed for: its table, index and partition, so a cursor can
+    only resume the query it came from.
+    '''
+    (pkey_value,) = params['ExpressionAttributeValues'][':pkey'].values()
+    pkey_name = params['ExpressionAttributeNames']['#pkey']
+    return f"{params['TableName']}|{params.get('IndexName') or ''}|{pkey_name}|{pkey_value}"
+
+def build_query_params(
+    table_name, pkey, pkey_name='pkey', index_name=None,
+    select='ALL_ATTRIBUTES',
+    consistent=False, forward=True,
+    return_consumed_capacity='NONE',
+    key_condition_expression=None,
+    projection_expression=None,
+    filter_expression=None,
+    expression_attribute_names=None,
+    expression_attribute_values=None
+):
+    '''
+    Build the parameters for a single partition query, without Limit or ExclusiveStartKey.
+    '''
     if key_condition_expression:
         use_key_condition_expression = f'{key_condition_expression} AND #pkey = :pkey'
     else:
@@ -214,8 +518,7 @@ def query(
         ':pkey': pkey
     }) 
 
-    # create a dictionary with all the parameters for the query
-    params = remove_none_attribs({
+    return remove_none_attribs({
         'TableName': table_name,
         'IndexName': index_name,
         'KeyConditionExpression': use_key_condition_expression,
@@ -227,28 +530,143 @@ def query(
         'ReturnConsumedCapacity': return_consumed_capacity,
         'ProjectionExpression': projection_expression,
         'FilterExpression': filter_expression,
-        'Limit': int(limit or 20),
-        'ExclusiveStartKey': exclusive_start_key,
     })
 
-    # execute the query
-    response = dynamodb_client.query(**params)
+def default_key_names(pkey_name='pkey', index_name=None):
+    '''
+    The attributes that make up a LastEvaluatedKey for the table or one of its lookupN indexes.
+    The table is keyed on pkey only, and index lookupN is keyed on lN_pkey and lN_skey.
+    '''
+    if not index_name:
+        return [pkey_name]
+    return ['pkey', pkey_name, pkey_name.replace('_pkey', '_skey')]
 
-    print (f'query response: {response}')
+class QueryIterator:
+    '''
+    Iterates over every item a query matches, following LastEvaluatedKey page by page.
 
-    # the returned cursor is LastEvaluatedKey, json dumped and base64 encoded    
-    cursor = base64.b64encode(json.dumps(response['LastEvaluatedKey']).encode(('utf-8'))).decode('utf-8') if 'LastEvaluatedKey' in response else None
-    
-    # if we have a cursor, it is the base64 encoded string of the json of last returned item
-    adjusted_response = remove_none_attribs({
-        'Items': [remove_ddb_format(x) for x in response['Items']],
-        'Count': response.get('Count'),
-        'ScannedCount': response.get('ScannedCount'),
-        'Cursor': cursor,
-        'ConsumedCapacity': response.get('ConsumedCapacity')
-    })
+    Items are decoded only as they are handed out, and the next page is fetched in the
+    background while the caller works through the current one, so at most two pages
+    are held in memory at once.
 
-    return adjusted_response
+    After (or during) iteration, cursor resumes the query just after the last item handed out.
+    It is None once the query is exhausted.
+    '''
+    def __init__(self, params, page_size=100, max_items=None, cursor=None, key_names=None):
+        self.params = params
+        self.page_size = page_size
+        self.max_items = max_items
+        self.key_names = key_names
+        self.cursor = cursor
+        self.cursor_key_names = default_key_names(params['ExpressionAttributeNames']['#pkey'], params.get('IndexName'))
+        self.cursor_context = query_cursor_context(params)
+        self.start_key = decode_cursor(cursor, self.cursor_key_names, self.cursor_context)
+        # pages are fetched on a worker thread, so note who is iterating now
+        self.call_site = ddb_call_site()
+
+    def fetch_page(self, start_key, limit):
+        try:
+            return call_dynamodb('Query', {
+                **self.params,
+                **remove_none_attribs({
+                    'Limit': limit,
+                    'ExclusiveStartKey': start_key
+                })
+            }, call_site=self.call_site)
+        except ClientError as e:
+            # only the first page starts from a key the caller gave us (see query)
+            if start_key is not None and start_key is self.start_key and is_invalid_start_key(e):
+                raise InvalidCursor('invalid cursor') from e
+            raise
+
+    def page_limit(self, remaining):
+        if remaining is None:
+            return self.page_size
+        return max(1, min(self.page_size, remaining))
+
+    def encode_cursor(self, key):
+        return encode_cursor(key, self.cursor_key_names, self.cursor_context)
+
+    def item_key(self, raw_item):
+        return {key_name: raw_item[key_name] for key_name in self.key_names if key_name in raw_item}
+
+    def __iter__(self):
+        executor = ThreadPoolExecutor(max_workers=1)
+
+        try:
+            count = 0
+            future = executor.submit(self.fetch_page, self.start_key, self.page_limit(self.max_items))
+
+            while future is not None:
+                response = future.result()
+
+                raw_items = response.get('Items') or []
+                last_key = response.get('LastEvaluatedKey')
+
+                if last_key and self.key_names is None:
+                    self.key_names = list(last_key.keys())
+
+                # read ahead while the caller consumes this page
+                remaining = None if self.max_items is None else self.max_items - count - len(raw_items)
+                future = None
+                if last_key and (remaining is None or remaining > 0):
+                    future = executor.submit(self.fetch_page, last_key, self.page_limit(remaining))
+
+                if not raw_items:
+                    self.cursor = self.encode_cursor(last_key)
+
+                for index, raw_item in enumerate(raw_items):
+                    if self.max_items is not None and count >= self.max_items:
+                        return
+
+                    count += 1
+
+                    if index == len(raw_items) - 1:
+                        self.cursor = self.encode_cursor(last_key)
+                    else:
+                        if self.key_names is None:
+                            self.key_names = default_key_names(
+                                self.params['ExpressionAttributeNames']['#pkey'], self.params.get('IndexName')
+                            )
+                        self.cursor = self.encode_cursor(self.item_key(raw_item))
+
+                    yield item_from_ddb(raw_item)
+        finally:
+            executor.shutdown(wait=False)
+
+def query_iter(
+    table_name, pkey, pkey_name='pkey', index_name=None,
+    select='ALL_ATTRIBUTES',
+    consistent=False, forward=True,
+    key_condition_expression=None,
+    projection_expression=None,
+    filter_expression=None,
+    expression_attribute_names=None,
+    expression_attribute_values=None,
+    cursor=None, max_items=None, page_size=100, key_names=None
+):
+    '''
+    Query a partition, streaming every matching item across as many pages as needed.
+
+    Takes the same arguments as query, plus:
+    max_items: stop after this many items (None for no cap)
+    page_size: the Limit for each underlying query call
+    key_names: the attributes making up the table/index key, used to build a cursor when
+        iteration stops part way through a page. Usually worked out automatically.
+
+    Returns a QueryIterator. Iterate it for the items, then read its cursor to resume later.
+    '''
+    params = build_query_params(
+        table_name, pkey, pkey_name=pkey_name, index_name=index_name,
+        select=select, consistent=consistent, forward=forward,
+        key_condition_expression=key_condition_expression,
+        projection_expression=projection_expression,
+        filter_expression=filter_expression,
+        expression_attribute_names=expression_attribute_names,
+        expression_attribute_values=expression_attribute_values
+    )
+
+    return QueryIterator(params, page_size=page_size, max_items=max_items, cursor=cursor, key_names=key_names)
 
 def put_item(
     table_name,
@@ -258,15 +676,31 @@ def put_item(
     expression_attribute_values=None,
     return_values='NONE',
     return_consumed_capacity='NONE',
-    return_item_collection_metrics='NONE'
+    return_item_collection_metrics='NONE',
+    pkey_name='pkey',
+    skey_name=None,
+    versioned=False,
+    expected_version=None,
+    version_attribute=C_VERSION_ATTRIBUTE
 ):
-    dynamodb_client = boto3.client('dynamodb')
+    '''
+    Put an item into dynamodb. pkey_name and skey_name are used to keep the item cache current.
+
+    With versioned, the put only succeeds if the stored item's version_attribute equals expected_version
+    (with expected_version None: if there is no stored item, or it has never been versioned),
+    and the item is written with the next version. Otherwise raises VersionConflictError.
+    '''
+    if versioned:
+        item = {**item, version_attribute: (expected_version or 0) + 1}
+        condition_expression, expression_attribute_names, expression_attribute_values = add_version_condition(
+            condition_expression, expression_attribute_names, expression_attribute_values,
+            version_attribute, expected_version
+        )
 
-    use_item = add_ddb_format(item)
+    # large attributes may be compressed or spilled to s3, see offload.py
+    use_item = add_ddb_format(offload_item(table_name, item, item.get(pkey_name)))
 
-    use_expression_attribute_values = {
-        key: add_ddb_format(value) for key, value in expression_attribute_values.items()
-    } if expression_attribute_values else None
+    use_expression_attribute_values = add_ddb_format(expression_attribute_values) if expression_attribute_values else None
 
     params = remove_none_attribs({
         'TableName': table_name,
@@ -279,12 +713,19 @@ def put_item(
         'ReturnItemCollectionMetrics': return_item_collection_metrics,
     })
 
-    response = dynamodb_client.put_item(**params)
+    try:
+        response = call_dynamodb('PutItem', params)
+    except ClientError as e:
+        if versioned and is_conditional_check_failed(e):
+            raise VersionConflictError(f'put_item: {table_name} {item.get(pkey_name)} is not at version {expected_version}') from e
+        raise
+    finally:
+        invalidate_cached_item(table_name, item.get(pkey_name), item.get(skey_name) if skey_name else None)
 
     if "Attributes" in response:
-        response["Attributes"] = remove_ddb_format(response["Attributes"])
+        response["Attributes"] = item_from_ddb(response["Attributes"])
 
-    print(f'put response: {response}')
+    logger.debug('put_item response', response=response)
 
     return response
 
@@ -302,15 +743,102 @@ def update_item(
     expression_attribute_values=None,
     return_values='ALL_NEW',
     return_consumed_capacity='NONE',
-    return_item_collection_metrics='NONE'
+    return_item_collection_metrics='NONE',
+    set_paths=None,
+    remove_paths=None,
+    versioned=False,
+    expected_version=None,
+    version_attribute=C_VERSION_ATTRIBUTE
 ):
-    dynamodb_client = boto3.client('dynamodb')
+    '''
+    Update an item in dynamodb.
+
+    set_value, add_value and remove_list work on top level attributes.
+    set_paths ({path: value}) and remove_paths ([path]) work on nested document paths, where a path
+    is a tuple of map keys and list indexes, e.g. ('lenses', 'summary', 'status').
+
+    With versioned, the update only succeeds if the item exists and its version_attribute equals
+    expected_version (None: it has never been versioned), and the version is bumped.
+    Otherwise raises VersionConflictError.
+    '''
+    # large attributes may be compressed or spilled to s3, see offload.py
+    if set_value:
+        set_value = offload_item(table_name, set_value, pkey)
+    set_paths = offload_paths(table_name, set_paths, pkey)
+
+    params = {
+        'TableName': table_name,
+        **build_update_params(
+            pkey, skey=skey, pkey_name=pkey_name, skey_name=skey_name,
+            set_value=set_value, add_value=add_value, remove_list=remove_list,
+            set_paths=set_paths, remove_paths=remove_paths,
+            condition_expression=condition_expression,
+            expression_attribute_names=expression_attribute_names,
+            expression_attribute_values=expression_attribute_values,
+            versioned=versioned, expected_version=expected_version, version_attribute=version_attribute
+        ),
+        **remove_none_attribs({
+            'ReturnValues': return_values,
+            'ReturnConsumedCapacity': return_consumed_capacity,
+            'ReturnItemCollectionMetrics': return_item_collection_metrics,
+        })
+    }
+
+    try:
+        response = call_dynamodb('UpdateItem', params)
+    except ClientError as e:
+        if versioned and is_conditional_check_failed(e):
+            raise VersionConflictError(f'update_item: {table_name} {pkey} is not at version {expected_version}') from e
+        raise
+    finally:
+        invalidate_cached_item(table_name, pkey, skey)
+
+    logger.debug('update_item response', response=response)
+
+    adjusted_response = remove_none_attribs({
+        'Attributes': item_from_ddb(response['Attributes']) if 'Attributes' in response else None,
+        **({
+            'ConsumedCapacity': response['ConsumedCapacity'],
+        } if 'ConsumedCapacity' in response else {}),
+        **({
+            'ItemCollectionMetrics': {
+                'ItemCollectionKey': remove_ddb_format(response['ItemCollectionMetrics']['ItemCollectionKey'], True),
+                'SizeEstimateRangeGB': response['ItemCollectionMetrics']['SizeEstimateRangeGB']
+            }
+        } if 'ItemCollectionMetrics' in response else {})
+    })
+
+    return adjusted_response
+
+def build_update_params(
+    pkey, skey=None, pkey_name='pkey', skey_name=None,
+    set_value=None, add_value=None, remove_list=None,
+    set_paths=None, remove_paths=None,
+    condition_expression=None,
+    expression_attribute_names=None,
+    expression_attribute_values=None,
+    versioned=False, expected_version=None, version_attribute=C_VERSION_ATTRIBUTE
+):
+    '''
+    Build the Key, UpdateExpression, ConditionExpression and expression attributes for an update.
+    Shared by update_item and Transaction.update.
+    '''
+    if versioned:
+        set_paths = {**(set_paths or {}), (version_attribute,): (expected_version or 0) + 1}
+        condition_expression, expression_attribute_names, expression_attribute_values = add_version_condition(
+            condition_expression, expression_attribute_names, expression_attribute_values,
+            version_attribute, expected_version, pkey_name=pkey_name
+        )
 
     key = calculate_key(pkey, skey, pkey_name, skey_name)
 
-    set_clause_list = [f'#{key_name} = :{key_name}' for key_name, _ in set_value.items()] if set_value else None
-    add_clause_list = [f'#{key_name} = :{key_name}' for key_name, _ in add_value.items()] if add_value else None
-    remove_clause_list = [f'#{key_name}' for key_name in remove_list] if remove_list else None
+    paths = DocumentPaths()
+
+    set_clause_list = [f'#{key_name} = :{key_name}' for key_name, _ in set_value.items()] if set_value else []
+    set_clause_list += [f'{paths.path(path)} = {paths.value(value)}' for path, value in (set_paths or {}).items()]
+    add_clause_list = [f'#{key_name} :{key_name}' for key_name, _ in add_value.items()] if add_value else None
+    remove_clause_list = [f'#{key_name}' for key_name in remove_list] if remove_list else []
+    remove_clause_list += [paths.path(path) for path in (remove_paths or [])]
 
     update_expression_clauses = [
         f'SET {",".join(set_clause_list)}' if set_clause_list else None,
@@ -322,6 +850,7 @@ def update_item(
 
     use_expression_names = {
         **(expression_attribute_names or {}),
+        **paths.names,
         ** {
             f'#{key_name}': key_name for key_name in (
                 list((set_value or {}).keys()) + 
@@ -338,39 +867,79 @@ def update_item(
                 **(set_value or {}),
                 **(add_value or {})
             }.items()
-        }
+        },
+        **paths.values
     })
 
-    params = remove_none_attribs({
-        'TableName': table_name,
+    return remove_none_attribs({
         'Key': key,
         'UpdateExpression': update_expression,
         'ConditionExpression': condition_expression,
-        'ExpressionAttributeNames': use_expression_names,
-        'ExpressionAttributeValues': use_expression_values,
-        'ReturnValues': return_values,
-        'ReturnConsumedCapacity': return_consumed_capacity,
-        'ReturnItemCollectionMetrics': return_item_collection_metrics,
+        'ExpressionAttributeNames': use_expression_names or None,
+        'ExpressionAttributeValues': use_expression_values or None,
     })
 
-    response = dynamodb_client.update_item(**params)
+class DocumentPaths:
+    '''
+    Collects ExpressionAttributeNames and ExpressionAttributeValues placeholders for document paths,
+    so that any attribute name (including reserved words and names with dots) can be used.
+    '''
+    def __init__(self, prefix='_p'):
+        self.prefix = prefix
+        self.names = {}
+        self.values = {}
+        self.placeholders = {}
 
-    print(f'update_item response: {response}')
+    def name(self, attribute_name):
+        placeholder = self.placeholders.get(attribute_name)
+        if placeholder is None:
+            placeholder = f'#{self.prefix}{len(self.placeholders)}'
+            self.placeholders[attribute_name] = placeholder
+            self.names[placeholder] = attribute_name
+        return placeholder
 
-    adjusted_response = remove_none_attribs({
-        'Attributes': remove_ddb_format(response['Attributes']) if 'Attributes' in response else None,
-        **({
-            'ConsumedCapacity': response['ConsumedCapacity'],
-        } if 'ConsumedCapacity' in response else {}),
-        **({
-            'ItemCollectionMetrics': {
-                'ItemCollectionKey': remove_ddb_format(response['ItemCollectionMetrics']['ItemCollectionKey'], True),
-                'SizeEstimateRangeGB': response['ItemCollectionMetrics']['SizeEstimateRangeGB']
-            }
-        } if 'ItemCollectionMetrics' in response else {})
-    })
+    def path(self, path):
+        if isinstance(path, str):
+            path = (path,)
 
-    return adjusted_response
+        expression = ''
+        for segment in path:
+            if isinstance(segment, int):
+                expression += f'[{segment}]'
+            else:
+                expression += ('.' if expression else '') + self.name(segment)
+        return expression
+
+    def value(self, value):
+        placeholder = f':{self.prefix}{len(self.values)}'
+        self.values[placeholder] = value
+        return placeholder
+
+def add_version_condition(
+    condition_expression, expression_attribute_names, expression_attribute_values,
+    version_attribute, expected_version, pkey_name=None
+):
+    '''
+    AND a version check onto a condition expression. With pkey_name, the item must also exist.
+    Returns the new (condition_expression, expression_attribute_names, expression_attribute_values).
+    '''
+    names = {**(expression_attribute_names or {}), '#_version': version_attribute}
+    values = dict(expression_attribute_values or {})
+
+    if expected_version is None:
+        version_condition = 'attribute_not_exists(#_version)'
+    else:
+        version_condition = '#_version = :_version'
+        values[':_version'] = expected_version
+
+    if pkey_name:
+        names['#_pkey'] = pkey_name
+        version_condition = f'attribute_exists(#_pkey) AND {version_condition}'
+
+    if condition_expression:
+        version_condition = f'({condition_expression}) AND {version_condition}'
+
+    return version_condition, names, values or None
 
 def delete_item(
     table_name,
@@ -385,8 +954,6 @@ def delete_item(
     return_consumed_capacity='NONE',
     return_item_collection_metrics='NONE'
 ):
-    dynamodb_client = boto3.client('dynamodb')
-
     key = calculate_key(pkey, skey, pkey_name, skey_name)
 
     params = remove_none_attribs({
@@ -394,18 +961,21 @@ def delete_item(
         'Key': key,
         'ConditionExpression': condition_expression,
         'ExpressionAttributeNames': expression_attribute_names,
-        'ExpressionAttributeValues': expression_attribute_values,
+        'ExpressionAttributeValues': add_ddb_format(expression_attribute_values) if expression_attribute_values else None,
         'ReturnValues': return_values,
         'ReturnConsumedCapacity': return_consumed_capacity,
         'ReturnItemCollectionMetrics': return_item_collection_metrics,
     })
 
-    response = dynamodb_client.delete_item(**params)
+    try:
+        response = call_dynamodb('DeleteItem', params)
+    finally:
+        invalidate_cached_item(table_name, pkey, skey)
 
-    print(f'delete_item response: {response}')
+    logger.debug('delete_item response', response=response)
 
     adjusted_response = {
-        'Attributes': remove_ddb_format(response['Attributes']) if 'Attributes' in response else None,
+        'Attributes': item_from_ddb(response['Attributes']) if 'Attributes' in response else None,
         **({
             'ConsumedCapacity': response['ConsumedCapacity'],
         } if 'ConsumedCapacity' in response else {}),
@@ -419,6 +989,624 @@ def delete_item(
 
     return adjusted_response
 
+class Transaction:
+    '''
+    Builds up to 100 put, update, delete and condition check operations, then runs them as a
+    single all-or-nothing transact_write_items call. Arguments mirror put_item, update_item and
+    delete_item, and values go through the same marshalling.
+
+        (Transaction()
+            .put(table_name, spelunk_item, condition_expression='attribute_not_exists(pkey)')
+            .put(table_name, alias_item)
+            .execute())
+
+    If any operation's condition fails the whole transaction is cancelled and execute raises
+    TransactionCanceledError, whose reasons say which operation failed and why.
+    '''
+    def __init__(self, client_request_token=None, return_consumed_capacity='NONE'):
+        self.client_request_token = client_request_token
+        self.return_consumed_capacity = return_consumed_capacity
+        self.operations = []
+        self.touched_keys = []
+
+    def add(self, operation, table_name, cache_key):
+        if len(self.operations) >= C_TRANSACTION_MAX_ITEMS:
+            raise ValueError(f'A transaction can have at most {C_TRANSACTION_MAX_ITEMS} operations')
+        self.operations.append(operation)
+        if cache_key is not None:
+            self.touched_keys.append((table_name, *cache_key))
+        return self
+
+    def put(
+        self, table_name, item,
+        condition_expression=None,
+        expression_attribute_names=None,
+        expression_attribute_values=None,
+        pkey_name='pkey',
+        skey_name=None,
+        versioned=False,
+        expected_version=None,
+        version_attribute=C_VERSION_ATTRIBUTE,
+        return_values_on_condition_check_failure='ALL_OLD'
+    ):
+        if versioned:
+            item = {**item, version_attribute: (expected_version or 0) + 1}
+            condition_expression, expression_attribute_names, expression_attribute_values = add_version_condition(
+                condition_expression, expression_attribute_names, expression_attribute_values,
+                version_attribute, expected_version
+            )
+
+        return self.add({
+            'Put': remove_none_attribs({
+                'TableName': table_name,
+                'Item': add_ddb_format(offload_item(table_name, item, item.get(pkey_name))),
+                'ConditionExpression': condition_expression,
+                'ExpressionAttributeNames': expression_attribute_names,
+                'ExpressionAttributeValues': add_ddb_format(expression_attribute_values) if expression_attribute_values else None,
+                'ReturnValuesOnConditionCheckFailure': return_values_on_condition_check_failure,
+            })
+        }, table_name, (item.get(pkey_name), item.get(skey_name) if skey_name else None))
+
+    def update(
+        self, table_name, pkey, skey=None, pkey_name='pkey', skey_name=None,
+        set_value=None, add_value=None, remove_list=None,
+        set_paths=None, remove_paths=None,
+        condition_expression=None,
+        expression_attribute_names=None,
+        expression_attribute_values=None,
+        versioned=False,
+        expected_version=None,
+        version_attribute=C_VERSION_ATTRIBUTE,
+        return_values_on_condition_check_failure='ALL_OLD'
+    ):
+        if set_value:
+            set_value = offload_item(table_name, set_value, pkey)
+        set_paths = offload_paths(table_name, set_paths, pkey)
+
+        return self.add({
+            'Update': {
+                'TableName': table_name,
+                **build_update_params(
+                    pkey, skey=skey, pkey_name=pkey_name, skey_name=skey_name,
+                    set_value=set_value, add_value=add_value, remove_list=remove_list,
+                    set_paths=set_paths, remove_paths=remove_paths,
+                    condition_expression=condition_expression,
+                    expression_attribute_names=expression_attribute_names,
+                    expression_attribute_values=expression_attribute_values,
+                    versioned=versioned, expected_version=expected_version, version_attribute=version_attribute
+                ),
+                'ReturnValuesOnConditionCheckFailure': return_values_on_condition_check_failure,
+            }
+        }, table_name, (pkey, skey))
+
+    def delete(
+        self, table_name, pkey, skey=None, pkey_name='pkey', skey_name=None,
+        condition_expression=None,
+        expression_attribute_names=None,
+        expression_attribute_values=None,
+        return_values_on_condition_check_failure='ALL_OLD'
+    ):
+        return self.add({
+            'Delete': remove_none_attribs({
+                'TableName': table_name,
+                'Key': calculate_key(pkey, skey, pkey_name, skey_name),
+                'ConditionExpression': condition_expression,
+                'ExpressionAttributeNames': expression_attribute_names,
+                'ExpressionAttributeValues': add_ddb_format(expression_attribute_values) if expression_attribute_values else None,
+                'ReturnValuesOnConditionCheckFailure': return_values_on_condition_check_failure,
+            })
+        }, table_name, (pkey, skey))
+
+    def condition_check(
+        self, table_name, pkey, condition_expression, skey=None, pkey_name='pkey', skey_name=None,
+        expression_attribute_names=None,
+        expression_attribute_values=None,
+        return_values_on_condition_check_failure='ALL_OLD'
+    ):
+        return self.add({
+            'ConditionCheck': remove_none_attribs({
+                'TableName': table_name,
+                'Key': calculate_key(pkey, skey, pkey_name, skey_name),
+                'ConditionExpression': condition_expression,
+                'ExpressionAttributeNames': expression_attribute_names,
+                'ExpressionAttributeValues': add_ddb_format(expression_attribute_values) if expression_attribute_values else None,
+                'ReturnValuesOnConditionCheckFailure': return_values_on_condition_check_failure,
+            })
+        }, table_name, None)
+
+    def execute(self):
+        '''
+        Run the transaction. Returns the (adjusted) response, or None if there was nothing to do.
+        '''
+        if not self.operations:
+            return None
+
+        params = remove_none_attribs({
+            'TransactItems': self.operations,
+            'ClientRequestToken': self.client_request_token,
+            'ReturnConsumedCapacity': self.return_consumed_capacity,
+        })
+
+        try:
+            response = call_dynamodb('TransactWriteItems', params)
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') == 'TransactionCanceledException':
+                reasons = decode_cancellation_reasons(e.response.get('CancellationReasons'))
+                raise TransactionCanceledError(f'Transaction cancelled: {[reason.get("Code") for reason in reasons]}', reasons) from e
+            raise
+        finally:
+            for table_name, pkey, skey in self.touched_keys:
+                invalidate_cached_item(table_name, pkey, skey)
+
+        logger.debug('transact_write_items response', response=response)
+
+        return remove_none_attribs({
+            'ConsumedCapacity': response.get('ConsumedCapacity')
+        })
+
+def decode_cancellation_reasons(reasons):
+    return [
+        remove_none_attribs({
+            'Code': reason.get('Code'),
+            'Message': reason.get('Message'),
+            'Item': item_from_ddb(reason['Item']) if reason.get('Item') else None
+        })
+        for reason in (reasons or [])
+    ]
+
+def transact_get_items(gets, return_consumed_capacity='NONE'):
+    '''
+    Read up to 100 items as one consistent snapshot, in a single transact_get_items call.
+
+    gets is a list of dicts of get_item style arguments:
+        {'table_name': ..., 'pkey': ..., 'skey': ..., 'pkey_name': ..., 'skey_name': ...,
+         'projection_expression': ..., 'expression_attribute_names': ...}
+    Returns the decoded items in the same order, with None for items that don't exist.
+    '''
+    if len(gets) > C_TRANSACTION_MAX_ITEMS:
+        raise ValueError(f'A transaction can have at most {C_TRANSACTION_MAX_ITEMS} operations')
+
+    if not gets:
+        return []
+
+    transact_items = [
+        {
+            'Get': remove_none_attribs({
+                'TableName': get['table_name'],
+                'Key': calculate_key(get['pkey'], get.get('skey'), get.get('pkey_name', 'pkey'), get.get('skey_name')),
+                'ProjectionExpression': get.get('projection_expression'),
+                'ExpressionAttributeNames': get.get('expression_attribute_names'),
+            })
+        }
+        for get in gets
+    ]
+
+    try:
+        response = call_dynamodb('TransactGetItems', {
+            'TransactItems': transact_items,
+            'ReturnConsumedCapacity': return_consumed_capacity
+        })
+    except ClientError as e:
+        if e.response.get('Error', {}).get('Code') == 'TransactionCanceledException':
+            reasons = decode_cancellation_reasons(e.response.get('CancellationReasons'))
+            raise TransactionCanceledError(f'Transaction cancelled: {[reason.get("Code") for reason in reasons]}', reasons) from e
+        raise
+
+    return [
+        item_from_ddb(entry['Item']) if entry.get('Item') else None
+        for entry in response.get('Responses', [])
+    ]
+
+def chunk_list(lst, size):
+    '''
+    Split a list into consecutive lists of at most size elements.
+    '''
+    return [lst[i:i + size] for i in range(0, len(lst), size)]
+
+def run_chunks(chunk_f, chunks, max_workers):
+    '''
+    Run chunk_f over each chunk, concurrently if there is more than one, and return the results in order.
+    '''
+    if len(chunks) <= 1:
+        return [chunk_f(chunk) for chunk in chunks]
+
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(chunks))) as executor:
+        return list(executor.map(chunk_f, chunks))
+
+def key_values(key_value, skey_name):
+    '''
+    Split a key as passed to the batch functions into (pkey, skey).
+    Keys are plain pkey values, or (pkey, skey) tuples when the table has a sort key.
+    '''
+    if skey_name is None:
+        return key_value, None
+    pkey, skey = key_value
+    return pkey, skey
+
+def dedupe_keys(keys, skey_name):
+    '''
+    Remove duplicate keys, keeping the first occurrence. DynamoDB rejects batches with duplicate keys.
+    '''
+    seen = set()
+    result = []
+    for key_value in keys:
+        marker = key_values(key_value, skey_name)
+        if marker not in seen:
+            seen.add(marker)
+            result.append(key_value)
+    return result
+
+def batch_get_items(
+    table_name, keys, pkey_name='pkey', skey_name=None,
+    consistent=False, projection_expression=None, expression_attribute_names=None,
+    max_workers=C_BATCH_MAX_WORKERS, max_attempts=C_BATCH_MAX_ATTEMPTS
+):
+    '''
+    Get any number of items from dynamodb.
+
+    keys is a list of pkey values, or of (pkey, skey) tuples if skey_name is set.
+    The keys are split into batch_get_item requests of 100 keys, which run concurrently.
+    UnprocessedKeys are retried with jittered backoff, up to max_attempts per request.
+
+    Returns the found items (in no particular order) and any keys that were still unprocessed
+    after all the retries, in the same format as they were passed in.
+    '''
+    call_site = ddb_call_site()
+
+    unique_keys = dedupe_keys(keys, skey_name)
+
+    def get_chunk(chunk):
+        request_items = {
+            table_name: remove_none_attribs({
+                'Keys': [calculate_key(*key_values(key_value, skey_name), pkey_name, skey_name) for key_value in chunk],
+                'ConsistentRead': consistent,
+                'ProjectionExpression': projection_expression,
+                'ExpressionAttributeNames': expression_attribute_names
+            })
+        }
+
+        items = []
+        attempt = 0
+        while True:
+            response = call_dynamodb('BatchGetItem', {'RequestItems': request_items}, call_site=call_site)
+
+            items.extend(response.get('Responses', {}).get(table_name, []))
+
+            request_items = response.get('UnprocessedKeys') or {}
+
+            # unprocessed keys mean the table is at capacity, treat them like a throttle
+            if request_items:
+                throttled(table_name, 'BatchGetItem')
+
+            attempt += 1
+            if not request_items or attempt >= max_attempts:
+                break
+
+            backoff_sleep(attempt)
+
+        unprocessed = (request_items.get(table_name) or {}).get('Keys') or []
+
+        return items, unprocessed
+
+    results = run_chunks(get_chunk, chunk_list(unique_keys, C_BATCH_GET_MAX_KEYS), max_workers)
+
+    items = [item_from_ddb(item) for chunk_items, _ in results for item in chunk_items]
+
+    unprocessed_keys = []
+    for _, chunk_unprocessed in results:
+        for key in chunk_unprocessed:
+            key = remove_ddb_format(key)
+            unprocessed_keys.append(key[pkey_name] if skey_name is None else (key[pkey_name], key[skey_name]))
+
+    if unprocessed_keys:
+        logger.warning('batch_get_items keys unprocessed', table_name=table_name, count=len(unprocessed_keys), attempts=max_attempts)
+
+    return {
+        'Items': items,
+        'UnprocessedKeys': unprocessed_keys
+    }
+
+def batch_write_items(
+    table_name, put_items=None, delete_keys=None, pkey_name='pkey', skey_name=None,
+    max_workers=C_BATCH_MAX_WORKERS, max_attempts=C_BATCH_MAX_ATTEMPTS
+):
+    '''
+    Put and delete any number of items in dynamodb.
+
+    put_items is a list of items, delete_keys is a list of pkey values, or of (pkey, skey) tuples
+    if skey_name is set. The writes are split into batch_write_item requests of 25, which run concurrently.
+    UnprocessedItems are retried with jittered backoff, up to max_attempts per request.
+
+    Note that batch writes cannot be conditional, and a key must not appear twice in one call.
+
+    Returns the puts and deletes that were still unprocessed after all the retries.
+    '''
+    call_site = ddb_call_site()
+
+    write_requests = [
+        {'PutRequest': {'Item': add_ddb_format(offload_item(table_name, item, item.get(pkey_name)))}}
+        for item in (put_items or [])
+    ] + [
+        {'DeleteRequest': {'Key': calculate_key(*key_values(key_value, skey_name), pkey_name, skey_name)}}
+        for key_value in dedupe_keys(delete_keys or [], skey_name)
+    ]
+
+    def write_chunk(chunk):
+        request_items = {table_name: chunk}
+
+        attempt = 0
+        while True:
+            response = call_dynamodb('BatchWriteItem', {'RequestItems': request_items}, call_site=call_site)
+
+            request_items = response.get('UnprocessedItems') or {}
+
+            # unprocessed items mean the table is at capacity, treat them like a throttle
+            if request_items:
+                throttled(table_name, 'BatchWriteItem')
+
+            attempt += 1
+            if not request_items or attempt >= max_attempts:
+                break
+
+            backoff_sleep(attempt)
+
+        return request_items.get(table_name) or []
+
+    try:
+        results = run_chunks(write_chunk, chunk_list(write_requests, C_BATCH_WRITE_MAX_ITEMS), max_workers)
+    finally:
+        for item in (put_items or []):
+            invalidate_cached_item(table_name, item.get(pkey_name), item.get(skey_name) if skey_name else None)
+        for key_value in (delete_keys or []):
+            invalidate_cached_item(table_name, *key_values(key_value, skey_name))
+
+    unprocessed_puts = []
+    unprocessed_deletes = []
+    for chunk_unprocessed in results:
+        for write_request in chunk_unprocessed:
+            if 'PutRequest' in write_request:
+                unprocessed_puts.append(remove_ddb_format(write_request['PutRequest']['Item']))
+            else:
+                key = remove_ddb_format(write_request['DeleteRequest']['Key'])
+                unprocessed_deletes.append(key[pkey_name] if skey_name is None else (key[pkey_name], key[skey_name]))
+
+    if unprocessed_puts or unprocessed_deletes:
+        logger.warning('batch_write_items writes unprocessed', table_name=table_name, count=len(unprocessed_puts) + len(unprocessed_deletes), attempts=max_attempts)
+
+    return {
+        'UnprocessedPutItems': unprocessed_puts,
+        'UnprocessedDeleteKeys': unprocessed_deletes
+    }
+
+def parallel_scan(
+    table_name, total_segments=C_SCAN_DEFAULT_SEGMENTS, index_name=None,
+    consistent=False,
+    projection_expression=None,
+    filter_expression=None,
+    expression_attribute_names=None,
+    expression_attribute_values=None,
+    page_size=None,
+    max_capacity_per_second=None
+):
+    '''
+    Scan a whole table (or index), splitting it into total_segments Segment/TotalSegments
+    workers that run concurrently on a thread pool.
+
+    Items are decoded and yielded as soon as any worker has them, so ordering is arbitrary.
+    Filter and projection expressions work as in query.
+
+    max_capacity_per_second caps the read capacity units the scan may consume per second,
+    across all workers, so that bulk jobs don't throttle live traffic. Workers wait before
+    each page until the budget is no longer in debt.
+
+    Closing the generator early stops the workers after their current page.
+    '''
+    call_site = ddb_call_site()
+
+    budget = TokenBucket(max_capacity_per_second) if max_capacity_per_second else None
+
+    params = remove_none_attribs({
+        'TableName': table_name,
+        'IndexName': index_name,
+        'ConsistentRead': consistent,
+        'ProjectionExpression': projection_expression,
+        'FilterExpression': filter_expression,
+        'ExpressionAttributeNames': expression_attribute_names,
+        'ExpressionAttributeValues': add_ddb_format(expression_attribute_values) if expression_attribute_values else None,
+        'Limit': page_size,
+        'TotalSegments': total_segments,
+        'ReturnConsumedCapacity': 'TOTAL' if budget else None
+    })
+
+    # workers hand back whole pages; the queue is bounded so a slow consumer applies backpressure
+    results = queue.Queue(maxsize=total_segments * 2)
+    stop = threading.Event()
+
+    def put_result(result):
+        while not stop.is_set():
+            try:
+                results.put(result, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def scan_segment(segment):
+        try:
+            start_key = None
+            while not stop.is_set():
+                if budget:
+                    budget.wait()
+
+                response = call_dynamodb('Scan', {
+                    **params,
+                    **remove_none_attribs({
+                        'Segment': segment,
+                        'ExclusiveStartKey': start_key
+                    })
+                }, call_site=call_site)
+
+                if budget:
+                    budget.consume((response.get('ConsumedCapacity') or {}).get('CapacityUnits') or 0)
+
+                if response.get('Items'):
+                    put_result(('items', response['Items']))
+
+                start_key = response.get('LastEvaluatedKey')
+                if not start_key:
+                    break
+        except Exception as e:
+            put_result(('error', e))
+        finally:
+            put_result(('done', segment))
+
+    executor = ThreadPoolExecutor(max_workers=total_segments)
+
+    try:
+        for segment in range(total_segments):
+            executor.submit(scan_segment, segment)
+
+        remaining = total_segments
+        while remaining:
+            kind, payload = results.get()
+
+            if kind == 'done':
+                remaining -= 1
+            elif kind == 'error':
+                raise payload
+            else:
+                for raw_item in payload:
+                    yield item_from_ddb(raw_item)
+    finally:
+        stop.set()
+        executor.shutdown(wait=False)
+
+class Descending:
+    '''
+    Wraps a sort value so that heapq, a min heap, hands out the largest first.
+    '''
+    def __init__(self, value):
+        self.value = value
+
+    def __lt__(self, other):
+        return other.value < self.value
+
+    def __eq__(self, other):
+        return self.value == other.value
+
+def query_many(
+    table_name, pkeys, pkey_name='pkey', index_name=None,
+    select='ALL_ATTRIBUTES',
+    consistent=False, forward=True,
+    key_condition_expression=None,
+    projection_expression=None,
+    filter_expression=None,
+    expression_attribute_names=None,
+    expression_attribute_values=None,
+    sort_key=None, max_items=None, page_size=100, max_workers=C_QUERY_MANY_MAX_WORKERS
+):
+    '''
+    Query many partitions at once, streaming the merged results.
+
+    Takes the same arguments as query_iter, with pkeys (a list of partition key values) instead
+    of pkey. Pages are fetched on a pool of max_workers threads, every partition reading one
+    page ahead, so the time taken grows with the number of pages per worker rather than
+    with the number of partitions.
+
+    sort_key: an attribute every partition is ordered by (the index's sort key, e.g. l2_skey).
+        Items are then handed out in sort_key order across all partitions (descending if not
+        forward), by a k-way merge. Without it, items are handed out as pages arrive.
+    max_items: stop after this many items in total (None for no cap).
+    '''
+    call_site = ddb_call_site()
+
+    partition_params = [
+        build_query_params(
+            table_name, pkey, pkey_name=pkey_name, index_name=index_name,
+            select=select, consistent=consistent, forward=forward,
+            key_condition_expression=key_condition_expression,
+            projection_expression=projection_expression,
+            filter_expression=filter_expression,
+            expression_attribute_names=expression_attribute_names,
+            expression_attribute_values=expression_attribute_values
+        )
+        for pkey in dict.fromkeys(pkeys)
+    ]
+
+    if not partition_params:
+        return
+
+    count = 0
+
+    def fetch_page(index, start_key, limit):
+        response = call_dynamodb('Query', {
+            **partition_params[index],
+            **remove_none_attribs({
+                'Limit': limit,
+                'ExclusiveStartKey': start_key
+            })
+        }, call_site=call_site)
+        return index, response
+
+    def submit(index, start_key=None):
+        limit = page_size if max_items is None else max(1, min(page_size, max_items - count))
+        return executor.submit(fetch_page, index, start_key, limit)
+
+    executor = ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(partition_params))))
+
+    try:
+        if sort_key is None:
+            pending = {submit(index) for index in range(len(partition_params))}
+
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+
+                for future in done:
+                    index, response = future.result()
+
+                    last_key = response.get('LastEvaluatedKey')
+                    if last_key and (max_items is None or count < max_items):
+                        pending.add(submit(index, last_key))
+
+                    for raw_item in response.get('Items') or []:
+                        if max_items is not None and count >= max_items:
+                            return
+                        count += 1
+                        yield item_from_ddb(raw_item)
+            return
+
+        # k-way merge: the heap holds the next item of each partition that has one left
+        next_pages = {index: submit(index) for index in range(len(partition_params))}
+        buffers = {}
+        heap = []
+
+        def push_next(index):
+            # take the partition's next item, waiting for its next page if need be
+            while not buffers.get(index) and index in next_pages:
+                _, response = next_pages.pop(index).result()
+
+                last_key = response.get('LastEvaluatedKey')
+                if last_key:
+                    next_pages[index] = submit(index, last_key)
+
+                buffers[index] = deque(response.get('Items') or [])
+
+            if not buffers.get(index):
+                return
+
+            raw_item = buffers[index].popleft()
+            if sort_key not in raw_item:
+                raise ValueError(f'query_many: item without sort key {sort_key} in partition {index}')
+
+            sort_value = decode_value(raw_item[sort_key])
+            heapq.heappush(heap, (sort_value if forward else Descending(sort_value), index, raw_item))
 
+        for index in range(len(partition_params)):
+            push_next(index)
 
-                
+        while heap and (max_items is None or count < max_items):
+            _, index, raw_item = heapq.heappop(heap)
+            count += 1
+            yield item_from_ddb(raw_item)
+            push_next(index)
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
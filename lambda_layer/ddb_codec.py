@@ -0,0 +1,227 @@
+'''
+This file converts between plain python values and dynamodb's typed attribute format.
+
+It is table driven and non-recursive: each value's type is looked up once in a dispatch
+table, and nested maps and lists are walked with an explicit stack, so deep or wide
+records (like spelunk lenses) don't pay for a python call per level.
+
+python -> dynamodb
+    str -> S, bool -> BOOL, int/float/Decimal -> N, bytes/bytearray -> B, None -> NULL,
+    dict -> M, list/tuple/set -> L
+    (sets are stored as lists, as they always have been, so records read back as plain json)
+
+dynamodb -> python
+    N is an int when it is integral, otherwise a float, or a Decimal if use_decimal is set
+    (dynamodb keeps 38 digits of precision, floats keep about 15).
+    SS/NS/BS (only written by other tools) are sets, B is bytes.
+'''
+from decimal import Decimal
+import math
+
+C_KIND_S = 'S'
+C_KIND_N = 'N'
+C_KIND_B = 'B'
+C_KIND_BOOL = 'BOOL'
+C_KIND_NULL = 'NULL'
+C_KIND_M = 'M'
+C_KIND_L = 'L'
+
+# exact type -> kind. Subclasses are resolved once by isinstance and then cached here.
+ENCODE_KINDS = {
+    str: C_KIND_S,
+    bool: C_KIND_BOOL,
+    int: C_KIND_N,
+    float: C_KIND_N,
+    Decimal: C_KIND_N,
+    bytes: C_KIND_B,
+    bytearray: C_KIND_B,
+    type(None): C_KIND_NULL,
+    dict: C_KIND_M,
+    list: C_KIND_L,
+    tuple: C_KIND_L,
+    set: C_KIND_L,
+    frozenset: C_KIND_L,
+}
+
+# checked in order, bool must come before int
+ENCODE_FALLBACKS = [
+    (bool, C_KIND_BOOL),
+    (str, C_KIND_S),
+    ((int, float, Decimal), C_KIND_N),
+    ((bytes, bytearray), C_KIND_B),
+    (dict, C_KIND_M),
+    ((list, tuple, set, frozenset), C_KIND_L),
+]
+
+def encode_kind(value):
+    value_type = type(value)
+    kind = ENCODE_KINDS.get(value_type)
+    if kind is None:
+        for base_types, base_kind in ENCODE_FALLBACKS:
+            if isinstance(value, base_types):
+                kind = base_kind
+                break
+        else:
+            raise ValueError(f'Unsupported type in obj: {value_type}')
+        ENCODE_KINDS[value_type] = kind
+    return kind
+
+def encode_number(value):
+    if type(value) is float and not math.isfinite(value):
+        raise ValueError(f'Cannot store {value} in dynamodb')
+    return str(value)
+
+def encode_value(value):
+    '''
+    Encode a single python value into a typed dynamodb attribute value.
+    '''
+    out = {}
+    encode_stack([(out, None, value)])
+    return out[None]
+
+def encode_item(item):
+    '''
+    Encode a dict of python values (an item, key or expression values) into dynamodb format.
+    '''
+    out = {}
+    stack = [(out, key, value) for key, value in item.items()]
+    encode_stack(stack)
+    return out
+
+def encode_stack(stack):
+    kinds = ENCODE_KINDS
+    pop = stack.pop
+    push = stack.append
+
+    while stack:
+        target, key, value = pop()
+
+        kind = kinds.get(type(value)) or encode_kind(value)
+
+        if kind is C_KIND_M:
+            children = {}
+            target[key] = {'M': children}
+            items = value.items()
+        elif kind is C_KIND_L:
+            children = [None] * len(value)
+            target[key] = {'L': children}
+            items = enumerate(value)
+        else:
+            target[key] = encode_scalar(kind, value)
+            continue
+
+        # scalars are the common case, so they are converted in place rather than pushed
+        for child_key, child_value in items:
+            value_type = type(child_value)
+            if value_type is str:
+                children[child_key] = {'S': child_value}
+            elif value_type is int:
+                children[child_key] = {'N': str(child_value)}
+            else:
+                child_kind = kinds.get(value_type) or encode_kind(child_value)
+                if child_kind is C_KIND_M or child_kind is C_KIND_L:
+                    push((children, child_key, child_value))
+                else:
+                    children[child_key] = encode_scalar(child_kind, child_value)
+
+def encode_scalar(kind, value):
+    if kind is C_KIND_S:
+        return {'S': value}
+    elif kind is C_KIND_N:
+        return {'N': encode_number(value)}
+    elif kind is C_KIND_BOOL:
+        return {'BOOL': value}
+    elif kind is C_KIND_NULL:
+        return {'NULL': True}
+    else:
+        return {'B': bytes(value)}
+
+def decode_number(strval, use_decimal=False):
+    try:
+        return int(strval)
+    except ValueError:
+        pass
+
+    # integral values can still come in exponent form (1E+2) or with a fraction of zero (100.0)
+    number = Decimal(strval)
+    if number == number.to_integral_value():
+        return int(number)
+    if use_decimal:
+        return number
+    return float(strval)
+
+def decode_value(value, use_decimal=False):
+    '''
+    Decode a single typed dynamodb attribute value into a python value.
+    '''
+    if not isinstance(value, dict):
+        raise ValueError(f'Expected ddb_obj to be a metadata dict, got {type(value)}')
+    out = {}
+    decode_stack([(out, None, value)], use_decimal)
+    return out[None]
+
+def decode_item(item, use_decimal=False):
+    '''
+    Decode a dict of typed dynamodb attribute values into plain python values.
+    '''
+    out = {}
+    decode_stack([(out, key, value) for key, value in item.items()], use_decimal)
+    return out
+
+def decode_stack(stack, use_decimal):
+    pop = stack.pop
+    push = stack.append
+
+    while stack:
+        target, key, value = pop()
+
+        if len(value) != 1:
+            raise ValueError(f'Bad format for metadata: {value}')
+
+        (kind, inner), = value.items()
+
+        if kind == 'M':
+            children = {}
+            target[key] = children
+            items = inner.items()
+        elif kind == 'L':
+            children = [None] * len(inner)
+            target[key] = children
+            items = enumerate(inner)
+        else:
+            target[key] = decode_scalar(kind, inner, use_decimal)
+            continue
+
+        # scalars are the common case, so they are converted in place rather than pushed
+        for child_key, child_value in items:
+            if len(child_value) != 1:
+                raise ValueError(f'Bad format for metadata: {child_value}')
+
+            (child_kind, child_inner), = child_value.items()
+
+            if child_kind == 'S':
+                children[child_key] = child_inner
+            elif child_kind == 'M' or child_kind == 'L':
+                push((children, child_key, child_value))
+            else:
+                children[child_key] = decode_scalar(child_kind, child_inner, use_decimal)
+
+def decode_scalar(kind, inner, use_decimal):
+    if kind == 'S':
+        return inner
+    elif kind == 'N':
+        return decode_number(inner, use_decimal)
+    elif kind == 'BOOL':
+        return inner
+    elif kind == 'NULL':
+        return None
+    elif kind == 'B':
+        return inner
+    elif kind == 'SS':
+        return set(inner)
+    elif kind == 'NS':
+        return {decode_number(x, use_decimal) for x in inner}
+    elif kind == 'BS':
+        return set(inner)
+    else:
+        raise ValueError(f'Unknown key in ddb metadata: {kind}')
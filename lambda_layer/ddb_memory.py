@@ -0,0 +1,1522 @@
+'''
+This file is an in-memory stand in for the low level dynamodb client, so the ddb layer
+(and everything built on it, like spelunk.py and plugin.py) can run without AWS, for
+unit tests and offline throughput benchmarks.
+
+It takes and returns the same typed attribute values as the boto3 client, and supports:
+    get_item, put_item, update_item, delete_item, query, scan, batch_get_item,
+    batch_write_item, transact_write_items, transact_get_items, create_table, delete_table
+    - hash/range keys, and global secondary indexes (sparse, ALL projection)
+    - key condition, filter, condition, update and projection expressions
+    - Limit, ExclusiveStartKey/LastEvaluatedKey and the 1MB page size, ScanIndexForward,
+      Select COUNT, parallel scan segments
+    - conditional failures, transaction cancellations and validation errors, raised as
+      botocore ClientErrors with the same codes as dynamodb
+    - approximate consumed capacity, so the metrics look like the real thing
+
+Tables are created on first use with the schema of the deployed table (see deploy_shared.py):
+hash key pkey, and indexes lookup1 to lookup4 keyed on lN_pkey and lN_skey, all strings.
+
+Use it by setting the ddb_backend env var to 'memory', or with clients.use_memory_dynamodb().
+
+Latency and throttling can be injected, to make benchmarks behave like the network:
+    ddb_memory_latency_ms: fixed latency added to every call (default 0)
+    ddb_memory_latency_jitter_ms: mean of an exponentially distributed extra latency, which
+        gives the long tail real calls have (default 0)
+    ddb_memory_throttle_rate: fraction of calls that fail with ProvisionedThroughputExceededException (default 0)
+'''
+from botocore.exceptions import ClientError
+from ddb_codec import encode_value, decode_item
+from bisect import bisect_left, bisect_right, insort
+from decimal import Decimal
+import copy
+import functools
+import math
+import operator
+import os
+import random
+import re
+import threading
+import time
+import zlib
+
+C_DEFAULT_HASH_KEY = 'pkey'
+C_DEFAULT_INDEXES = {f'lookup{n}': (f'l{n}_pkey', f'l{n}_skey') for n in range(1, 5)}
+
+C_MAX_ITEM_BYTES = 400 * 1024
+C_MAX_PAGE_BYTES = 1024 * 1024
+C_READ_UNIT_BYTES = 4096
+C_WRITE_UNIT_BYTES = 1024
+C_BATCH_GET_MAX_KEYS = 100
+C_BATCH_WRITE_MAX_ITEMS = 25
+C_TRANSACTION_MAX_ITEMS = 100
+
+C_INVALID_UPDATE_PATH = 'The document path provided in the update expression is invalid for update'
+C_INCORRECT_OPERAND = 'An operand in the update expression has an incorrect data type'
+C_KEY_MISMATCH = 'The provided key element does not match the schema'
+
+C_SCALAR_TYPES = ('S', 'N', 'B')
+
+C_COMPARATORS = {
+    '=': operator.eq,
+    '<>': operator.ne,
+    '<': operator.lt,
+    '<=': operator.le,
+    '>': operator.gt,
+    '>=': operator.ge,
+}
+
+C_CONDITION_FUNCTIONS = {'attribute_exists', 'attribute_not_exists', 'attribute_type', 'begins_with', 'contains'}
+
+C_UPDATE_CLAUSES = ('SET', 'REMOVE', 'ADD', 'DELETE')
+
+C_EXPRESSION_PARAMS = ('KeyConditionExpression', 'FilterExpression', 'ConditionExpression', 'UpdateExpression', 'ProjectionExpression')
+
+# an attribute or document path that isn't in the item
+MISSING = object()
+
+class ValidationError(Exception):
+    '''
+    Raised inside the engine, and turned into a ValidationException ClientError.
+    '''
+    pass
+
+class ConditionFailed(Exception):
+    '''
+    Raised inside the engine when a write's condition is false. item is the stored item, if any.
+    '''
+    def __init__(self, item):
+        super().__init__('The conditional request failed')
+        self.item = item
+
+def client_error(code, message, operation_name, **extra):
+    return ClientError({'Error': {'Code': code, 'Message': message}, **extra}, operation_name)
+
+###################################################################
+#
+# Values
+#
+# Items are held as plain python values (numbers as int or Decimal, so no precision is
+# lost), and converted from/to the typed format at the edges with ddb_codec.
+#
+###################################################################
+
+def value_type(value):
+    '''
+    The dynamodb type of a python value: S, N, B, BOOL, NULL, M, L, SS, NS or BS.
+    '''
+    if isinstance(value, bool):
+        return 'BOOL'
+    elif isinstance(value, str):
+        return 'S'
+    elif isinstance(value, (int, float, Decimal)):
+        return 'N'
+    elif isinstance(value, (bytes, bytearray)):
+        return 'B'
+    elif value is None:
+        return 'NULL'
+    elif isinstance(value, dict):
+        return 'M'
+    elif isinstance(value, (list, tuple)):
+        return 'L'
+    elif isinstance(value, (set, frozenset)):
+        for element in value:
+            return value_type(element) + 'S'
+        return 'SS'
+    else:
+        return None
+
+def value_size(value):
+    '''
+    Approximately how many bytes dynamodb counts for a value.
+    '''
+    if isinstance(value, bool) or value is None:
+        return 1
+    elif isinstance(value, str):
+        return len(value.encode('utf-8'))
+    elif isinstance(value, (int, float, Decimal)):
+        return len(str(value)) // 2 + 1
+    elif isinstance(value, (bytes, bytearray)):
+        return len(value)
+    elif isinstance(value, dict):
+        return 3 + sum(len(name.encode('utf-8')) + value_size(child) + 1 for name, child in value.items())
+    else:
+        return 3 + sum(value_size(child) + 1 for child in value)
+
+def item_size(item):
+    return sum(len(name.encode('utf-8')) + value_size(value) for name, value in item.items())
+
+def read_units(size, consistent):
+    return max(1, math.ceil(size / C_READ_UNIT_BYTES)) * (1.0 if consistent else 0.5)
+
+def write_units(size):
+    return float(max(1, math.ceil(size / C_WRITE_UNIT_BYTES)))
+
+def decode(typed_item):
+    return decode_item(typed_item or {}, use_decimal=True)
+
+def encode_attribute(value):
+    # ddb_codec writes python sets as lists, but sets held here came in as SS/NS/BS and
+    # must go back out that way
+    if isinstance(value, (set, frozenset)):
+        kind = value_type(value)
+        if kind == 'NS':
+            return {'NS': [str(element) for element in value]}
+        elif kind == 'BS':
+            return {'BS': [bytes(element) for element in value]}
+        return {'SS': list(value)}
+    elif isinstance(value, dict):
+        return {'M': {name: encode_attribute(child) for name, child in value.items()}}
+    elif isinstance(value, (list, tuple)):
+        return {'L': [encode_attribute(child) for child in value]}
+    return encode_value(value)
+
+def encode(item):
+    return {name: encode_attribute(value) for name, value in item.items()}
+
+def compare(op, left, right):
+    '''
+    Compare two values the way dynamodb does: values of different types are never equal,
+    and only strings, numbers and binary can be ordered.
+    '''
+    if left is MISSING or right is MISSING:
+        return op == '<>'
+
+    left_type = value_type(left)
+    right_type = value_type(right)
+
+    if op == '=':
+        return left_type == right_type and left == right
+    if op == '<>':
+        return left_type != right_type or left != right
+    if left_type != right_type or left_type not in C_SCALAR_TYPES:
+        return False
+    return C_COMPARATORS[op](left, right)
+
+def get_path(item, elements):
+    value = item
+    for element in elements:
+        if isinstance(element, int):
+            if not isinstance(value, list) or element >= len(value):
+                return MISSING
+        elif not isinstance(value, dict) or element not in value:
+            return MISSING
+        value = value[element]
+    return value
+
+def set_path(item, elements, value):
+    parent = get_path(item, elements[:-1])
+    last = elements[-1]
+
+    if isinstance(last, int):
+        if not isinstance(parent, list):
+            raise ValidationError(C_INVALID_UPDATE_PATH)
+        if last < len(parent):
+            parent[last] = value
+        else:
+            parent.append(value)
+    else:
+        if not isinstance(parent, dict):
+            raise ValidationError(C_INVALID_UPDATE_PATH)
+        parent[last] = value
+
+def remove_path(item, elements):
+    parent = get_path(item, elements[:-1])
+    last = elements[-1]
+
+    if isinstance(last, int):
+        if isinstance(parent, list) and last < len(parent):
+            del parent[last]
+    elif isinstance(parent, dict):
+        parent.pop(last, None)
+
+class ProjectedList(dict):
+    '''
+    A list being built up by a projection, as {index: value}. Projected list elements are
+    returned in order, without gaps.
+    '''
+    pass
+
+def finish_projection(value):
+    if isinstance(value, ProjectedList):
+        return [finish_projection(value[index]) for index in sorted(value)]
+    elif isinstance(value, dict):
+        return {name: finish_projection(child) for name, child in value.items()}
+    else:
+        return value
+
+###################################################################
+#
+# Expressions
+#
+# Expressions are parsed into tuples once, and the parsed forms are cached, as the layer
+# sends the same few expressions over and over. Attribute names and values are looked
+# up when the expression is evaluated.
+#
+###################################################################
+
+C_TOKEN_RE = re.compile(
+    r'\s*(?:(?P<name>#[A-Za-z0-9_]+)|(?P<value>:[A-Za-z0-9_]+)|(?P<number>\d+)'
+    r'|(?P<word>[A-Za-z_][A-Za-z0-9_]*)|(?P<op><>|<=|>=|[=<>(),.\[\]+\-]))'
+)
+
+def tokenize(text):
+    tokens = []
+    text = text.rstrip()
+    pos = 0
+
+    while pos < len(text):
+        match = C_TOKEN_RE.match(text, pos)
+        if not match:
+            raise ValidationError(f'Invalid expression: Syntax error; token: "{text[pos:pos + 10].strip()}", near: "{text}"')
+        tokens.append((match.lastgroup, match.group(match.lastgroup)))
+        pos = match.end()
+
+    return tokens
+
+class ExpressionParser:
+    '''
+    Recursive descent parser for dynamodb's expression language.
+    '''
+    def __init__(self, text):
+        self.text = text
+        self.tokens = tokenize(text)
+        self.pos = 0
+
+    def syntax_error(self):
+        kind, text = self.peek()
+        near = text if kind is not None else '<EOF>'
+        return ValidationError(f'Invalid expression: Syntax error; token: "{near}", near: "{self.text}"')
+
+    def peek(self, offset=0):
+        index = self.pos + offset
+        return self.tokens[index] if index < len(self.tokens) else (None, None)
+
+    def take(self):
+        token = self.peek()
+        if token[0] is None:
+            raise self.syntax_error()
+        self.pos += 1
+        return token
+
+    def at_word(self, *words):
+        kind, text = self.peek()
+        return kind == 'word' and text.upper() in words
+
+    def at_op(self, *ops):
+        kind, text = self.peek()
+        return kind == 'op' and text in ops
+
+    def at_call(self, *names):
+        kind, text = self.peek()
+        return kind == 'word' and text in names and self.peek(1) == ('op', '(')
+
+    def expect_op(self, op):
+        if not self.at_op(op):
+            raise self.syntax_error()
+        self.take()
+
+    def finish(self, node):
+        if self.pos < len(self.tokens):
+            raise self.syntax_error()
+        return node
+
+    # conditions: key conditions, filters and write conditions
+
+    def condition(self):
+        node = self.conjunction()
+        while self.at_word('OR'):
+            self.take()
+            node = ('or', node, self.conjunction())
+        return node
+
+    def conjunction(self):
+        node = self.negation()
+        while self.at_word('AND'):
+            self.take()
+            node = ('and', node, self.negation())
+        return node
+
+    def negation(self):
+        if self.at_word('NOT'):
+            self.take()
+            return ('not', self.negation())
+        return self.predicate()
+
+    def predicate(self):
+        if self.at_op('('):
+            self.take()
+            node = self.condition()
+            self.expect_op(')')
+            return node
+
+        if self.at_call(*C_CONDITION_FUNCTIONS):
+            _, name = self.take()
+            self.take()
+            return ('func', name, self.arguments())
+
+        left = self.operand()
+
+        if self.at_word('BETWEEN'):
+            self.take()
+            low = self.operand()
+            if not self.at_word('AND'):
+                raise self.syntax_error()
+            self.take()
+            return ('between', left, low, self.operand())
+
+        if self.at_word('IN'):
+            self.take()
+            self.expect_op('(')
+            return ('in', left, self.arguments())
+
+        kind, op = self.take()
+        if kind != 'op' or op not in C_COMPARATORS:
+            raise self.syntax_error()
+        return ('cmp', op, left, self.operand())
+
+    def arguments(self):
+        # the opening bracket has been taken
+        args = [self.operand()]
+        while self.at_op(','):
+            self.take()
+            args.append(self.operand())
+        self.expect_op(')')
+        return args
+
+    def operand(self):
+        kind, text = self.peek()
+        if kind == 'value':
+            self.take()
+            return ('value', text)
+        if self.at_call('size'):
+            self.take()
+            self.take()
+            path = self.path()
+            self.expect_op(')')
+            return ('size', path)
+        return self.path()
+
+    def path(self):
+        kind, text = self.take()
+        if kind not in ('name', 'word'):
+            raise self.syntax_error()
+
+        elements = [text]
+        while True:
+            if self.at_op('.'):
+                self.take()
+                kind, text = self.take()
+                if kind not in ('name', 'word'):
+                    raise self.syntax_error()
+                elements.append(text)
+            elif self.at_op('['):
+                self.take()
+                kind, text = self.take()
+                if kind != 'number':
+                    raise self.syntax_error()
+                elements.append(int(text))
+                self.expect_op(']')
+            else:
+                return ('path', tuple(elements))
+
+    # update expressions
+
+    def update(self):
+        actions = []
+        seen_clauses = set()
+
+        while self.pos < len(self.tokens):
+            if not self.at_word(*C_UPDATE_CLAUSES):
+                raise self.syntax_error()
+            _, clause = self.take()
+            clause = clause.upper()
+
+            if clause in seen_clauses:
+                raise ValidationError(f'Invalid UpdateExpression: The "{clause}" section can only be used once in an update expression;')
+            seen_clauses.add(clause)
+
+            while True:
+                path = self.path()
+
+                if clause == 'SET':
+                    self.expect_op('=')
+                    actions.append(('set', path, self.set_value()))
+                elif clause == 'REMOVE':
+                    actions.append(('remove', path))
+                else:
+                    kind, text = self.take()
+                    if kind != 'value':
+                        raise self.syntax_error()
+                    actions.append((clause.lower(), path, ('value', text)))
+
+                if not self.at_op(','):
+                    break
+                self.take()
+
+        if not actions:
+            raise self.syntax_error()
+
+        return actions
+
+    def set_value(self):
+        left = self.set_operand()
+        if self.at_op('+', '-'):
+            _, op = self.take()
+            return ('plus' if op == '+' else 'minus', left, self.set_operand())
+        return left
+
+    def set_operand(self):
+        if self.at_call('if_not_exists', 'list_append'):
+            _, name = self.take()
+            self.take()
+            first = self.path() if name == 'if_not_exists' else self.set_operand()
+            self.expect_op(',')
+            second = self.set_operand()
+            self.expect_op(')')
+            return (name, first, second)
+
+        kind, text = self.peek()
+        if kind == 'value':
+            self.take()
+            return ('value', text)
+        return self.path()
+
+    # projection expressions
+
+    def projection(self):
+        paths = [self.path()]
+        while self.at_op(','):
+            self.take()
+            paths.append(self.path())
+        return paths
+
+@functools.lru_cache(maxsize=1024)
+def expression_references(text):
+    '''
+    The attribute name and value placeholders an expression uses.
+    '''
+    tokens = tokenize(text)
+    return (
+        frozenset(token for kind, token in tokens if kind == 'name'),
+        frozenset(token for kind, token in tokens if kind == 'value')
+    )
+
+def check_expression_attributes(params):
+    '''
+    dynamodb rejects a request whose ExpressionAttributeNames or ExpressionAttributeValues
+    have entries that none of its expressions use.
+    '''
+    expressions = [params[name] for name in C_EXPRESSION_PARAMS if params.get(name)]
+    used_names = set()
+    used_values = set()
+    for expression in expressions:
+        names, values = expression_references(expression)
+        used_names |= names
+        used_values |= values
+
+    for param_name, used in (('ExpressionAttributeNames', used_names), ('ExpressionAttributeValues', used_values)):
+        supplied = params.get(param_name)
+        if supplied is None:
+            continue
+        if not expressions:
+            raise ValidationError(f'{param_name} can only be specified when using expressions')
+        if not supplied:
+            raise ValidationError(f'{param_name} must not be empty')
+        unused = sorted(set(supplied) - used)
+        if unused:
+            raise ValidationError(f'Value provided in {param_name} unused in expressions: keys: {{{", ".join(unused)}}}')
+
+@functools.lru_cache(maxsize=1024)
+def parse_condition(text):
+    parser = ExpressionParser(text)
+    return parser.finish(parser.condition())
+
+@functools.lru_cache(maxsize=1024)
+def parse_update(text):
+    parser = ExpressionParser(text)
+    return parser.finish(parser.update())
+
+@functools.lru_cache(maxsize=1024)
+def parse_projection(text):
+    parser = ExpressionParser(text)
+    return parser.finish(parser.projection())
+
+class Evaluator:
+    '''
+    Evaluates parsed expressions against items, with a request's ExpressionAttributeNames
+    and (decoded) ExpressionAttributeValues.
+    '''
+    def __init__(self, names=None, values=None):
+        self.names = names or {}
+        self.values = values or {}
+
+    def element(self, element):
+        if isinstance(element, str) and element.startswith('#'):
+            if element not in self.names:
+                raise ValidationError(f'An expression attribute name used in the document path is not defined; attribute name: {element}')
+            return self.names[element]
+        return element
+
+    def elements(self, path):
+        return [self.element(element) for element in path[1]]
+
+    def value(self, ref):
+        if ref not in self.values:
+            raise ValidationError(f'An expression attribute value used in expression is not defined; attribute value: {ref}')
+        return self.values[ref]
+
+    def operand(self, node, item):
+        kind = node[0]
+        if kind == 'path':
+            return get_path(item, self.elements(node))
+        elif kind == 'value':
+            return self.value(node[1])
+        else:
+            value = get_path(item, self.elements(node[1]))
+            if value_type(value) in ('S', 'B', 'M', 'L', 'SS', 'NS', 'BS'):
+                return len(value.encode('utf-8')) if isinstance(value, str) else len(value)
+            return MISSING
+
+    def test(self, node, item):
+        kind = node[0]
+        if kind == 'and':
+            return self.test(node[1], item) and self.test(node[2], item)
+        elif kind == 'or':
+            return self.test(node[1], item) or self.test(node[2], item)
+        elif kind == 'not':
+            return not self.test(node[1], item)
+        elif kind == 'cmp':
+            return compare(node[1], self.operand(node[2], item), self.operand(node[3], item))
+        elif kind == 'between':
+            value = self.operand(node[1], item)
+            return compare('>=', value, self.operand(node[2], item)) and compare('<=', value, self.operand(node[3], item))
+        elif kind == 'in':
+            value = self.operand(node[1], item)
+            return any(compare('=', value, self.operand(arg, item)) for arg in node[2])
+        else:
+            return self.function(node[1], node[2], item)
+
+    def function(self, name, args, item):
+        expected_args = 1 if name in ('attribute_exists', 'attribute_not_exists') else 2
+        if len(args) != expected_args or args[0][0] != 'path':
+            raise ValidationError(f'Invalid ConditionExpression: Incorrect number or type of operands for function: {name}')
+
+        value = self.operand(args[0], item)
+
+        if name == 'attribute_exists':
+            return value is not MISSING
+        elif name == 'attribute_not_exists':
+            return value is MISSING
+
+        other = self.operand(args[1], item)
+        if value is MISSING or other is MISSING:
+            return False
+
+        if name == 'attribute_type':
+            return value_type(value) == other
+        elif name == 'begins_with':
+            return isinstance(value, type(other)) and isinstance(value, (str, bytes)) and value.startswith(other)
+        else:
+            # contains
+            if isinstance(value, str):
+                return isinstance(other, str) and other in value
+            if isinstance(value, (set, frozenset, list)):
+                return any(compare('=', element, other) for element in value)
+            return False
+
+    def project(self, paths, item):
+        out = {}
+        for path in paths:
+            elements = self.elements(path)
+            value = get_path(item, elements)
+            if value is MISSING:
+                continue
+
+            target = out
+            for element, next_element in zip(elements, elements[1:]):
+                child = target.get(element)
+                if child is None:
+                    child = ProjectedList() if isinstance(next_element, int) else {}
+                    target[element] = child
+                target = child
+            target[elements[-1]] = copy.deepcopy(value)
+
+        return finish_projection(out)
+
+    def apply_update(self, actions, item, key_names):
+        '''
+        Apply parsed update actions to a copy of item. Values are worked out from the item
+        as it was before the update, as dynamodb does.
+        '''
+        new_item = copy.deepcopy(item)
+        removes = []
+
+        paths = [self.elements(action[1]) for action in actions]
+        check_overlapping_paths(paths)
+
+        for action, elements in zip(actions, paths):
+            kind = action[0]
+
+            if elements[0] in key_names:
+                raise ValidationError(f'One or more parameter values were invalid: Cannot update attribute {elements[0]}. This attribute is part of the key')
+
+            if kind == 'set':
+                set_path(new_item, elements, self.set_value(action[2], item))
+            elif kind == 'remove':
+                removes.append(elements)
+            elif kind == 'add':
+                self.add(new_item, elements, self.value(action[2][1]))
+            else:
+                self.delete(new_item, elements, self.value(action[2][1]))
+
+        # remove later list elements first, so earlier indexes still point at the right element
+        removes.sort(key=lambda elements: (repr(elements[:-1]), -elements[-1] if isinstance(elements[-1], int) else 0))
+        for elements in removes:
+            remove_path(new_item, elements)
+
+        return new_item
+
+    def set_value(self, node, item):
+        kind = node[0]
+        if kind == 'value':
+            return copy.deepcopy(self.value(node[1]))
+        elif kind == 'path':
+            value = get_path(item, self.elements(node))
+            if value is MISSING:
+                raise ValidationError('The provided expression refers to an attribute that does not exist in the item')
+            return copy.deepcopy(value)
+        elif kind == 'if_not_exists':
+            value = get_path(item, self.elements(node[1]))
+            return copy.deepcopy(value) if value is not MISSING else self.set_value(node[2], item)
+        elif kind == 'list_append':
+            first = self.set_value(node[1], item)
+            second = self.set_value(node[2], item)
+            if not isinstance(first, list) or not isinstance(second, list):
+                raise ValidationError(C_INCORRECT_OPERAND)
+            return first + second
+        else:
+            first = self.set_value(node[1], item)
+            second = self.set_value(node[2], item)
+            if value_type(first) != 'N' or value_type(second) != 'N':
+                raise ValidationError(C_INCORRECT_OPERAND)
+            return first + second if kind == 'plus' else first - second
+
+    def add(self, item, elements, value):
+        current = get_path(item, elements)
+        kind = value_type(value)
+
+        if kind == 'N':
+            if current is not MISSING and value_type(current) != 'N':
+                raise ValidationError(C_INCORRECT_OPERAND)
+            set_path(item, elements, value if current is MISSING else current + value)
+        elif kind in ('SS', 'NS', 'BS'):
+            if current is not MISSING and value_type(current) != kind:
+                raise ValidationError(C_INCORRECT_OPERAND)
+            set_path(item, elements, set(value) if current is MISSING else current | value)
+        else:
+            raise ValidationError(f'Invalid UpdateExpression: Incorrect operand type for operator or function; operator: ADD, operand type: {kind}')
+
+    def delete(self, item, elements, value):
+        kind = value_type(value)
+        if kind not in ('SS', 'NS', 'BS'):
+            raise ValidationError(f'Invalid UpdateExpression: Incorrect operand type for operator or function; operator: DELETE, operand type: {kind}')
+
+        current = get_path(item, elements)
+        if current is MISSING:
+            return
+        if value_type(current) != kind:
+            raise ValidationError(C_INCORRECT_OPERAND)
+
+        remaining = current - value
+        if remaining:
+            set_path(item, elements, remaining)
+        else:
+            remove_path(item, elements)
+
+def check_overlapping_paths(paths):
+    '''
+    An update can't touch a path and also anything inside it (or the same path twice).
+    '''
+    for index, path in enumerate(paths):
+        for other in paths[index + 1:]:
+            common = min(len(path), len(other))
+            if path[:common] == other[:common]:
+                raise ValidationError(
+                    'Invalid UpdateExpression: Two document paths overlap with each other; '
+                    f'must remove or rewrite one of these paths; path one: [{", ".join(map(str, path))}], '
+                    f'path two: [{", ".join(map(str, other))}]'
+                )
+
+def request_evaluator(params):
+    check_expression_attributes(params)
+    return Evaluator(params.get('ExpressionAttributeNames'), decode(params.get('ExpressionAttributeValues')))
+
+def flatten_and(node):
+    if node[0] == 'and':
+        return flatten_and(node[1]) + flatten_and(node[2])
+    return [node]
+
+###################################################################
+#
+# Tables
+#
+###################################################################
+
+class MemoryTable:
+    '''
+    One table: its items by key, plus sorted entries for each partition of the table
+    (when it has a range key) and of each index, so queries only look at one partition.
+    '''
+    def __init__(self, name, hash_key=C_DEFAULT_HASH_KEY, range_key=None, indexes=None, attribute_types=None):
+        self.name = name
+        self.hash_key = hash_key
+        self.range_key = range_key
+        self.key_names = [hash_key] + ([range_key] if range_key else [])
+        self.indexes = dict(C_DEFAULT_INDEXES if indexes is None else indexes)
+        self.attribute_types = attribute_types or {}
+
+        self.items = {}
+        # hash value -> sorted list of (range value, table key)
+        self.partitions = {}
+        self.index_partitions = {index_name: {} for index_name in self.indexes}
+
+    def attribute_type(self, name):
+        return self.attribute_types.get(name, 'S')
+
+    def key_schema(self, index_name):
+        if not index_name:
+            return self.hash_key, self.range_key
+        if index_name not in self.indexes:
+            raise ValidationError(f'The table does not have the specified index: {index_name}')
+        return self.indexes[index_name]
+
+    def table_key(self, item):
+        values = []
+        for name in self.key_names:
+            value = item.get(name, MISSING)
+            if value is MISSING:
+                raise ValidationError(f'One or more parameter values were invalid: Missing the key {name} in the item')
+            if value_type(value) != self.attribute_type(name):
+                raise ValidationError(
+                    f'One or more parameter values were invalid: Type mismatch for key {name} '
+                    f'expected: {self.attribute_type(name)} actual: {value_type(value)}'
+                )
+            if value == '' or value == b'':
+                raise ValidationError(f'One or more parameter values are not valid. The AttributeValue for a key attribute cannot contain an empty string value. Key: {name}')
+            values.append(value)
+        return tuple(values)
+
+    def decode_key(self, typed_key):
+        key = decode(typed_key)
+        if set(key) != set(self.key_names):
+            raise ValidationError(C_KEY_MISMATCH)
+        return self.table_key(key)
+
+    def key_item(self, table_key):
+        return dict(zip(self.key_names, table_key))
+
+    def validate_item(self, item):
+        self.table_key(item)
+
+        for index_name, (hash_name, range_name) in self.indexes.items():
+            for name in (hash_name, range_name):
+                if name and name in item and value_type(item[name]) != self.attribute_type(name):
+                    raise ValidationError(
+                        f'One or more parameter values were invalid: Type mismatch for Index Key {name} '
+                        f'Expected: {self.attribute_type(name)} Actual: {value_type(item[name])} IndexName: {index_name}'
+                    )
+
+        if item_size(item) > C_MAX_ITEM_BYTES:
+            raise ValidationError('Item size has exceeded the maximum allowed size')
+
+    def index_entry(self, item, index_name, table_key):
+        hash_name, range_name = self.indexes[index_name]
+        hash_value = item.get(hash_name, MISSING)
+        range_value = item.get(range_name, MISSING) if range_name else None
+
+        # indexes are sparse: items without the index's key attributes aren't in it
+        if hash_value is MISSING or range_value is MISSING:
+            return None
+        return hash_value, (range_value, table_key)
+
+    def add_entries(self, table_key, item):
+        if self.range_key:
+            insort(self.partitions.setdefault(table_key[0], []), (table_key[1], table_key))
+        for index_name, partitions in self.index_partitions.items():
+            entry = self.index_entry(item, index_name, table_key)
+            if entry is not None:
+                insort(partitions.setdefault(entry[0], []), entry[1])
+
+    def remove_entries(self, table_key, item):
+        if self.range_key:
+            remove_entry(self.partitions, table_key[0], (table_key[1], table_key))
+        for index_name, partitions in self.index_partitions.items():
+            entry = self.index_entry(item, index_name, table_key)
+            if entry is not None:
+                remove_entry(partitions, entry[0], entry[1])
+
+    def store(self, table_key, item):
+        '''
+        Write (or with item None, delete) the item at table_key, keeping the indexes current.
+        '''
+        old_item = self.items.get(table_key)
+        if old_item is not None:
+            self.remove_entries(table_key, old_item)
+
+        if item is None:
+            self.items.pop(table_key, None)
+        else:
+            self.items[table_key] = item
+            self.add_entries(table_key, item)
+
+    def partition_entries(self, index_name, hash_value):
+        '''
+        The sorted (range value, table key) entries of one partition of the table or an index.
+        '''
+        if index_name:
+            return self.index_partitions[index_name].get(hash_value, [])
+        if self.range_key:
+            return self.partitions.get(hash_value, [])
+        table_key = (hash_value,)
+        return [(None, table_key)] if table_key in self.items else []
+
+    def last_key(self, item, index_name):
+        '''
+        The LastEvaluatedKey for an item: the table key, plus the index key when reading an index.
+        '''
+        key = {name: item[name] for name in self.key_names}
+        if index_name:
+            for name in self.indexes[index_name]:
+                if name:
+                    key[name] = item[name]
+        return key
+
+    def start_entry(self, index_name, typed_start_key):
+        '''
+        The sort entry that an ExclusiveStartKey points at.
+        '''
+        start_key = decode(typed_start_key)
+        key_names = set(self.key_names) | {name for name in (self.key_schema(index_name) if index_name else ()) if name}
+        if set(start_key) != key_names:
+            raise ValidationError('The provided starting key is invalid: The provided key element does not match the schema')
+        table_key = self.table_key(start_key)
+        _, range_name = self.key_schema(index_name)
+        range_value = start_key.get(range_name) if range_name else None
+        return start_key.get(self.key_schema(index_name)[0]), (range_value, table_key)
+
+def remove_entry(partitions, hash_value, entry):
+    entries = partitions.get(hash_value)
+    if not entries:
+        return
+    index = bisect_left(entries, entry)
+    if index < len(entries) and entries[index] == entry:
+        del entries[index]
+    if not entries:
+        del partitions[hash_value]
+
+def scan_segment_of(table_key, total_segments):
+    return zlib.crc32(repr(table_key).encode('utf-8')) % total_segments
+
+###################################################################
+#
+# The client
+#
+###################################################################
+
+C_NO_CHANGE = object()
+
+def dynamodb_operation(operation_name):
+    '''
+    Decorator for client methods: injects latency and throttling, serializes access to the
+    tables, and turns validation errors into ClientErrors.
+    '''
+    def decorator(f):
+        @functools.wraps(f)
+        def wrapper(self, **params):
+            self.simulate_network(operation_name)
+            try:
+                with self.lock:
+                    return f(self, **params)
+            except ValidationError as e:
+                raise client_error('ValidationException', str(e), operation_name)
+            except KeyError as e:
+                raise client_error('ValidationException', f'Missing required parameter in input: {e}', operation_name)
+        return wrapper
+    return decorator
+
+class MemoryDynamoDBClient:
+    '''
+    An in-memory, thread safe implementation of the low level dynamodb client calls used by the ddb layer.
+
+    latency_ms, latency_jitter_ms and throttle_rate default to the ddb_memory_* env vars.
+    unprocessed_rate is the fraction of batch keys/items handed back as unprocessed, to
+    exercise retry paths. With auto_create_tables, tables spring into existence with the
+    deployed table's schema on first use, otherwise they must be made with create_table.
+    '''
+    def __init__(self, latency_ms=None, latency_jitter_ms=None, throttle_rate=None, unprocessed_rate=0.0, auto_create_tables=True):
+        self.latency_ms = float(latency_ms if latency_ms is not None else os.environ.get('ddb_memory_latency_ms', 0))
+        self.latency_jitter_ms = float(latency_jitter_ms if latency_jitter_ms is not None else os.environ.get('ddb_memory_latency_jitter_ms', 0))
+        self.throttle_rate = float(throttle_rate if throttle_rate is not None else os.environ.get('ddb_memory_throttle_rate', 0))
+        self.unprocessed_rate = unprocessed_rate
+        self.auto_create_tables = auto_create_tables
+
+        self.lock = threading.RLock()
+        self.tables = {}
+        self.transaction_tokens = {}
+
+    def simulate_network(self, operation_name):
+        delay_ms = self.latency_ms
+        if self.latency_jitter_ms:
+            delay_ms += random.expovariate(1.0 / self.latency_jitter_ms)
+        if delay_ms:
+            time.sleep(delay_ms / 1000.0)
+
+        if self.throttle_rate and random.random() < self.throttle_rate:
+            raise client_error(
+                'ProvisionedThroughputExceededException',
+                'The level of configured provisioned throughput for the table was exceeded.',
+                operation_name
+            )
+
+    def table(self, table_name):
+        table = self.tables.get(table_name)
+        if table is None:
+            if not self.auto_create_tables:
+                raise client_error('ResourceNotFoundException', 'Requested resource not found', 'DescribeTable')
+            table = self.tables[table_name] = MemoryTable(table_name)
+        return table
+
+    def reset(self):
+        '''
+        Drop every table.
+        '''
+        with self.lock:
+            self.tables.clear()
+            self.transaction_tokens.clear()
+
+    def consumed_capacity(self, params, table_name, units):
+        mode = params.get('ReturnConsumedCapacity') or 'NONE'
+        if mode == 'NONE':
+            return None
+        capacity = {'TableName': table_name, 'CapacityUnits': units}
+        if mode == 'INDEXES':
+            capacity['Table'] = {'CapacityUnits': units}
+        return capacity
+
+    def add_capacity(self, response, params, table_name, units):
+        capacity = self.consumed_capacity(params, table_name, units)
+        if capacity is not None:
+            response['ConsumedCapacity'] = capacity
+        return response
+
+    def item_write_units(self, table, old_item, new_item):
+        # each index holding the item is written too
+        size = max(item_size(old_item or {}), item_size(new_item or {}))
+        written_indexes = sum(
+            1 for index_name in table.indexes
+            if any(
+                item and table.index_entry(item, index_name, None) is not None
+                for item in (old_item, new_item)
+            )
+        )
+        return write_units(size) * (1 + written_indexes)
+
+    def conditional_check_failed(self, e, params, operation_name):
+        extra = {}
+        if params.get('ReturnValuesOnConditionCheckFailure') == 'ALL_OLD' and e.item is not None:
+            extra['Item'] = encode(e.item)
+        return client_error('ConditionalCheckFailedException', 'The conditional request failed', operation_name, **extra)
+
+    # writes are planned (conditions checked, new item worked out) before anything is stored,
+    # so a transaction can check every operation before applying any of them
+
+    def check_condition(self, params, evaluator, item):
+        expression = params.get('ConditionExpression')
+        if expression and not evaluator.test(parse_condition(expression), item if item is not None else {}):
+            raise ConditionFailed(item)
+
+    def plan_put(self, table, params):
+        item = decode(params['Item'])
+        table.validate_item(item)
+        table_key = table.table_key(item)
+        old_item = table.items.get(table_key)
+        self.check_condition(params, request_evaluator(params), old_item)
+        return table_key, old_item, item
+
+    def plan_update(self, table, params):
+        table_key = table.decode_key(params['Key'])
+        old_item = table.items.get(table_key)
+
+        evaluator = request_evaluator(params)
+        self.check_condition(params, evaluator, old_item)
+
+        base_item = old_item if old_item is not None else table.key_item(table_key)
+        if params.get('UpdateExpression'):
+            new_item = evaluator.apply_update(parse_update(params['UpdateExpression']), base_item, table.key_names)
+        else:
+            new_item = copy.deepcopy(base_item)
+
+        table.validate_item(new_item)
+        return table_key, old_item, new_item
+
+    def plan_delete(self, table, params):
+        table_key = table.decode_key(params['Key'])
+        old_item = table.items.get(table_key)
+        self.check_condition(params, request_evaluator(params), old_item)
+        return table_key, old_item, None
+
+    def plan_condition_check(self, table, params):
+        table_key = table.decode_key(params['Key'])
+        old_item = table.items.get(table_key)
+        self.check_condition(params, request_evaluator(params), old_item)
+        return table_key, old_item, C_NO_CHANGE
+
+    # single item calls
+
+    @dynamodb_operation('GetItem')
+    def get_item(self, **params):
+        table = self.table(params['TableName'])
+        check_expression_attributes(params)
+        item = table.items.get(table.decode_key(params['Key']))
+
+        response = {}
+        if item is not None:
+            if params.get('ProjectionExpression'):
+                evaluator = Evaluator(params.get('ExpressionAttributeNames'))
+                item = evaluator.project(parse_projection(params['ProjectionExpression']), item)
+            response['Item'] = encode(item)
+
+        units = read_units(item_size(item or {}), params.get('ConsistentRead'))
+        return self.add_capacity(response, params, table.name, units)
+
+    @dynamodb_operation('PutItem')
+    def put_item(self, **params):
+        table = self.table(params['TableName'])
+
+        try:
+            table_key, old_item, new_item = self.plan_put(table, params)
+        except ConditionFailed as e:
+            raise self.conditional_check_failed(e, params, 'PutItem')
+
+        table.store(table_key, new_item)
+
+        response = {}
+        if params.get('ReturnValues') == 'ALL_OLD' and old_item is not None:
+            response['Attributes'] = encode(old_item)
+        return self.add_capacity(response, params, table.name, self.item_write_units(table, old_item, new_item))
+
+    @dynamodb_operation('UpdateItem')
+    def update_item(self, **params):
+        table = self.table(params['TableName'])
+
+        try:
+            table_key, old_item, new_item = self.plan_update(table, params)
+        except ConditionFailed as e:
+            raise self.conditional_check_failed(e, params, 'UpdateItem')
+
+        table.store(table_key, new_item)
+
+        response = {}
+        return_values = params.get('ReturnValues') or 'NONE'
+        if return_values == 'ALL_OLD' and old_item is not None:
+            response['Attributes'] = encode(old_item)
+        elif return_values == 'ALL_NEW':
+            response['Attributes'] = encode(new_item)
+        elif return_values in ('UPDATED_OLD', 'UPDATED_NEW'):
+            evaluator = request_evaluator(params)
+            updated_names = {
+                evaluator.elements(action[1])[0]
+                for action in parse_update(params['UpdateExpression'])
+            } if params.get('UpdateExpression') else set()
+            source = (old_item or {}) if return_values == 'UPDATED_OLD' else new_item
+            attributes = {name: source[name] for name in updated_names if name in source}
+            if attributes:
+                response['Attributes'] = encode(attributes)
+
+        return self.add_capacity(response, params, table.name, self.item_write_units(table, old_item, new_item))
+
+    @dynamodb_operation('DeleteItem')
+    def delete_item(self, **params):
+        table = self.table(params['TableName'])
+
+        try:
+            table_key, old_item, _ = self.plan_delete(table, params)
+        except ConditionFailed as e:
+            raise self.conditional_check_failed(e, params, 'DeleteItem')
+
+        table.store(table_key, None)
+
+        response = {}
+        if params.get('ReturnValues') == 'ALL_OLD' and old_item is not None:
+            response['Attributes'] = encode(old_item)
+        return self.add_capacity(response, params, table.name, self.item_write_units(table, old_item, None))
+
+    # reads of many items
+
+    def read_page(self, table, index_name, items, evaluator, params):
+        '''
+        Apply Limit, the 1MB page size, the filter, projection and Select to the items a
+        query or scan reads, in order, and build the response.
+        '''
+        limit = params.get('Limit')
+        if limit is not None and limit < 1:
+            raise ValidationError('1 validation error detected: Value at \'limit\' failed to satisfy constraint: Member must have value greater than or equal to 1')
+
+        filter_node = parse_condition(params['FilterExpression']) if params.get('FilterExpression') else None
+        projection = parse_projection(params['ProjectionExpression']) if params.get('ProjectionExpression') else None
+
+        matched = []
+        scanned = 0
+        size = 0
+        last_item = None
+
+        for position, item in enumerate(items):
+            scanned += 1
+            size += item_size(item)
+
+            if filter_node is None or evaluator.test(filter_node, item):
+                matched.append(item)
+
+            if (limit is not None and scanned >= limit) or size >= C_MAX_PAGE_BYTES:
+                if position < len(items) - 1:
+                    last_item = item
+                break
+
+        response = {'Count': len(matched), 'ScannedCount': scanned}
+
+        if params.get('Select') != 'COUNT':
+            response['Items'] = [
+                encode(evaluator.project(projection, item) if projection else item)
+                for item in matched
+            ]
+
+        if last_item is not None:
+            response['LastEvaluatedKey'] = encode(table.last_key(last_item, index_name))
+
+        return self.add_capacity(response, params, table.name, read_units(size, params.get('ConsistentRead')))
+
+    def key_condition_hash(self, node, evaluator, hash_name):
+        '''
+        Check a key condition's shape, and return the hash key value it selects.
+        '''
+        hash_value = MISSING
+        for part in flatten_and(node):
+            if part[0] in ('or', 'not', 'in'):
+                raise ValidationError(f'Invalid operator used in KeyConditionExpression: {part[0].upper()}')
+            if part[0] == 'func' and part[1] != 'begins_with':
+                raise ValidationError(f'Invalid operator used in KeyConditionExpression: {part[1]}')
+
+            operands = part[2] if part[0] == 'func' else part[1:] if part[0] == 'between' else part[2:]
+            if any(operand[0] == 'size' for operand in operands):
+                raise ValidationError('Invalid KeyConditionExpression: KeyConditionExpressions cannot contain nested operations; operation: size')
+
+            if part[0] == 'cmp' and part[1] == '=':
+                for path, other in ((part[2], part[3]), (part[3], part[2])):
+                    if path[0] == 'path' and other[0] == 'value' and evaluator.elements(path) == [hash_name]:
+                        hash_value = evaluator.value(other[1])
+
+        if hash_value is MISSING:
+            raise ValidationError(f'Query condition missed key schema element: {hash_name}')
+        return hash_value
+
+    @dynamodb_operation('Query')
+    def query(self, **params):
+        table = self.table(params['TableName'])
+        index_name = params.get('IndexName')
+        hash_name, _ = table.key_schema(index_name)
+
+        if index_name and params.get('ConsistentRead'):
+            raise ValidationError('Consistent reads are not supported on global secondary indexes')
+
+        evaluator = request_evaluator(params)
+        key_condition = parse_condition(params['KeyConditionExpression'])
+        hash_value = self.key_condition_hash(key_condition, evaluator, hash_name)
+
+        entries = table.partition_entries(index_name, hash_value)
+        forward = params.get('ScanIndexForward', True)
+
+        if params.get('ExclusiveStartKey'):
+            start_hash, start = table.start_entry(index_name, params['ExclusiveStartKey'])
+            if start_hash != hash_value:
+                raise ValidationError('The provided starting key is outside query boundaries based on provided conditions')
+            entries = entries[bisect_right(entries, start):] if forward else entries[:bisect_left(entries, start)]
+        if not forward:
+            entries = entries[::-1]
+
+        items = [table.items[table_key] for _, table_key in entries]
+        items = [item for item in items if evaluator.test(key_condition, item)]
+
+        return self.read_page(table, index_name, items, evaluator, params)
+
+    @dynamodb_operation('Scan')
+    def scan(self, **params):
+        table = self.table(params['TableName'])
+        index_name = params.get('IndexName')
+        table.key_schema(index_name)
+
+        segment = params.get('Segment')
+        total_segments = params.get('TotalSegments')
+        if (segment is None) != (total_segments is None):
+            raise ValidationError('The TotalSegments parameter is required but was not present in the request when Segment parameter is present')
+
+        if index_name:
+            entries = [
+                (hash_value, entry)
+                for hash_value, partition in sorted(table.index_partitions[index_name].items())
+                for entry in partition
+            ]
+        else:
+            entries = [(None, (None, table_key)) for table_key in sorted(table.items)]
+
+        if params.get('ExclusiveStartKey'):
+            start_hash, (start_range, start_table_key) = table.start_entry(index_name, params['ExclusiveStartKey'])
+            if index_name:
+                start = (start_hash, (start_range, start_table_key))
+            else:
+                start = (None, (None, start_table_key))
+            entries = entries[bisect_right(entries, start):]
+
+        if total_segments:
+            entries = [entry for entry in entries if scan_segment_of(entry[1][1], total_segments) == segment]
+
+        items = [table.items[table_key] for _, (_, table_key) in entries]
+
+        return self.read_page(table, index_name, items, request_evaluator(params), params)
+
+    @dynamodb_operation('BatchGetItem')
+    def batch_get_item(self, **params):
+        request_items = params['RequestItems']
+        if sum(len(request['Keys']) for request in request_items.values()) > C_BATCH_GET_MAX_KEYS:
+            raise ValidationError('Too many items requested for the BatchGetItem call')
+
+        responses = {}
+        unprocessed = {}
+        capacities = []
+
+        for table_name, request in request_items.items():
+            table = self.table(table_name)
+            check_expression_attributes(request)
+            evaluator = Evaluator(request.get('ExpressionAttributeNames'))
+            projection = parse_projection(request['ProjectionExpression']) if request.get('ProjectionExpression') else None
+
+            table_keys = [table.decode_key(typed_key) for typed_key in request['Keys']]
+            if len(set(table_keys)) != len(table_keys):
+                raise ValidationError('Provided list of item keys contains duplicates')
+
+            responses[table_name] = []
+            units = 0.0
+
+            for typed_key, table_key in zip(request['Keys'], table_keys):
+                if self.unprocessed_rate and random.random() < self.unprocessed_rate:
+                    unprocessed.setdefault(table_name, {**request, 'Keys': []})['Keys'].append(typed_key)
+                    continue
+
+                item = table.items.get(table_key)
+                units += read_units(item_size(item or {}), request.get('ConsistentRead'))
+                if item is not None:
+                    responses[table_name].append(encode(evaluator.project(projection, item) if projection else item))
+
+            capacity = self.consumed_capacity(params, table_name, units)
+            if capacity is not None:
+                capacities.append(capacity)
+
+        response = {'Responses': responses, 'UnprocessedKeys': unprocessed}
+        if capacities:
+            response['ConsumedCapacity'] = capacities
+        return response
+
+    @dynamodb_operation('BatchWriteItem')
+    def batch_write_item(self, **params):
+        request_items = params['RequestItems']
+        if sum(len(requests) for requests in request_items.values()) > C_BATCH_WRITE_MAX_ITEMS:
+            raise ValidationError('Too many items requested for the BatchWriteItem call')
+
+        # plan everything first: an invalid request fails the whole batch
+        plans = []
+        for table_name, requests in request_items.items():
+            table = self.table(table_name)
+            seen_keys = set()
+
+            for request in requests:
+                if 'PutRequest' in request:
+                    plan = self.plan_put(table, request['PutRequest'])
+                else:
+                    plan = self.plan_delete(table, request['DeleteRequest'])
+
+                if plan[0] in seen_keys:
+                    raise ValidationError('Provided list of item keys contains duplicates')
+                seen_keys.add(plan[0])
+                plans.append((table, request, plan))
+
+        unprocessed = {}
+        units_by_table = {}
+
+        for table, request, (table_key, old_item, new_item) in plans:
+            if self.unprocessed_rate and random.random() < self.unprocessed_rate:
+                unprocessed.setdefault(table.name, []).append(request)
+                continue
+
+            table.store(table_key, new_item)
+            units_by_table[table.name] = units_by_table.get(table.name, 0.0) + self.item_write_units(table, old_item, new_item)
+
+        response = {'UnprocessedItems': unprocessed}
+        capacities = [
+            capacity for capacity in (
+                self.consumed_capacity(params, table_name, units) for table_name, units in units_by_table.items()
+            )
+            if capacity is not None
+        ]
+        if capacities:
+            response['ConsumedCapacity'] = capacities
+        return response
+
+    # transactions
+
+    @dynamodb_operation('TransactWriteItems')
+    def transact_write_items(self, **params):
+        transact_items = params['TransactItems']
+        if len(transact_items) > C_TRANSACTION_MAX_ITEMS:
+            raise ValidationError(f'Member must have length less than or equal to {C_TRANSACTION_MAX_ITEMS}')
+
+        token = params.get('ClientRequestToken')
+        if token and token in self.transaction_tokens:
+            # a retry of a transaction that already succeeded
+            return copy.deepcopy(self.transaction_tokens[token])
+
+        plans = []
+        reasons = []
+        seen_keys = set()
+
+        for transact_item in transact_items:
+            (kind, request), = transact_item.items()
+            table = self.table(request['TableName'])
+
+            try:
+                if kind == 'Put':
+                    plan = self.plan_put(table, request)
+                elif kind == 'Update':
+                    plan = self.plan_update(table, request)
+                elif kind == 'Delete':
+                    plan = self.plan_delete(table, request)
+                elif kind == 'ConditionCheck':
+                    plan = self.plan_condition_check(table, request)
+                else:
+                    raise ValidationError(f'Unknown transaction operation: {kind}')
+            except ConditionFailed as e:
+                reason = {'Code': 'ConditionalCheckFailed', 'Message': 'The conditional request failed'}
+                if request.get('ReturnValuesOnConditionCheckFailure') == 'ALL_OLD' and e.item is not None:
+                    reason['Item'] = encode(e.item)
+                reasons.append(reason)
+                continue
+
+            if (table.name, plan[0]) in seen_keys:
+                raise ValidationError('Transaction request cannot include multiple operations on one item')
+            seen_keys.add((table.name, plan[0]))
+
+            plans.append((table, plan))
+            reasons.append({'Code': 'None'})
+
+        if len(plans) < len(transact_items):
+            codes = ', '.join(reason['Code'] for reason in reasons)
+            raise client_error(
+                'TransactionCanceledException',
+                f'Transaction cancelled, please refer cancellation reasons for specific reasons [{codes}]',
+                'TransactWriteItems',
+                CancellationReasons=reasons
+            )
+
+        units_by_table = {}
+        for table, (table_key, old_item, new_item) in plans:
+            if new_item is C_NO_CHANGE:
+                units = read_units(item_size(old_item or {}), True)
+            else:
+                table.store(table_key, new_item)
+                units = self.item_write_units(table, old_item, new_item)
+            # transactions cost twice as much
+            units_by_table[table.name] = units_by_table.get(table.name, 0.0) + 2 * units
+
+        response = {}
+        capacities = [
+            capacity for capacity in (
+                self.consumed_capacity(params, table_name, units) for table_name, units in units_by_table.items()
+            )
+            if capacity is not None
+        ]
+        if capacities:
+            response['ConsumedCapacity'] = capacities
+
+        if token:
+            self.transaction_tokens[token] = copy.deepcopy(response)
+
+        return response
+
+    @dynamodb_operation('TransactGetItems')
+    def transact_get_items(self, **params):
+        transact_items = params['TransactItems']
+        if len(transact_items) > C_TRANSACTION_MAX_ITEMS:
+            raise ValidationError(f'Member must have length less than or equal to {C_TRANSACTION_MAX_ITEMS}')
+
+        responses = []
+        units_by_table = {}
+
+        for transact_item in transact_items:
+            request = transact_item['Get']
+            table = self.table(request['TableName'])
+            check_expression_attributes(request)
+            item = table.items.get(table.decode_key(request['Key']))
+
+            units_by_table[table.name] = units_by_table.get(table.name, 0.0) + 2 * read_units(item_size(item or {}), True)
+
+            if item is None:
+                responses.append({})
+                continue
+
+            if request.get('ProjectionExpression'):
+                evaluator = Evaluator(request.get('ExpressionAttributeNames'))
+                item = evaluator.project(parse_projection(request['ProjectionExpression']), item)
+            responses.append({'Item': encode(item)})
+
+        response = {'Responses': responses}
+        capacities = [
+            capacity for capacity in (
+                self.consumed_capacity(params, table_name, units) for table_name, units in units_by_table.items()
+            )
+            if capacity is not None
+        ]
+        if capacities:
+            response['ConsumedCapacity'] = capacities
+        return response
+
+    # tables
+
+    @dynamodb_operation('CreateTable')
+    def create_table(self, **params):
+        table_name = params['TableName']
+        if table_name in self.tables:
+            raise client_error('ResourceInUseException', f'Table already exists: {table_name}', 'CreateTable')
+
+        def schema_keys(key_schema):
+            keys = {entry['KeyType']: entry['AttributeName'] for entry in key_schema}
+            return keys['HASH'], keys.get('RANGE')
+
+        hash_key, range_key = schema_keys(params['KeySchema'])
+        indexes = {
+            index['IndexName']: schema_keys(index['KeySchema'])
+            for index in params.get('GlobalSecondaryIndexes', [])
+        }
+        attribute_types = {
+            definition['AttributeName']: definition['AttributeType']
+            for definition in params.get('AttributeDefinitions', [])
+        }
+
+        self.tables[table_name] = MemoryTable(table_name, hash_key, range_key, indexes, attribute_types)
+
+        return {'TableDescription': {'TableName': table_name, 'TableStatus': 'ACTIVE'}}
+
+    @dynamodb_operation('DeleteTable')
+    def delete_table(self, **params):
+        table_name = params['TableName']
+        if self.tables.pop(table_name, None) is None:
+            raise client_error('ResourceNotFoundException', 'Requested resource not found', 'DeleteTable')
+        return {'TableDescription': {'TableName': table_name, 'TableStatus': 'DELETING'}}
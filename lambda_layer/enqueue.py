@@ -0,0 +1,215 @@
+'''
+This file includes the SQS enqueue buffer, which collects messages during a request or job
+and sends them with send_message_batch, up to 10 at a time, rather than one send_message each.
+
+    enqueue_message(json.dumps(body), group_id=spelunk_id)
+    ...
+    flush_enqueued()    # at the end of the request / invocation
+
+Messages are buffered per queue, in the order they were enqueued, and a queue is flushed as
+soon as it has a full batch, so a backfill doesn't hold thousands of messages in memory. The
+rest are sent by flush_enqueued, which the API middleware and flush_enqueued_after (for lambda
+handlers) call at the end of every invocation.
+
+FIFO semantics are kept: each entry carries its own MessageGroupId (and MessageDeduplicationId
+if one was given), and entries are sent in order. Our queue uses content based deduplication
+scoped to the message group, so a message with the same group and body as one already waiting
+in the buffer is dropped here, as SQS would drop it anyway.
+
+Entries that fail for reasons that aren't the sender's fault (throttling, internal errors) are
+retried with backoff. Note a retried entry can land after later entries of its group that
+succeeded first time. Entries that still fail are logged and returned by flush_enqueued, and
+their on_failed callbacks are run, so the caller can undo whatever marked the work as queued:
+    enqueue_message(body, group_id=spelunk_id, on_failed=lambda: release_lease(spelunk_id))
+
+Configured with these environment variables:
+    queue_url: the default queue
+'''
+from clients import get_client
+from retry import backoff_sleep
+from log import get_logger
+import functools
+import os
+import threading
+
+logger = get_logger('enqueue')
+
+C_SQS_BATCH_MAX_ENTRIES = 10
+C_SQS_BATCH_MAX_BYTES = 256 * 1024
+C_ENQUEUE_MAX_ATTEMPTS = 5
+
+# the parts of an entry that are sent, the rest (on_failed) stays here
+C_SQS_ENTRY_FIELDS = ('MessageBody', 'MessageGroupId', 'MessageDeduplicationId')
+
+# queue_url: list of entries waiting to be sent
+PENDING = {}
+PENDING_LOCK = threading.Lock()
+
+# held while taking entries from PENDING and sending them, so batches go out in order
+FLUSH_LOCK = threading.Lock()
+
+def entry_dedup_key(entry):
+    return (
+        entry.get('MessageGroupId'),
+        entry.get('MessageDeduplicationId') or entry['MessageBody'],
+    )
+
+def enqueue_message(body, group_id=None, dedup_id=None, queue_url=None, on_failed=None):
+    '''
+    Buffer a message (a string) for queue_url (default the queue_url env var).
+    It is sent when the queue has a full batch, or at the next flush_enqueued.
+    on_failed is called (with no arguments) if the message can't be sent.
+    '''
+    queue_url = queue_url or os.environ['queue_url']
+
+    entry = {'MessageBody': body, 'on_failed': [on_failed] if on_failed else []}
+    if group_id is not None:
+        entry['MessageGroupId'] = group_id
+    if dedup_id is not None:
+        entry['MessageDeduplicationId'] = dedup_id
+
+    with PENDING_LOCK:
+        entries = PENDING.setdefault(queue_url, [])
+
+        dedup_key = entry_dedup_key(entry)
+        for pending in entries:
+            if entry_dedup_key(pending) == dedup_key:
+                # the waiting message stands in for this one, so it answers for its failure too
+                pending['on_failed'].extend(entry['on_failed'])
+                logger.debug('enqueue_message duplicate dropped', queue_url=queue_url, group_id=group_id)
+                return
+
+        entries.append(entry)
+        full = len(entries) >= C_SQS_BATCH_MAX_ENTRIES
+
+    if full:
+        flush_enqueued(queue_url)
+
+def pending_count(queue_url=None):
+    '''
+    How many messages are waiting to be sent (to queue_url, or to any queue).
+    '''
+    with PENDING_LOCK:
+        if queue_url:
+            return len(PENDING.get(queue_url, []))
+        return sum(len(entries) for entries in PENDING.values())
+
+def sqs_entry(entry, entry_id):
+    return dict({name: entry[name] for name in C_SQS_ENTRY_FIELDS if name in entry}, Id=entry_id)
+
+def entry_size(entry):
+    return len(entry['MessageBody'].encode('utf-8'))
+
+def make_batches(entries):
+    '''
+    Split entries into consecutive send_message_batch sized lists (10 entries, 256KB).
+    '''
+    batches = []
+    batch = []
+    batch_size = 0
+
+    for entry in entries:
+        size = entry_size(entry)
+        if batch and (len(batch) >= C_SQS_BATCH_MAX_ENTRIES or batch_size + size > C_SQS_BATCH_MAX_BYTES):
+            batches.append(batch)
+            batch = []
+            batch_size = 0
+        batch.append(entry)
+        batch_size += size
+
+    if batch:
+        batches.append(batch)
+
+    return batches
+
+def send_batch(sqs, queue_url, batch, max_attempts):
+    '''
+    Send one batch, retrying the entries that failed through no fault of ours.
+    Returns the entries that couldn't be sent.
+    '''
+    waiting = {str(i): entry for i, entry in enumerate(batch)}
+    failed = []
+
+    attempt = 0
+    while waiting:
+        try:
+            response = sqs.send_message_batch(
+                QueueUrl=queue_url,
+                Entries=[sqs_entry(entry, entry_id) for entry_id, entry in waiting.items()]
+            )
+        except Exception as e:
+            logger.warning('send_message_batch failed', queue_url=queue_url, count=len(waiting), attempt=attempt, exc=e)
+            response = {
+                'Failed': [{'Id': entry_id, 'SenderFault': False, 'Code': 'Exception'} for entry_id in waiting]
+            }
+
+        retry = {}
+        for failure in response.get('Failed') or []:
+            entry = waiting[failure['Id']]
+            if failure.get('SenderFault'):
+                logger.error(
+                    'enqueue rejected', queue_url=queue_url, group_id=entry.get('MessageGroupId'),
+                    code=failure.get('Code'), reason=failure.get('Message')
+                )
+                failed.append(entry)
+            else:
+                retry[failure['Id']] = entry
+
+        attempt += 1
+        if retry and attempt >= max_attempts:
+            logger.error('enqueue failed after retries', queue_url=queue_url, count=len(retry), attempts=attempt)
+            failed.extend(retry.values())
+            break
+
+        waiting = retry
+        if waiting:
+            backoff_sleep(attempt)
+
+    return failed
+
+def flush_enqueued(queue_url=None, max_attempts=C_ENQUEUE_MAX_ATTEMPTS):
+    '''
+    Send everything buffered for queue_url (or for every queue). Returns the entries that
+    couldn't be sent, after retries, once their on_failed callbacks have run.
+    '''
+    failed = []
+
+    with FLUSH_LOCK:
+        with PENDING_LOCK:
+            queue_urls = [queue_url] if queue_url else list(PENDING)
+            taken = {url: PENDING.pop(url, []) for url in queue_urls}
+
+        sqs = None
+        for url, entries in taken.items():
+            if not entries:
+                continue
+
+            sqs = sqs or get_client('sqs')
+            for batch in make_batches(entries):
+                failed.extend(send_batch(sqs, url, batch, max_attempts))
+
+            logger.debug('flush_enqueued', queue_url=url, count=len(entries))
+
+    for entry in failed:
+        run_on_failed(entry)
+
+    return failed
+
+def run_on_failed(entry):
+    for on_failed in entry['on_failed']:
+        try:
+            on_failed()
+        except Exception as e:
+            logger.error('enqueue on_failed callback failed', group_id=entry.get('MessageGroupId'), exc=e)
+
+def flush_enqueued_after(handler):
+    '''
+    Decorator for a lambda handler, flushing the enqueue buffer at the end of every invocation.
+    '''
+    @functools.wraps(handler)
+    def wrapper(*args, **kwargs):
+        try:
+            return handler(*args, **kwargs)
+        finally:
+            flush_enqueued()
+    return wrapper
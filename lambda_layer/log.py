@@ -0,0 +1,117 @@
+'''
+This file includes a small structured logging facade for the layer modules.
+
+Each log line is a single JSON object, which CloudWatch Logs Insights can query directly:
+    {"level": "INFO", "logger": "ddb", "message": "put_item", "table_name": "..."}
+
+Messages and field values can be callables. They are only called when the line is actually
+going to be written, so expensive formatting (like dumping a whole record) costs nothing
+when its level is switched off:
+    logger.debug('get_item response', response=lambda: response)
+
+Configured with these environment variables:
+    log_level: DEBUG, INFO, WARNING or ERROR (default INFO)
+    log_sample_rate: fraction of suppressed (below log_level) lines to write anyway,
+        e.g. 0.01 to see 1% of DEBUG lines in production (default 0)
+'''
+import json
+import os
+import random
+import sys
+import traceback
+
+C_DEBUG = 10
+C_INFO = 20
+C_WARNING = 30
+C_ERROR = 40
+
+C_LEVEL_NAMES = {
+    C_DEBUG: 'DEBUG',
+    C_INFO: 'INFO',
+    C_WARNING: 'WARNING',
+    C_ERROR: 'ERROR',
+}
+
+C_LEVELS_BY_NAME = {name: level for level, name in C_LEVEL_NAMES.items()}
+
+LOGGERS = {}
+
+def level_from_env():
+    return C_LEVELS_BY_NAME.get(os.environ.get('log_level', 'INFO').upper(), C_INFO)
+
+def sample_rate_from_env():
+    try:
+        return float(os.environ.get('log_sample_rate', 0))
+    except ValueError:
+        return 0.0
+
+def resolve(value):
+    return value() if callable(value) else value
+
+class Logger:
+    def __init__(self, name, level=None, sample_rate=None):
+        self.name = name
+        self.level = level if level is not None else level_from_env()
+        self.sample_rate = sample_rate if sample_rate is not None else sample_rate_from_env()
+
+    def enabled(self, level):
+        '''
+        Is a line at this level going to be written? Sampling makes this a coin toss
+        for suppressed levels, so call it once per line.
+        '''
+        if level >= self.level:
+            return True
+        return self.sample_rate > 0 and random.random() < self.sample_rate
+
+    def log(self, level, message, exc=None, **fields):
+        if not self.enabled(level):
+            return
+
+        entry = {
+            'level': C_LEVEL_NAMES.get(level, str(level)),
+            'logger': self.name,
+            'message': resolve(message),
+            **{key: resolve(value) for key, value in fields.items()}
+        }
+
+        if exc is not None:
+            entry['exception'] = ''.join(traceback.format_exception(type(exc), exc, exc.__traceback__))
+
+        try:
+            line = json.dumps(entry, default=str)
+        except (TypeError, ValueError):
+            line = json.dumps({key: str(value) for key, value in entry.items()})
+
+        sys.stdout.write(line + '\n')
+
+    def debug(self, message, **fields):
+        self.log(C_DEBUG, message, **fields)
+
+    def info(self, message, **fields):
+        self.log(C_INFO, message, **fields)
+
+    def warning(self, message, **fields):
+        self.log(C_WARNING, message, **fields)
+
+    def error(self, message, **fields):
+        self.log(C_ERROR, message, **fields)
+
+def get_logger(name):
+    '''
+    Get the logger for a module, creating it on first use.
+    '''
+    logger = LOGGERS.get(name)
+    if logger is None:
+        logger = LOGGERS.setdefault(name, Logger(name))
+    return logger
+
+def set_level(level, sample_rate=None):
+    '''
+    Change the level (a name or number) of every logger, e.g. for one verbose invocation.
+    '''
+    if isinstance(level, str):
+        level = C_LEVELS_BY_NAME[level.upper()]
+    for logger in LOGGERS.values():
+        logger.level = level
+        if sample_rate is not None:
+            logger.sample_rate = sample_rate
@@ -0,0 +1,98 @@
+'''
+This file includes a bounded, thread safe LRU cache with per-entry expiry, used by the
+in-process caches in the layer.
+'''
+from collections import OrderedDict
+import threading
+import time
+
+class TTLCache:
+    '''
+    Least recently used cache holding at most max_size entries.
+
+    Each entry expires ttl seconds after it was set (None means never). Expired entries
+    are dropped when they are next looked up, or when they reach the end of the LRU order.
+    Counts hits, misses, evictions (for size) and expirations.
+    '''
+    def __init__(self, max_size=1024, ttl=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.data = OrderedDict()
+        self.lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key, default=None):
+        '''
+        Get the value for key, or default if it is missing or expired.
+        '''
+        with self.lock:
+            entry = self.data.get(key)
+
+            if entry is None:
+                self.misses += 1
+                return default
+
+            expires_at, value = entry
+
+            if expires_at is not None and expires_at <= time.monotonic():
+                del self.data[key]
+                self.expirations += 1
+                self.misses += 1
+                return default
+
+            self.data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, ttl=None):
+        '''
+        Set the value for key. ttl overrides the cache's default expiry for this entry.
+        '''
+        use_ttl = self.ttl if ttl is None else ttl
+        expires_at = time.monotonic() + use_ttl if use_ttl is not None else None
+
+        with self.lock:
+            self.data[key] = (expires_at, value)
+            self.data.move_to_end(key)
+
+            while len(self.data) > self.max_size:
+                self.data.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        '''
+        Remove key from the cache. Returns whether it was there.
+        '''
+        with self.lock:
+            return self.data.pop(key, None) is not None
+
+    def delete_where(self, predicate):
+        '''
+        Remove every entry whose key matches predicate. Returns how many were removed.
+        '''
+        with self.lock:
+            keys = [key for key in self.data if predicate(key)]
+            for key in keys:
+                del self.data[key]
+            return len(keys)
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+    def stats(self):
+        with self.lock:
+            return {
+                'size': len(self.data),
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+            }
+
+    def __len__(self):
+        return len(self.data)
@@ -0,0 +1,265 @@
+'''
+This file includes cache_result, a decorator memoizing functions (plain or async) whose
+results are worth keeping for a while in a warm container:
+
+    @cache_result
+    def get_thing(thing_id): ...
+
+    @cache_result(max_size=256, ttl=3600)
+    async def get_other_thing(thing_id): ...
+
+Each decorated function gets its own TTLCache (see lru.py), holding at most max_size results,
+each for ttl seconds (None: until it is evicted). Concurrent calls that miss on the same
+arguments share one computation (single-flight) rather than all doing the work. Exceptions
+are not cached; every caller waiting on the failed computation gets the exception.
+
+Arguments are the cache key. Unhashable arguments (dicts, lists, sets) are converted to a
+hashable equivalent, and anything else unhashable is keyed by its repr.
+
+Cached results are shared between callers, so don't mutate them.
+
+With shared_ttl, results are also kept in dynamodb for shared_ttl seconds, so they survive
+cold starts and are shared by every container. That tier is checked after the in-process
+cache misses and before recomputing. Records are keyed MEMO*<function>*<hash of the
+arguments>, expire through the table's ttl attribute, and hold the result as JSON, so
+shared results must be JSON serializable (tuples come back as lists). Large results are
+compressed or spilled to s3 like any other offloaded attribute (see offload.py). If
+dynamodb can't be reached, the function is just called.
+
+The decorated function also has:
+    invalidate(*args, **kwargs): forget the result for those arguments (in dynamodb too)
+    cache_clear(): forget everything in this container
+    cache_stats(): size, hits, misses, evictions and expirations (and shared_* counts)
+'''
+from lru import TTLCache
+from ddb import get_item, put_item, delete_item
+from offload import register_offload_policy
+from aio import run_blocking
+from log import get_logger
+import asyncio
+import functools
+import hashlib
+import json
+import os
+import threading
+import time
+
+logger = get_logger('memo')
+
+C_DEFAULT_MAX_SIZE = 256
+C_DEFAULT_TTL = 300
+
+C_MEMO = 'MEMO'
+C_MEMO_VALUE_ATTRIBUTE = 'memo_value'
+
+# a cache miss, as opposed to a cached None
+MISSING = object()
+
+register_offload_policy(C_MEMO_VALUE_ATTRIBUTE)
+
+def freeze(value):
+    '''
+    A hashable stand in for value, equal for equal values. Its repr is the same in every
+    process (sets are sorted, as their iteration order depends on PYTHONHASHSEED), so it can
+    key the shared tier.
+    '''
+    if isinstance(value, dict):
+        return ('dict', tuple(sorted(((freeze(k), freeze(v)) for k, v in value.items()), key=repr)))
+    if isinstance(value, (list, tuple)):
+        return (type(value).__name__, tuple(freeze(v) for v in value))
+    if isinstance(value, (set, frozenset)):
+        return ('set', tuple(sorted((freeze(v) for v in value), key=repr)))
+    try:
+        hash(value)
+        return value
+    except TypeError:
+        return ('repr', type(value).__name__, repr(value))
+
+def make_key(args, kwargs):
+    key = (args, tuple(sorted(kwargs.items())))
+    try:
+        hash(key)
+        return key
+    except TypeError:
+        return freeze(key)
+
+class SharedTier:
+    '''
+    The dynamodb tier for one memoized function.
+    '''
+    def __init__(self, name, ttl):
+        self.name = name
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+
+    def pkey(self, key):
+        digest = hashlib.sha256(repr(freeze(key)).encode('utf-8')).hexdigest()
+        return f'{C_MEMO}*{self.name}*{digest}'
+
+    def get(self, key):
+        try:
+            item = get_item(os.environ['table_name'], self.pkey(key)).get('Item')
+        except Exception as e:
+            self.errors += 1
+            logger.warning('memo shared get failed', name=self.name, exc=e)
+            return MISSING
+
+        # dynamodb deletes expired items eventually, not straight away
+        if not item or int(item.get('ttl') or 0) <= time.time():
+            self.misses += 1
+            return MISSING
+
+        self.hits += 1
+        return json.loads(item[C_MEMO_VALUE_ATTRIBUTE])
+
+    def set(self, key, value):
+        try:
+            serialized = json.dumps(value)
+        except (TypeError, ValueError):
+            logger.debug('memo result is not JSON serializable, not sharing it', name=self.name)
+            return
+
+        try:
+            put_item(os.environ['table_name'], {
+                'pkey': self.pkey(key),
+                C_MEMO_VALUE_ATTRIBUTE: serialized,
+                'ttl': int(time.time() + self.ttl),
+            })
+        except Exception as e:
+            self.errors += 1
+            logger.warning('memo shared set failed', name=self.name, exc=e)
+
+    def delete(self, key):
+        try:
+            delete_item(os.environ['table_name'], self.pkey(key))
+        except Exception as e:
+            self.errors += 1
+            logger.warning('memo shared delete failed', name=self.name, exc=e)
+
+    def stats(self):
+        return {
+            'shared_hits': self.hits,
+            'shared_misses': self.misses,
+            'shared_errors': self.errors,
+        }
+
+class Flight:
+    '''
+    A computation in progress, which callers missing on the same key wait for.
+    '''
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+def cache_result(f=None, max_size=C_DEFAULT_MAX_SIZE, ttl=C_DEFAULT_TTL, cache_none=True, shared_ttl=None):
+    '''
+    Memoize f: see the top of this file. Use bare (@cache_result) or with arguments.
+    With cache_none False, None results aren't kept. shared_ttl turns on the dynamodb tier.
+    '''
+    if f is None:
+        return functools.partial(cache_result, max_size=max_size, ttl=ttl, cache_none=cache_none, shared_ttl=shared_ttl)
+
+    cache = TTLCache(max_size=max_size, ttl=ttl)
+    shared = SharedTier(f'{f.__module__}.{f.__qualname__}', shared_ttl) if shared_ttl else None
+    lock = threading.Lock()
+    in_flight = {}
+
+    def finish(key, result):
+        # with the lock held
+        if keep_result(result):
+            cache.set(key, result)
+        in_flight.pop(key, None)
+
+    def keep_result(result):
+        return result is not None or cache_none
+
+    def call_through_shared(key, args, kwargs):
+        # the dynamodb tier, then f
+        result = shared.get(key)
+        if result is MISSING:
+            result = f(*args, **kwargs)
+            if keep_result(result):
+                shared.set(key, result)
+        return result
+
+    if asyncio.iscoroutinefunction(f):
+        async def compute(key, args, kwargs):
+            try:
+                result = await run_blocking(shared.get, key) if shared else MISSING
+                if result is MISSING:
+                    result = await f(*args, **kwargs)
+                    if shared and keep_result(result):
+                        await run_blocking(shared.set, key, result)
+            except BaseException:
+                with lock:
+                    in_flight.pop(key, None)
+                raise
+            with lock:
+                finish(key, result)
+            return result
+
+        @functools.wraps(f)
+        async def wrapper(*args, **kwargs):
+            key = make_key(args, kwargs)
+            loop = asyncio.get_running_loop()
+
+            with lock:
+                value = cache.get(key, MISSING)
+                if value is not MISSING:
+                    return value
+
+                flight = in_flight.get(key)
+                # a task can only be awaited on its own event loop
+                if flight is None or flight[0] is not loop:
+                    flight = in_flight[key] = (loop, loop.create_task(compute(key, args, kwargs)))
+
+            # shielded, so a cancelled caller doesn't cancel the computation others are waiting for
+            return await asyncio.shield(flight[1])
+    else:
+        @functools.wraps(f)
+        def wrapper(*args, **kwargs):
+            key = make_key(args, kwargs)
+
+            with lock:
+                value = cache.get(key, MISSING)
+                if value is not MISSING:
+                    return value
+
+                flight = in_flight.get(key)
+                leader = flight is None
+                if leader:
+                    flight = in_flight[key] = Flight()
+
+            if not leader:
+                flight.done.wait()
+                if flight.error is not None:
+                    raise flight.error
+                return flight.result
+
+            try:
+                flight.result = call_through_shared(key, args, kwargs) if shared else f(*args, **kwargs)
+                with lock:
+                    finish(key, flight.result)
+                return flight.result
+            except BaseException as e:
+                flight.error = e
+                with lock:
+                    in_flight.pop(key, None)
+                raise
+            finally:
+                flight.done.set()
+
+    def invalidate(*args, **kwargs):
+        key = make_key(args, kwargs)
+        if shared:
+            shared.delete(key)
+        return cache.delete(key)
+
+    wrapper.invalidate = invalidate
+    wrapper.cache_clear = cache.clear
+    wrapper.cache_stats = lambda: {**cache.stats(), **(shared.stats() if shared else {})}
+
+    return wrapper
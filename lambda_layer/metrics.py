@@ -0,0 +1,195 @@
+'''
+This file collects per-invocation metrics for dynamodb calls (and other steps worth timing, see
+record_timing), and flushes them at the end of the invocation as CloudWatch Embedded Metric
+Format (EMF) log lines, or to a pluggable sink.
+
+Each call is recorded against (operation, table, index, call site), where the call site is the
+module.function outside the ddb layer that made the call, e.g. spelunk.get_spelunk_rec.
+Calls are aggregated in memory, so recording is cheap, and one line per aggregate is written
+on flush. CloudWatch turns the EMF lines into metrics in the metrics_namespace namespace
+(default spl/ddb), with dimensions [Operation, Table] and [Operation, Table, CallSite].
+
+Configured with these environment variables:
+    ddb_metrics: 'false' to switch recording off (default 'true')
+    metrics_namespace: the CloudWatch namespace (default 'spl/ddb')
+'''
+import functools
+import json
+import os
+import sys
+import threading
+import time
+
+C_READ_OPERATIONS = {'GetItem', 'Query', 'Scan', 'BatchGetItem', 'TransactGetItems'}
+
+# EMF allows up to 100 values per metric per line
+C_MAX_LATENCY_SAMPLES = 100
+
+METRICS_ENABLED = os.environ.get('ddb_metrics', 'true').strip().lower() not in ('0', 'false', 'no', 'off')
+
+AGGREGATES = {}
+AGGREGATES_LOCK = threading.Lock()
+
+def emf_sink(aggregates):
+    '''
+    The default sink: write one EMF line per aggregate to stdout.
+    '''
+    namespace = os.environ.get('metrics_namespace', 'spl/ddb')
+    timestamp = int(time.time() * 1000)
+
+    for aggregate in aggregates:
+        entry = {
+            '_aws': {
+                'Timestamp': timestamp,
+                'CloudWatchMetrics': [
+                    {
+                        'Namespace': namespace,
+                        'Dimensions': [['Operation', 'Table'], ['Operation', 'Table', 'CallSite']],
+                        'Metrics': [
+                            {'Name': 'Calls', 'Unit': 'Count'},
+                            {'Name': 'Errors', 'Unit': 'Count'},
+                            {'Name': 'Throttles', 'Unit': 'Count'},
+                            {'Name': 'Items', 'Unit': 'Count'},
+                            {'Name': 'ReadCapacityUnits', 'Unit': 'Count'},
+                            {'Name': 'WriteCapacityUnits', 'Unit': 'Count'},
+                            {'Name': 'Latency', 'Unit': 'Milliseconds'},
+                        ]
+                    }
+                ]
+            },
+            'Operation': aggregate['operation'],
+            'Table': aggregate['table_name'] or '-',
+            'Index': aggregate['index_name'] or '-',
+            'CallSite': aggregate['call_site'],
+            'Calls': aggregate['calls'],
+            'Errors': aggregate['errors'],
+            'Throttles': aggregate['throttles'],
+            'Items': aggregate['items'],
+            'ReadCapacityUnits': aggregate['read_capacity_units'],
+            'WriteCapacityUnits': aggregate['write_capacity_units'],
+            'Latency': aggregate['latencies_ms'],
+            'LatencyTotal': aggregate['latency_total_ms'],
+            'LatencyMax': aggregate['latency_max_ms'],
+        }
+        sys.stdout.write(json.dumps(entry) + '\n')
+
+SINK = emf_sink
+
+def set_metrics_sink(sink):
+    '''
+    Send flushed metrics somewhere else. sink is called with a list of aggregate dicts.
+    Passing None restores the EMF sink.
+    '''
+    global SINK
+    SINK = sink or emf_sink
+
+def metrics_enabled():
+    return METRICS_ENABLED
+
+def set_metrics_enabled(enabled):
+    global METRICS_ENABLED
+    METRICS_ENABLED = enabled
+
+def capacity_units(consumed_capacity):
+    '''
+    Total CapacityUnits from a ConsumedCapacity entry, or list of them (batch and transact calls).
+    '''
+    if not consumed_capacity:
+        return 0.0
+    if isinstance(consumed_capacity, dict):
+        consumed_capacity = [consumed_capacity]
+    return float(sum(entry.get('CapacityUnits') or 0 for entry in consumed_capacity))
+
+def record_ddb_call(
+    operation, table_name, index_name, call_site,
+    consumed_capacity=None, item_count=0, elapsed_ms=0.0, error=False, throttled=False
+):
+    '''
+    Add one dynamodb call (one attempt, when calls are retried) to this invocation's metrics.
+    '''
+    if not METRICS_ENABLED:
+        return
+
+    key = (operation, table_name, index_name, call_site)
+    units = capacity_units(consumed_capacity)
+
+    with AGGREGATES_LOCK:
+        aggregate = AGGREGATES.get(key)
+        if aggregate is None:
+            aggregate = AGGREGATES[key] = {
+                'operation': operation,
+                'table_name': table_name,
+                'index_name': index_name,
+                'call_site': call_site,
+                'calls': 0,
+                'errors': 0,
+                'throttles': 0,
+                'items': 0,
+                'read_capacity_units': 0.0,
+                'write_capacity_units': 0.0,
+                'latencies_ms': [],
+                'latency_total_ms': 0.0,
+                'latency_max_ms': 0.0,
+            }
+
+        aggregate['calls'] += 1
+        aggregate['errors'] += 1 if error else 0
+        aggregate['throttles'] += 1 if throttled else 0
+        aggregate['items'] += item_count or 0
+        if operation in C_READ_OPERATIONS:
+            aggregate['read_capacity_units'] += units
+        else:
+            aggregate['write_capacity_units'] += units
+        if len(aggregate['latencies_ms']) < C_MAX_LATENCY_SAMPLES:
+            aggregate['latencies_ms'].append(round(elapsed_ms, 3))
+        aggregate['latency_total_ms'] += elapsed_ms
+        aggregate['latency_max_ms'] = max(aggregate['latency_max_ms'], elapsed_ms)
+
+def record_timing(operation, call_site, elapsed_ms, item_count=0, error=False):
+    '''
+    Add a step that isn't a dynamodb call (e.g. the API's enqueue flush) to this invocation's
+    metrics. It is aggregated and flushed like a call, with no table.
+    '''
+    record_ddb_call(operation, None, None, call_site, item_count=item_count, elapsed_ms=elapsed_ms, error=error)
+
+def metrics_snapshot():
+    '''
+    The aggregates recorded so far in this invocation, without flushing them.
+    '''
+    with AGGREGATES_LOCK:
+        return [dict(aggregate, latencies_ms=list(aggregate['latencies_ms'])) for aggregate in AGGREGATES.values()]
+
+def flush_metrics():
+    '''
+    Send this invocation's metrics to the sink and start afresh. Call at the end of each invocation.
+    '''
+    with AGGREGATES_LOCK:
+        aggregates = list(AGGREGATES.values())
+        AGGREGATES.clear()
+
+    if aggregates:
+        SINK(aggregates)
+
+def flush_metrics_after(handler):
+    '''
+    Decorator for a lambda handler, flushing the metrics at the end of every invocation.
+    '''
+    @functools.wraps(handler)
+    def wrapper(*args, **kwargs):
+        try:
+            return handler(*args, **kwargs)
+        finally:
+            flush_metrics()
+    return wrapper
+
+def call_site(skip_modules):
+    '''
+    module.function of the nearest caller outside skip_modules (module names), e.g. spelunk.get_spelunk_rec.
+    '''
+    frame = sys._getframe(1)
+    while frame is not None:
+        module = frame.f_globals.get('__name__', '?')
+        if module not in skip_modules:
+            return f'{module}.{frame.f_code.co_name}'
+        frame = frame.f_back
+    return 'unknown'
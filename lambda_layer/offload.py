@@ -0,0 +1,290 @@
+'''
+This file includes attribute offload policies, which keep large attributes from bloating
+dynamodb items (400KB limit, and one write unit per KB on every write).
+
+A policy is registered per attribute (optionally per table). When an item is written
+through the ddb layer, a policied attribute that is a large string or JSON value is:
+    - gzipped into a binary, if it is over compress_over bytes (and that makes it smaller)
+    - spilled to S3, with a small pointer left in the item, if it is still over spill_over bytes
+Both are stored as maps marked with C_OFFLOAD_MARKER, so reads know what to do without
+needing the policy: gzipped values are unpacked straight away, and spilled values are left
+as pointers in an OffloadedItem, which fetches them from S3 the first time they're read.
+
+Only top level attributes are offloaded, so a policied attribute should be written whole,
+not updated at nested paths.
+
+Spilled values are content addressed (by sha256), so writing the same value again puts
+the same S3 object. Objects for overwritten values aren't deleted; use a lifecycle rule on
+the prefix if that matters.
+
+Configured with these environment variables:
+    offload_bucket: the bucket to spill to, when the policy doesn't name one (default: bucket_name)
+'''
+from clients import get_client
+from lru import TTLCache
+from log import get_logger
+from urllib.parse import quote
+import copy
+import gzip
+import hashlib
+import json
+import os
+
+logger = get_logger('offload')
+
+C_OFFLOAD_MARKER = '__offload__'
+C_OFFLOAD_GZIP = 'gzip'
+C_OFFLOAD_S3 = 's3'
+
+C_FORMAT_STR = 'str'
+C_FORMAT_JSON = 'json'
+
+C_DEFAULT_COMPRESS_OVER = 1024
+C_DEFAULT_SPILL_OVER = 64 * 1024
+C_DEFAULT_S3_PREFIX = 'ddb-offload/'
+
+# spilled objects never change (they're content addressed), so they can be cached for as long as we like
+SPILLED_VALUE_CACHE = TTLCache(max_size=64)
+
+POLICIES = {}
+
+class OffloadPolicy:
+    '''
+    How to store one attribute: see the top of this file.
+    s3_bucket None means the offload_bucket (or bucket_name) env var.
+    '''
+    def __init__(
+        self, attribute_name, compress_over=C_DEFAULT_COMPRESS_OVER, spill_over=C_DEFAULT_SPILL_OVER,
+        s3_bucket=None, s3_prefix=C_DEFAULT_S3_PREFIX
+    ):
+        self.attribute_name = attribute_name
+        self.compress_over = compress_over
+        self.spill_over = spill_over
+        self.s3_bucket = s3_bucket
+        self.s3_prefix = s3_prefix
+
+    def bucket(self):
+        bucket = self.s3_bucket or os.environ.get('offload_bucket') or os.environ.get('bucket_name')
+        if not bucket:
+            raise ValueError(f'no bucket to spill {self.attribute_name} to, set offload_bucket')
+        return bucket
+
+def register_offload_policy(attribute_name, table_name=None, **kwargs):
+    '''
+    Offload attribute_name in table_name (None for every table). kwargs are OffloadPolicy's.
+    '''
+    policy = OffloadPolicy(attribute_name, **kwargs)
+    POLICIES[(table_name, attribute_name)] = policy
+    return policy
+
+def get_offload_policy(table_name, attribute_name):
+    return POLICIES.get((table_name, attribute_name)) or POLICIES.get((None, attribute_name))
+
+def is_offloaded(value):
+    return isinstance(value, dict) and C_OFFLOAD_MARKER in value
+
+def is_spilled(value):
+    return isinstance(value, dict) and value.get(C_OFFLOAD_MARKER) == C_OFFLOAD_S3
+
+def serialize(value):
+    '''
+    (format, bytes) for a value that can be offloaded, or None if it can't.
+    '''
+    if isinstance(value, str):
+        return C_FORMAT_STR, value.encode('utf-8')
+    if isinstance(value, (dict, list)) and not is_offloaded(value):
+        try:
+            return C_FORMAT_JSON, json.dumps(value, separators=(',', ':'), sort_keys=True).encode('utf-8')
+        except (TypeError, ValueError):
+            return None
+    return None
+
+def deserialize(value_format, data):
+    text = data.decode('utf-8')
+    return text if value_format == C_FORMAT_STR else json.loads(text)
+
+def spill_s3_key(policy, table_name, pkey, digest):
+    return f'{policy.s3_prefix}{table_name}/{quote(str(pkey), safe="")}/{policy.attribute_name}/{digest}.gz'
+
+def offload_value(policy, table_name, pkey, value):
+    '''
+    What to store for value under policy: value itself, a gzip marker, or an S3 pointer.
+    '''
+    serialized = serialize(value)
+    if serialized is None:
+        return value
+
+    value_format, data = serialized
+    if len(data) <= policy.compress_over:
+        return value
+
+    compressed = gzip.compress(data, mtime=0)
+
+    if len(compressed) <= policy.spill_over:
+        if len(compressed) >= len(data):
+            return value
+        return {C_OFFLOAD_MARKER: C_OFFLOAD_GZIP, 'format': value_format, 'data': compressed}
+
+    digest = hashlib.sha256(data).hexdigest()
+    bucket = policy.bucket()
+    s3_key = spill_s3_key(policy, table_name, pkey, digest)
+
+    get_client('s3').put_object(
+        Bucket=bucket,
+        Key=s3_key,
+        Body=compressed,
+        ContentType='application/octet-stream'
+    )
+
+    logger.debug('spilled attribute to s3', table_name=table_name, attribute_name=policy.attribute_name, s3_key=s3_key, size=len(data))
+
+    return {
+        C_OFFLOAD_MARKER: C_OFFLOAD_S3,
+        'format': value_format,
+        'bucket': bucket,
+        'key': s3_key,
+        'size': len(data),
+        'sha256': digest,
+    }
+
+def offload_item(table_name, item, pkey):
+    '''
+    Apply the policies to an item about to be written. Returns a plain dict (the item itself
+    if there was nothing to do), with spilled values already put in S3.
+    '''
+    raw = dict(dict.items(item))
+
+    for name, value in raw.items():
+        policy = get_offload_policy(table_name, name)
+        if policy is not None:
+            raw[name] = offload_value(policy, table_name, pkey, value)
+
+    return raw
+
+def offload_paths(table_name, set_paths, pkey):
+    '''
+    Apply the policies to update_item's set_paths ({path: value}), for top level attribute paths.
+    '''
+    if not set_paths:
+        return set_paths
+
+    offloaded = {}
+    for path, value in set_paths.items():
+        name = path if isinstance(path, str) else (path[0] if len(path) == 1 else None)
+        policy = get_offload_policy(table_name, name) if name is not None else None
+        offloaded[path] = offload_value(policy, table_name, pkey, value) if policy is not None else value
+
+    return offloaded
+
+def fetch_spilled_value(pointer):
+    '''
+    Get a spilled value back from S3.
+    '''
+    cache_key = (pointer['bucket'], pointer['key'])
+    value = SPILLED_VALUE_CACHE.get(cache_key)
+
+    if value is None:
+        response = get_client('s3').get_object(Bucket=pointer['bucket'], Key=pointer['key'])
+        data = gzip.decompress(response['Body'].read())
+
+        if hashlib.sha256(data).hexdigest() != pointer['sha256']:
+            raise ValueError(f'spilled value {pointer["key"]} does not match its pointer')
+
+        value = deserialize(pointer['format'], data)
+        SPILLED_VALUE_CACHE.set(cache_key, value)
+
+    return copy.deepcopy(value)
+
+def unpack_value(value):
+    '''
+    The value a marker stands for, fetching it from S3 if it was spilled.
+    '''
+    if not is_offloaded(value):
+        return value
+    if value[C_OFFLOAD_MARKER] == C_OFFLOAD_GZIP:
+        return deserialize(value['format'], gzip.decompress(bytes(value['data'])))
+    return fetch_spilled_value(value)
+
+class OffloadedItem(dict):
+    '''
+    An item holding pointers to attributes spilled to S3. Each is fetched (and kept) the
+    first time it is read, through [], get, items, values, or by copying the item into a
+    plain dict. Deep copies stay lazy.
+
+    dict.items(item) gives the attributes as stored, without fetching anything.
+    '''
+    def rehydrate(self, name):
+        value = dict.__getitem__(self, name)
+        if is_spilled(value):
+            value = fetch_spilled_value(value)
+            dict.__setitem__(self, name, value)
+        return value
+
+    def rehydrate_all(self):
+        for name in list(dict.keys(self)):
+            self.rehydrate(name)
+
+    def __getitem__(self, name):
+        return self.rehydrate(name)
+
+    def get(self, name, default=None):
+        return self.rehydrate(name) if name in self else default
+
+    def pop(self, name, *default):
+        if name in self:
+            self.rehydrate(name)
+        return dict.pop(self, name, *default)
+
+    def items(self):
+        self.rehydrate_all()
+        return dict.items(self)
+
+    def values(self):
+        self.rehydrate_all()
+        return dict.values(self)
+
+    def __iter__(self):
+        # overriding iteration makes dict(item) and **item go through __getitem__
+        return dict.__iter__(self)
+
+    def copy(self):
+        copied = type(self)()
+        dict.update(copied, dict.items(self))
+        return copied
+
+    def __deepcopy__(self, memo):
+        copied = type(self)()
+        memo[id(self)] = copied
+        for name, value in dict.items(self):
+            dict.__setitem__(copied, name, copy.deepcopy(value, memo))
+        copied.__dict__.update(copy.deepcopy(self.__dict__, memo))
+        return copied
+
+def restore_item(item):
+    '''
+    Undo offloading on an item read from dynamodb: gzipped attributes are unpacked, and if
+    any were spilled the item is returned as an OffloadedItem, which fetches them when read.
+    '''
+    spilled = False
+
+    for name, value in dict.items(item):
+        if is_offloaded(value):
+            if value[C_OFFLOAD_MARKER] == C_OFFLOAD_GZIP:
+                item[name] = unpack_value(value)
+            else:
+                spilled = True
+
+    if spilled and not isinstance(item, OffloadedItem):
+        lazy_item = OffloadedItem()
+        dict.update(lazy_item, dict.items(item))
+        return lazy_item
+
+    return item
+
+def rehydrate_item(item):
+    '''
+    A plain dict of the item with every offloaded attribute fetched.
+    '''
+    if item is None:
+        return None
+    return {name: unpack_value(value) for name, value in dict.items(item)}
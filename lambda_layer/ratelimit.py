@@ -0,0 +1,189 @@
+'''
+This file includes rate limiting helpers shared by the layer modules.
+'''
+import threading
+import time
+
+class TokenBucket:
+    '''
+    A thread safe token bucket.
+
+    Tokens refill continuously at rate per second, up to capacity (default one second's worth).
+    Callers either take tokens up front with acquire, or wait for the bucket to be
+    non-empty and then consume what they actually used, which lets the balance go
+    negative when the real cost is only known afterwards (e.g. consumed capacity units).
+    '''
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity if capacity is not None else max(rate, 1))
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def set_rate(self, rate, capacity=None, drain=False):
+        '''
+        Change the refill rate (and capacity, default one second's worth). With drain, empty the bucket.
+        '''
+        with self.lock:
+            self.refill()
+            self.rate = float(rate)
+            self.capacity = float(capacity if capacity is not None else max(rate, 1))
+            self.tokens = 0.0 if drain else min(self.tokens, self.capacity)
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount):
+        '''
+        Seconds until amount tokens are available, assuming nobody else takes any.
+        '''
+        with self.lock:
+            self.refill()
+            if self.tokens >= amount:
+                return 0.0
+            return (amount - self.tokens) / self.rate
+
+    def acquire(self, amount=1.0):
+        '''
+        Block until amount tokens are available, then take them.
+        '''
+        while True:
+            with self.lock:
+                self.refill()
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return
+                delay = (amount - self.tokens) / self.rate
+            time.sleep(delay)
+
+    def wait(self):
+        '''
+        Block until the balance is no longer negative, without taking anything.
+        '''
+        while True:
+            delay = self.wait_time(0)
+            if delay <= 0:
+                return
+            time.sleep(delay)
+
+    def consume(self, amount):
+        '''
+        Take amount tokens without waiting. The balance may go negative.
+        '''
+        with self.lock:
+            self.refill()
+            self.tokens -= amount
+
+C_MEASURE_WINDOW_SECS = 0.5
+
+class AdaptiveRateLimiter:
+    '''
+    A client side limit on the send rate that adapts to throttling (additive increase,
+    multiplicative decrease).
+
+    It doesn't limit anything until the first throttle. Then the allowed rate drops to
+    backoff_factor times the rate we were actually sending at (never below min_rate), and
+    climbs back by recovery_rate requests per second for every second without a throttle.
+    Throttles within decrease_interval seconds of a cut are from requests already in flight
+    at the old rate, so they don't cut it again.
+    Limiting switches off again when the rate passes max_rate, or after reset_after seconds
+    without a throttle.
+
+    Call acquire before every request, and on_throttle whenever a request is throttled.
+    '''
+    def __init__(
+        self, min_rate=1.0, backoff_factor=0.7, recovery_rate=5.0, max_rate=None,
+        decrease_interval=1.0, reset_after=60.0
+    ):
+        self.min_rate = float(min_rate)
+        self.backoff_factor = backoff_factor
+        self.recovery_rate = recovery_rate
+        self.decrease_interval = decrease_interval
+        self.max_rate = max_rate
+        self.reset_after = reset_after
+        self.lock = threading.Lock()
+
+        self.limiting = False
+        self.rate = None
+        self.bucket = None
+        self.throttled_at = None
+        self.adjusted_at = None
+
+        # send rate, as an exponentially weighted average over short windows
+        self.measured_rate = None
+        self.window_start = time.monotonic()
+        self.window_count = 0
+
+    def measure(self, now):
+        self.window_count += 1
+        elapsed = now - self.window_start
+        if elapsed >= C_MEASURE_WINDOW_SECS:
+            window_rate = self.window_count / elapsed
+            if self.measured_rate is None:
+                self.measured_rate = window_rate
+            else:
+                self.measured_rate = 0.8 * self.measured_rate + 0.2 * window_rate
+            self.window_start = now
+            self.window_count = 0
+
+    def sending_rate(self, now):
+        if self.measured_rate is not None:
+            return self.measured_rate
+        elapsed = now - self.window_start
+        return self.window_count / elapsed if elapsed > 0 else self.min_rate
+
+    def recover(self, now):
+        self.rate += self.recovery_rate * (now - self.adjusted_at)
+        self.adjusted_at = now
+
+        if (self.max_rate is not None and self.rate >= self.max_rate) or now - self.throttled_at >= self.reset_after:
+            self.limiting = False
+        else:
+            self.bucket.set_rate(self.rate)
+
+    def acquire(self):
+        '''
+        Block until a request may be sent.
+        '''
+        with self.lock:
+            now = time.monotonic()
+            self.measure(now)
+            if not self.limiting:
+                return
+            self.recover(now)
+            bucket = self.bucket if self.limiting else None
+
+        if bucket is not None:
+            bucket.acquire(1)
+
+    def on_throttle(self):
+        '''
+        A request was throttled: cut the allowed rate.
+        '''
+        with self.lock:
+            now = time.monotonic()
+            if self.limiting and now - self.throttled_at < self.decrease_interval:
+                return
+
+            sending_rate = self.sending_rate(now)
+            if self.limiting:
+                sending_rate = min(sending_rate, self.rate)
+
+            self.rate = max(self.min_rate, sending_rate * self.backoff_factor)
+            self.limiting = True
+            self.throttled_at = now
+            self.adjusted_at = now
+
+            if self.bucket is None:
+                self.bucket = TokenBucket(self.rate)
+            self.bucket.set_rate(self.rate, drain=True)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'limiting': self.limiting,
+                'rate': self.rate if self.limiting else None,
+                'measured_rate': self.measured_rate,
+            }
@@ -0,0 +1,11 @@
+'''
+This file includes retry helpers shared by the layer modules (ddb.py, enqueue.py).
+'''
+import random
+import time
+
+def backoff_sleep(attempt, base=0.05, cap=5.0):
+    '''
+    Sleep for a jittered exponential backoff ("full jitter") before retry number attempt.
+    '''
+    time.sleep(random.uniform(0, min(cap, base * (2 ** attempt))))
@@ -3,7 +3,10 @@ import os
 import json
 import base64
 from fastapi import HTTPException
-import boto3
+from enqueue import enqueue_message
+# cache_result lives in memo.py now (bounded, expiring and thread safe), and is re-exported here
+from memo import cache_result
+from log import get_logger
 
 # dynamodb_client.create_table(
 #     TableName=TableName,
@@ -113,12 +116,16 @@ import boto3
 
 # the ttl attribute is called 'ttl'
 
+logger = get_logger('shared')
+
 C_DOMAIN_NAME = os.environ['domain_name']
 
 C_ACCESSTOKEN = "AT"
 
 C_USER = "U"
 C_SPELUNK = "S"
+C_SPELUNK_ALIAS = "SA"
+C_SPELUNK_WORK = "SW"
 
 def safe_id(id):
     # only allow alphanumeric characters and underscores
@@ -168,19 +175,15 @@ def normalize_url(url):
 def calc_spelunk_pkey(spelunk_id):
     return f"{C_SPELUNK}*{safe_id(spelunk_id)}"
 
-# the following function is a decorator that caches the result of the function
-# in a global dictionary.
-# the function is decorated with @cache_result
+def calc_spelunk_alias_pkey(alias_id):
+    return f"{C_SPELUNK_ALIAS}*{safe_id(alias_id)}"
 
-CACHE = {} 
+def calc_spelunk_work_l3_pkey():
+    return f"{C_SPELUNK_WORK}*pending"
 
-def cache_result(func):
-    def wrapper(*args, **kwargs):
-        key = (func.__name__, args, frozenset(kwargs.items()))
-        if key not in CACHE:
-            CACHE[key] = func(*args, **kwargs)
-        return CACHE[key]
-    return wrapper
+def calc_spelunk_work_l3_skey(check_at, spelunk_id):
+    # zero padded, so the index sorts by time
+    return f"{int(check_at):010d}*{safe_id(spelunk_id)}"
 
 import traceback
 def exc_to_string(exc):
@@ -198,17 +201,19 @@ def flatten_for_api(d):
 def remove_none_attribs(d):
     return {k: v for k, v in d.items() if v is not None}
 
-def process_op_in_blambda(group_id, op, detail_dict):
-    print (f"process_op_in_blambda: {group_id}, {op}, {detail_dict}")
-    queue_url = os.environ['queue_url']
-
-    sqs = boto3.client('sqs')
+def process_op_in_blambda(group_id, op, detail_dict, on_failed=None):
+    '''
+    Queue op for the blambda. The message is buffered (see enqueue.py) and sent in a batch
+    when the request or job finishes, so callers don't wait on SQS.
+    on_failed is called if the message can't be sent.
+    '''
+    logger.info('process_op_in_blambda', group_id=group_id, op=op, detail=detail_dict)
 
-    _ = sqs.send_message(
-        QueueUrl=queue_url,
-        MessageGroupId=group_id,
-        MessageBody=json.dumps({
+    enqueue_message(
+        json.dumps({
             "op": op,
             "detail": detail_dict
-        })
+        }),
+        group_id=group_id,
+        on_failed=on_failed
     )
@@ -1,11 +1,23 @@
 from pydantic import BaseModel
 from typing import Dict, Optional
-from shared import project_dict, calc_spelunk_pkey, str_to_hashed_id, normalize_url
-from ddb import get_item, put_item, query, delete_item, update_item
+from shared import project_dict, calc_spelunk_pkey, calc_spelunk_alias_pkey, str_to_hashed_id, normalize_url, \
+    process_op_in_blambda, C_SPELUNK, calc_spelunk_work_l3_pkey, calc_spelunk_work_l3_skey
+from ddb import get_item, query_iter, update_item, DocumentPaths, is_conditional_check_failed, Transaction, \
+    TransactionCanceledError, parallel_scan, C_VERSION_ATTRIBUTE
+from ratelimit import TokenBucket
 import uuid
 import time
-from youtube import is_youtube_url, get_youtube_data, get_youtube_transcript_url, get_youtube_summary_url
+from youtube import get_youtube_id, get_youtube_canonical_url, get_youtube_data, get_transcript_s3_key, get_summary_s3_key, \
+    presign_s3_url_async
+from memo import cache_result
+from aio import to_async
+from offload import register_offload_policy
+import asyncio
 import os
+import threading
+from log import get_logger
+
+logger = get_logger('spelunk')
 
 # the dynamo record will have these attributes:
 # pkey: string
@@ -20,6 +32,19 @@ import os
 #   lens_url: string
 #   lens_type: string
 #   lens_status: string
+#   started_at: unix timestamp, when the lens was last claimed
+#   owner: string, the worker holding the lens lease (while underway)
+#   lease_expires: unix timestamp, after which another worker may take the lens over
+# enqueued_at: unix timestamp, when process_spelunk was last queued
+# enqueue_lease_expires: unix timestamp, until when nobody else should queue it
+# l3_pkey: string (SW*pending), only while the spelunk has unfinished lenses (see reap_stuck_spelunks)
+# l3_skey: string (check_at*id), check_at being when the reaper should look at it if nothing else has
+#
+# spelunks are keyed by video (see calc_spelunk_id). alias records point other ids at them:
+# pkey: string (SA*alias_id)
+# alias_id: string
+# spelunk_id: string
+# created_at: unix timestamp
 
 C_STATUS_PREPARING = 'preparing'
 C_STATUS_UNDERWAY = 'underway'
@@ -28,6 +53,35 @@ C_STATUS_ERROR = 'error'
 
 C_CURRENT_VERSION = 1
 
+C_LENS_NAMES = ('source', 'transcript', 'summary')
+
+# the lens fields a status check needs (see get_spelunk_status). not message, which holds
+# the whole traceback when a lens fails; the full record (GET /{spelunk_id}) has it.
+C_LENS_STATUS_FIELDS = ('status', 'started_at', 'lease_expires')
+
+# a worker computing a lens holds a lease on it, extended by heartbeats while it works.
+# if the worker dies, the lens can be taken over once the lease expires.
+C_LENS_LEASE_SECS = int(os.environ.get('lens_lease_secs', 300))
+
+# lenses marked underway before there were leases have no lease_expires, and are taken to
+# have been abandoned this long after started_at
+C_LENS_STALE_SECS = 900
+
+# the sparse index of unfinished spelunks, by when they should be finished or checked on
+C_WORK_INDEX = 'lookup3'
+
+# per reaper run
+C_REAP_MAX_ITEMS = 1000
+C_REAP_REQUEUE_RATE = 10
+
+# how long a queued process_spelunk holds off others queuing it again. long enough for the
+# blambda to pick it up and mark the lenses underway, after which it doesn't need processing.
+C_ENQUEUE_LEASE_SECS = int(os.environ.get('enqueue_lease_secs', 300))
+
+# overviews can grow large (e.g. inline summaries), so compress them, and spill really big
+# ones to s3. lenses are updated at nested paths (lenses.summary.status), so they can't be offloaded.
+register_offload_policy('overview')
+
 class Lens(BaseModel):
     status: str
     # url is optional
@@ -53,7 +107,7 @@ class Spelunk(BaseModel):
     lenses: Dict[str, Lens]
  
     def __init__(self, **data):
-        print (data)
+        logger.debug('Spelunk', data=data)
         super().__init__(**data)
         self.id = data.get('id')
         self.version = data.get('version')
@@ -64,6 +118,14 @@ class Spelunk(BaseModel):
         self.updated_at = data.get('updated_at')
         self.lenses = {key: Lens(**value) for key, value in data.get('lenses').items()}
 
+class LensStatus(BaseModel):
+    status: str
+
+class SpelunkStatus(BaseModel):
+    id: str
+    updated_at: Optional[int]
+    lenses: Dict[str, LensStatus]
+
 def spelunk_rec_to_api(spelunk_rec):
     api_obj = {
         **project_dict(
@@ -82,23 +144,45 @@ def spelunk_rec_to_api(spelunk_rec):
 
     return Spelunk(**api_obj)
 
+def calc_spelunk_id(youtube_id):
+    # every form of a video's url (youtu.be, shorts, embed, &t=...) is the same spelunk
+    return str_to_hashed_id(f'youtube:{youtube_id}')
+
+def calc_legacy_spelunk_id(url):
+    # spelunks used to be keyed by the normalized url
+    return str_to_hashed_id(normalize_url(url))
+
+def make_spelunk_alias_item(alias_id, spelunk_id, now):
+    return {
+        'pkey': calc_spelunk_alias_pkey(alias_id),
+        'alias_id': alias_id,
+        'spelunk_id': spelunk_id,
+        'created_at': now,
+    }
+
+# aliases never change once written, so they're kept as long as the container lives
+@cache_result(max_size=1024, ttl=None, cache_none=False)
+def resolve_spelunk_alias(alias_id):
+    item = get_item(os.environ['table_name'], calc_spelunk_alias_pkey(alias_id)).get('Item')
+
+    return item['spelunk_id'] if item else None
+
 def create_spelunk_rec_from_url(url):
     # first test if this is a youtube url
     # if so, create a spelunk record with the youtube url
     # and return the spelunk record
 
-    if not is_youtube_url(url):
+    youtube_id = get_youtube_id(url)
+
+    if not youtube_id:
         raise Exception('Not a valid youtube url')
-    
-    # normalize the url
-    norm_url = normalize_url(url)
 
-    id = str_to_hashed_id(norm_url)
+    id = calc_spelunk_id(youtube_id)
 
-    # before proceeding, check if this spelunk already exists
+    # before proceeding, check if this spelunk already exists (maybe under an alias)
     # if so, return the existing spelunk
 
-    spelunk_rec = get_spelunk_rec(id)
+    spelunk_rec = get_spelunk_rec(id, use_cache=True)
 
     if spelunk_rec:
         return spelunk_rec
@@ -109,7 +193,23 @@ def create_spelunk_rec_from_url(url):
 
     now = int(time.time())
 
-    youtube_data = get_youtube_data(url)
+    legacy_id = calc_legacy_spelunk_id(url)
+
+    # a spelunk made for this url before spelunks were keyed by video is adopted, not redone
+    legacy_rec = get_spelunk_rec(legacy_id)
+
+    if legacy_rec and legacy_rec['id'] == legacy_id:
+        try:
+            (Transaction()
+                .put(table_name, make_spelunk_alias_item(id, legacy_id, now), condition_expression='attribute_not_exists(pkey)')
+                .condition_check(table_name, pkey, 'attribute_not_exists(pkey)')
+                .execute())
+        except TransactionCanceledError:
+            return get_spelunk_rec(id)
+
+        return legacy_rec
+
+    youtube_data = get_youtube_data(get_youtube_canonical_url(youtube_id))
 
     item = {
         'pkey': pkey,
@@ -132,94 +232,555 @@ def create_spelunk_rec_from_url(url):
             'summary': {
                 'status': C_STATUS_PREPARING,
             }
-        }
+        },
+        # if nobody has queued it by then, the reaper will
+        **spelunk_work_index_attribs(id, now + C_ENQUEUE_LEASE_SECS)
     }
 
-    put_item(table_name, item)
+    try:
+        # versioned, so if someone else created it in the meantime we keep theirs
+        (Transaction()
+            .put(table_name, item, versioned=True)
+            # so this url's old style id finds the spelunk too
+            .put(table_name, make_spelunk_alias_item(legacy_id, id, now))
+            # and nobody adopted an older spelunk for the video in the meantime
+            .condition_check(table_name, calc_spelunk_alias_pkey(id), 'attribute_not_exists(pkey)')
+            .execute())
+    except TransactionCanceledError:
+        return get_spelunk_rec(id)
 
     return item
 
-def create_spelunk_from_url(url, s3_bucket):
-    spelunk_rec = create_spelunk_rec_from_url(url)
-
-    spelunk_rec = add_temporary_urls_to_spelunk_rec(spelunk_rec, s3_bucket)
-
-    return Spelunk(**spelunk_rec)
-
-def get_spelunk_rec(spelunk_id):
+def get_spelunk_item(spelunk_id, **kwargs):
+    # the spelunk's record, following an alias if there's no spelunk with that id.
+    # kwargs are get_item's
     table_name = os.environ['table_name']
 
-    pkey = calc_spelunk_pkey(spelunk_id)
-
-    item = get_item(table_name, pkey)
+    item = get_item(table_name, calc_spelunk_pkey(spelunk_id), **kwargs).get('Item')
 
-    spelunk_rec = item.get('Item')
+    if not item:
+        alias_target_id = resolve_spelunk_alias(spelunk_id)
+        if alias_target_id and alias_target_id != spelunk_id:
+            item = get_item(table_name, calc_spelunk_pkey(alias_target_id), **kwargs).get('Item')
 
-    if not spelunk_rec:
-        return None
-    
-    return spelunk_rec
-
-def get_spelunk_by_id(spelunk_id, s3_bucket):
-    spelunk_rec = get_spelunk_rec(spelunk_id)
+    return item
 
-    if not spelunk_rec:
-        return None
-    
-    spelunk_rec = add_temporary_urls_to_spelunk_rec(spelunk_rec, s3_bucket)
+def get_spelunk_rec(spelunk_id, use_cache=False):
+    # with use_cache, settled spelunks are served from the in-process item cache
+    return get_spelunk_item(spelunk_id, use_cache=use_cache, cache_if=spelunk_rec_is_settled) or None
+
+def get_spelunk_status(spelunk_id, consistent=False):
+    # just the id and the lens status fields, which is all spelunk_rec_needs_processing looks at.
+    # the projection keeps the payload small; dynamodb still bills the read on the whole item.
+    paths = DocumentPaths()
+    projection_expression = ', '.join(
+        [paths.path('id'), paths.path('updated_at'), paths.path('enqueue_lease_expires')] +
+        [paths.path(('lenses', lens_name, field)) for lens_name in C_LENS_NAMES for field in C_LENS_STATUS_FIELDS]
+    )
+
+    return get_spelunk_item(
+        spelunk_id, consistent=consistent,
+        projection_expression=projection_expression,
+        expression_attribute_names=paths.names
+    )
+
+def spelunk_status_to_api(status_rec):
+    return SpelunkStatus(
+        id=status_rec['id'],
+        updated_at=status_rec.get('updated_at'),
+        lenses={
+            lens_name: LensStatus(status=lens.get('status'))
+            for lens_name, lens in (status_rec.get('lenses') or {}).items()
+        }
+    )
 
-    return Spelunk(**spelunk_rec)
+def spelunk_rec_is_settled(spelunk_rec):
+    # once every lens is ready or in error, nothing will change the record again
+    lenses = spelunk_rec.get('lenses') or {}
+    return all(lens.get('status') in (C_STATUS_READY, C_STATUS_ERROR) for lens in lenses.values())
 
 def spelunk_rec_needs_processing(spelunk_rec):
     return spelunk_rec_needs_transcript(spelunk_rec) or spelunk_rec_needs_summary(spelunk_rec)
 
-def spelunk_rec_needs_transcript(spelunk_rec):
-    lens = spelunk_rec['lenses']['transcript']
-    
+def spelunk_lens_lease_expired(lens, now=None):
+    now = now or time.time()
+
     try:
-        started_at = int(lens.get('started_at')) or 0
-    except:
+        lease_expires = int(lens.get('lease_expires') or 0)
+    except (TypeError, ValueError):
+        lease_expires = 0
+
+    if lease_expires:
+        return lease_expires <= now
+
+    try:
+        started_at = int(lens.get('started_at') or 0)
+    except (TypeError, ValueError):
         started_at = 0
 
-    # we need the transcript if it's in the preparing state, or in the underway state and the started_at timestamp is more than 15 minutes ago
-    return lens['status'] == C_STATUS_PREPARING or (lens['status'] == C_STATUS_UNDERWAY and started_at > 900)
+    return started_at + C_LENS_STALE_SECS <= now
+
+def spelunk_rec_needs_lens(spelunk_rec, lens_name):
+    lens = spelunk_rec['lenses'][lens_name]
+
+    # we need the lens if it's in the preparing state, or in the underway state and whoever was working on it has let the lease expire
+    return lens['status'] == C_STATUS_PREPARING or (lens['status'] == C_STATUS_UNDERWAY and spelunk_lens_lease_expired(lens))
+
+def spelunk_rec_needs_transcript(spelunk_rec):
+    return spelunk_rec_needs_lens(spelunk_rec, 'transcript')
 
 def spelunk_rec_needs_summary(spelunk_rec):
-    lens = spelunk_rec['lenses']['summary']
+    return spelunk_rec_needs_lens(spelunk_rec, 'summary')
 
+def spelunk_work_index_attribs(spelunk_id, check_at):
+    # the attributes that put a spelunk in the work index, due to be checked at check_at
+    return {
+        'l3_pkey': calc_spelunk_work_l3_pkey(),
+        'l3_skey': calc_spelunk_work_l3_skey(check_at, spelunk_id),
+    }
+
+def spelunk_work_index_paths(spelunk_id, check_at):
+    return {(name,): value for name, value in spelunk_work_index_attribs(spelunk_id, check_at).items()}
+
+def reschedule_spelunk_work(spelunk_id, check_at):
+    # move a spelunk that's in the work index to check_at. one that has left it stays out.
     try:
-        started_at = int(lens.get('started_at')) or 0
-    except:
-        started_at = 0
+        update_item(
+            os.environ['table_name'],
+            pkey=calc_spelunk_pkey(spelunk_id),
+            set_value=spelunk_work_index_attribs(spelunk_id, check_at),
+            condition_expression='attribute_exists(#_l3_pkey)',
+            expression_attribute_names={'#_l3_pkey': 'l3_pkey'},
+            return_values='NONE'
+        )
+    except Exception as e:
+        if not is_conditional_check_failed(e):
+            raise
 
-    # we need the summary if it's in the preparing state, or in the underway state and the started_at timestamp is more than 15 minutes ago
-    return lens['status'] == C_STATUS_PREPARING or (lens['status'] == C_STATUS_UNDERWAY and started_at > 900)
+def remove_spelunk_from_work_index(spelunk_id):
+    # once a spelunk is settled there's nothing for the reaper to do
+    try:
+        update_item(
+            os.environ['table_name'],
+            pkey=calc_spelunk_pkey(spelunk_id),
+            remove_list=['l3_pkey', 'l3_skey'],
+            condition_expression='attribute_exists(#_pkey)',
+            expression_attribute_names={'#_pkey': 'pkey'},
+            return_values='NONE'
+        )
+    except Exception as e:
+        if not is_conditional_check_failed(e):
+            raise
+
+def update_spelunk_lens_if(spelunk_id, condition, condition_expression, set_paths=None, remove_paths=None, return_values='ALL_NEW'):
+    # conditionally update lens paths. condition is the DocumentPaths the condition_expression was built with.
+    # bumps the version, so a versioned write based on an earlier read fails rather than undo us.
+    # returns the record if the condition held, None if it didn't.
+    try:
+        response = update_item(
+            os.environ['table_name'],
+            pkey=calc_spelunk_pkey(spelunk_id),
+            set_paths=set_paths,
+            remove_paths=remove_paths,
+            add_value={C_VERSION_ATTRIBUTE: 1},
+            condition_expression=condition_expression,
+            expression_attribute_names=condition.names,
+            expression_attribute_values=condition.values,
+            return_values=return_values
+        )
+    except Exception as e:
+        if is_conditional_check_failed(e):
+            return None
+        raise
+
+    return response.get('Attributes') or {}
 
-def update_spelunk_rec(spelunk_rec):
-    # copy the spelunk record
-    spelunk_rec_copy = spelunk_rec.copy()
+def claim_spelunk_lens(spelunk_id, lens_name, owner, lease_secs=C_LENS_LEASE_SECS):
+    # mark the lens underway with owner holding the lease, if it's preparing or its lease has expired.
+    # of any number of concurrent workers, only one gets it. returns the record, or None.
+    now = int(time.time())
+    lens_path = ('lenses', lens_name)
+
+    condition = DocumentPaths(prefix='_c')
+    status = condition.path(lens_path + ('status',))
+    lease_expires = condition.path(lens_path + ('lease_expires',))
+    started_at = condition.path(lens_path + ('started_at',))
+
+    condition_expression = (
+        f'{status} = {condition.value(C_STATUS_PREPARING)} OR ({status} = {condition.value(C_STATUS_UNDERWAY)} AND ('
+        f'{lease_expires} <= {condition.value(now)} OR (attribute_not_exists({lease_expires}) AND '
+        f'(attribute_not_exists({started_at}) OR {started_at} <= {condition.value(now - C_LENS_STALE_SECS)}))))'
+    )
+
+    return update_spelunk_lens_if(
+        spelunk_id, condition, condition_expression,
+        set_paths={
+            lens_path + ('status',): C_STATUS_UNDERWAY,
+            lens_path + ('started_at',): now,
+            lens_path + ('owner',): owner,
+            lens_path + ('lease_expires',): now + lease_secs,
+            # if we die, the reaper will look at it when the lease expires
+            **spelunk_work_index_paths(spelunk_id, now + lease_secs),
+        },
+        remove_paths=[lens_path + ('message',)]
+    )
+
+def owner_condition(lens_name, owner):
+    lens_path = ('lenses', lens_name)
+
+    condition = DocumentPaths(prefix='_c')
+    condition_expression = (
+        f'{condition.path(lens_path + ("owner",))} = {condition.value(owner)} AND '
+        f'{condition.path(lens_path + ("status",))} = {condition.value(C_STATUS_UNDERWAY)}'
+    )
+
+    return condition, condition_expression
+
+def extend_spelunk_lens_lease(spelunk_id, lens_name, owner, lease_secs=C_LENS_LEASE_SECS):
+    # heartbeat: push the lease expiry out, if owner still holds it. returns whether it does.
+    condition, condition_expression = owner_condition(lens_name, owner)
+    lease_expires = int(time.time()) + lease_secs
+
+    return update_spelunk_lens_if(
+        spelunk_id, condition, condition_expression,
+        set_paths={
+            ('lenses', lens_name, 'lease_expires'): lease_expires,
+            **spelunk_work_index_paths(spelunk_id, lease_expires),
+        },
+        return_values='NONE'
+    ) is not None
+
+def finish_spelunk_lens(spelunk_id, lens_name, owner, status, message=None):
+    # set the lens' final status and give up the lease, if owner still holds it.
+    # returns the record, or None if someone else has taken the lens over.
+    lens_path = ('lenses', lens_name)
+    condition, condition_expression = owner_condition(lens_name, owner)
+
+    spelunk_rec = update_spelunk_lens_if(
+        spelunk_id, condition, condition_expression,
+        set_paths={
+            lens_path + ('status',): status,
+            **({lens_path + ('message',): message} if message is not None else {}),
+        },
+        remove_paths=[lens_path + ('owner',), lens_path + ('lease_expires',)]
+    )
+
+    if spelunk_rec and spelunk_rec_is_settled(spelunk_rec):
+        remove_spelunk_from_work_index(spelunk_id)
 
-    pkey = spelunk_rec_copy.get('pkey') or calc_spelunk_pkey(spelunk_rec_copy['id'])
-    # updated = spelunk_rec.get('updated_at')
-    if 'pkey' in spelunk_rec_copy:
-        del spelunk_rec_copy['pkey']
+    return spelunk_rec
 
-    # # need a conditional update that checks the updated_at timestamp
-    # condition_expression = 'updated_at = :updated_at'
-    # expression_attribute_values = {':updated_at': updated}
+class SpelunkLensLease:
+    # a lease on one lens, for computing it:
+    #
+    #   with SpelunkLensLease(spelunk_id, 'summary') as lease:
+    #       if lease.spelunk_rec is not None:
+    #           ... compute the summary ...
+    #           lease.finish(C_STATUS_READY)
+    #
+    # entering claims the lens (spelunk_rec is None if someone else holds it), and while the
+    # lease is held a background thread heartbeats it every heartbeat_secs. if the lease is lost
+    # (we stalled past its expiry and someone took over), lost is set and finish does nothing.
+    def __init__(self, spelunk_id, lens_name, lease_secs=C_LENS_LEASE_SECS, heartbeat_secs=None):
+        self.spelunk_id = spelunk_id
+        self.lens_name = lens_name
+        self.lease_secs = lease_secs
+        self.heartbeat_secs = heartbeat_secs or lease_secs / 3
+        self.owner = uuid.uuid4().hex
+        self.spelunk_rec = None
+        self.lost = False
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def __enter__(self):
+        self.spelunk_rec = claim_spelunk_lens(self.spelunk_id, self.lens_name, self.owner, self.lease_secs)
+
+        if self.spelunk_rec is not None:
+            self.thread = threading.Thread(target=self.heartbeat, name=f'lease-{self.lens_name}', daemon=True)
+            self.thread.start()
+
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.stop_heartbeat()
+        return False
+
+    def heartbeat(self):
+        while not self.stopped.wait(self.heartbeat_secs):
+            try:
+                if not extend_spelunk_lens_lease(self.spelunk_id, self.lens_name, self.owner, self.lease_secs):
+                    self.lost = True
+                    logger.warning('lens lease lost', spelunk_id=self.spelunk_id, lens_name=self.lens_name)
+                    return
+            except Exception as e:
+                # try again next beat, the lease has a couple of beats of slack
+                logger.warning('lens lease heartbeat failed', spelunk_id=self.spelunk_id, lens_name=self.lens_name, exc=e)
+
+    def stop_heartbeat(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def finish(self, status, message=None):
+        self.stop_heartbeat()
+
+        spelunk_rec = finish_spelunk_lens(self.spelunk_id, self.lens_name, self.owner, status, message=message)
+
+        if spelunk_rec is None:
+            self.lost = True
+            logger.warning('lens lease lost before finishing', spelunk_id=self.spelunk_id, lens_name=self.lens_name, status=status)
+        else:
+            self.spelunk_rec = spelunk_rec
 
-    update_item(os.environ['table_name'], pkey=pkey, set_value=spelunk_rec_copy) #, condition_expression=condition_expression, expression_attribute_values=expression_attribute_values)
+        return spelunk_rec
 
-def add_temporary_urls_to_spelunk_rec(spelunk_rec, s3_bucket):
-    # add temporary urls to the spelunk record
-    # this is used for testing
+def alias_legacy_spelunks(max_capacity_per_second=None):
+    # one off backfill for spelunks made before they were keyed by video: alias each video's id
+    # to its spelunk, so any form of the url finds it. where there are several for a video,
+    # the first one aliased wins. returns counts.
+    table_name = os.environ['table_name']
 
-    # if the transcript is ready, add a temporary url
+    paths = DocumentPaths()
+    spelunk_recs = parallel_scan(
+        table_name,
+        projection_expression=', '.join([paths.path('id'), paths.path(('lenses', 'source', 'url'))]),
+        filter_expression=f'begins_with({paths.path("pkey")}, {paths.value(f"{C_SPELUNK}*")})',
+        expression_attribute_names=paths.names,
+        expression_attribute_values=paths.values,
+        max_capacity_per_second=max_capacity_per_second
+    )
+
+    counts = {'scanned': 0, 'aliased': 0, 'skipped': 0}
+
+    for spelunk_rec in spelunk_recs:
+        counts['scanned'] += 1
+
+        url = ((spelunk_rec.get('lenses') or {}).get('source') or {}).get('url')
+        youtube_id = get_youtube_id(url) if url else None
+        id = calc_spelunk_id(youtube_id) if youtube_id else None
+
+        if not id or id == spelunk_rec['id']:
+            counts['skipped'] += 1
+            continue
+
+        try:
+            (Transaction()
+                .put(table_name, make_spelunk_alias_item(id, spelunk_rec['id'], int(time.time())), condition_expression='attribute_not_exists(pkey)')
+                .condition_check(table_name, calc_spelunk_pkey(id), 'attribute_not_exists(pkey)')
+                .execute())
+            counts['aliased'] += 1
+        except TransactionCanceledError:
+            counts['skipped'] += 1
+
+    logger.info('alias_legacy_spelunks', **counts)
+
+    return counts
+
+def index_unsettled_spelunks(max_capacity_per_second=None):
+    # one off backfill for spelunks made before the work index: put each unsettled one in it,
+    # due now, so the reaper picks up any that are stuck. returns counts.
+    table_name = os.environ['table_name']
+    now = int(time.time())
+
+    paths = DocumentPaths()
+    spelunk_recs = parallel_scan(
+        table_name,
+        projection_expression=', '.join(
+            [paths.path('id')] +
+            [paths.path(('lenses', lens_name, 'status')) for lens_name in C_LENS_NAMES]
+        ),
+        filter_expression=(
+            f'begins_with({paths.path("pkey")}, {paths.value(f"{C_SPELUNK}*")}) AND '
+            f'attribute_not_exists({paths.path("l3_pkey")})'
+        ),
+        expression_attribute_names=paths.names,
+        expression_attribute_values=paths.values,
+        max_capacity_per_second=max_capacity_per_second
+    )
+
+    counts = {'scanned': 0, 'indexed': 0, 'settled': 0, 'skipped': 0}
+
+    for spelunk_rec in spelunk_recs:
+        counts['scanned'] += 1
+
+        if spelunk_rec_is_settled(spelunk_rec):
+            counts['settled'] += 1
+            continue
+
+        try:
+            update_item(
+                table_name,
+                pkey=calc_spelunk_pkey(spelunk_rec['id']),
+                set_value=spelunk_work_index_attribs(spelunk_rec['id'], now),
+                # if it's been indexed since the scan read it, that's newer than what we'd write
+                condition_expression='attribute_exists(#_pkey) AND attribute_not_exists(#_l3_pkey)',
+                expression_attribute_names={'#_pkey': 'pkey', '#_l3_pkey': 'l3_pkey'},
+                return_values='NONE'
+            )
+            counts['indexed'] += 1
+        except Exception as e:
+            if not is_conditional_check_failed(e):
+                raise
+            counts['skipped'] += 1
+
+    logger.info('index_unsettled_spelunks', **counts)
+
+    return counts
+
+def spelunk_rec_has_enqueue_lease(spelunk_rec, now=None):
+    # whether process_spelunk was queued recently enough that it shouldn't be queued again
+    try:
+        lease_expires = int(spelunk_rec.get('enqueue_lease_expires') or 0)
+    except (TypeError, ValueError):
+        lease_expires = 0
+
+    return lease_expires > (now or time.time())
+
+def claim_spelunk_enqueue_lease(spelunk_id, lease_secs=C_ENQUEUE_LEASE_SECS):
+    # conditional write, so of any number of concurrent pollers only one gets the lease.
+    # returns the lease's enqueued_at if we got it, otherwise None.
+    now = int(time.time())
+
+    try:
+        update_item(
+            os.environ['table_name'],
+            pkey=calc_spelunk_pkey(spelunk_id),
+            set_value={
+                'enqueued_at': now,
+                'enqueue_lease_expires': now + lease_secs,
+                # if the message is lost, the reaper will queue it again when the lease expires
+                **spelunk_work_index_attribs(spelunk_id, now + lease_secs),
+            },
+            condition_expression='attribute_exists(#_pkey) AND (attribute_not_exists(#enqueue_lease_expires) OR #enqueue_lease_expires <= :_now)',
+            expression_attribute_names={'#_pkey': 'pkey'},
+            expression_attribute_values={':_now': now},
+            return_values='NONE'
+        )
+        return now
+    except Exception as e:
+        if is_conditional_check_failed(e):
+            return None
+        raise
+
+def release_spelunk_enqueue_lease(spelunk_id, enqueued_at):
+    # give up the enqueue lease taken at enqueued_at, when its message couldn't be sent, so the
+    # next poll queues it again. it's due in the work index now, so the reaper will if nobody polls.
+    now = int(time.time())
+
+    try:
+        update_item(
+            os.environ['table_name'],
+            pkey=calc_spelunk_pkey(spelunk_id),
+            set_value=spelunk_work_index_attribs(spelunk_id, now),
+            remove_list=['enqueued_at', 'enqueue_lease_expires'],
+            condition_expression='#_enqueued_at = :_enqueued_at',
+            expression_attribute_names={'#_enqueued_at': 'enqueued_at'},
+            expression_attribute_values={':_enqueued_at': enqueued_at},
+            return_values='NONE'
+        )
+        logger.warning('process_spelunk not queued, enqueue lease released', spelunk_id=spelunk_id)
+    except Exception as e:
+        if not is_conditional_check_failed(e):
+            raise
+
+def enqueue_spelunk_processing(spelunk_rec):
+    # queue process_spelunk for a record that needs processing, unless it's already queued.
+    # spelunk_rec can be a full record or a status record (see get_spelunk_status).
+    # returns whether it was queued.
+    spelunk_id = spelunk_rec['id']
+
+    # a lease we can already see saves the write
+    if spelunk_rec_has_enqueue_lease(spelunk_rec):
+        return False
+
+    enqueued_at = claim_spelunk_enqueue_lease(spelunk_id)
+    if enqueued_at is None:
+        logger.debug('process_spelunk already queued', spelunk_id=spelunk_id)
+        return False
+
+    process_op_in_blambda(
+        spelunk_id, 'process_spelunk', {"spelunk_id": spelunk_id},
+        on_failed=lambda: release_spelunk_enqueue_lease(spelunk_id, enqueued_at)
+    )
+    return True
+
+def spelunk_rec_next_lease_expiry(spelunk_rec):
+    # when the first lease on an underway lens runs out
+    expiries = [
+        int(lens.get('lease_expires') or 0) or int(lens.get('started_at') or 0) + C_LENS_STALE_SECS
+        for lens in (spelunk_rec.get('lenses') or {}).values()
+        if lens.get('status') == C_STATUS_UNDERWAY
+    ]
+    return min(expiries) if expiries else None
+
+def reap_stuck_spelunks(max_items=C_REAP_MAX_ITEMS, requeue_rate=C_REAP_REQUEUE_RATE):
+    # requeue spelunks whose processing was lost (the message went missing, or the worker died).
+    # unfinished spelunks are in the work index (lookup3) keyed by when they're due to be checked,
+    # so this is a query for the overdue ones rather than a scan. requeues are rate limited to
+    # requeue_rate per second, and go out in batches through the enqueue buffer. returns counts.
+    table_name = os.environ['table_name']
+    now = int(time.time())
+
+    spelunk_recs = query_iter(
+        table_name, calc_spelunk_work_l3_pkey(), pkey_name='l3_pkey', index_name=C_WORK_INDEX,
+        key_condition_expression='#_l3_skey < :_due_before',
+        expression_attribute_names={'#_l3_skey': 'l3_skey'},
+        expression_attribute_values={':_due_before': calc_spelunk_work_l3_skey(now + 1, '')},
+        max_items=max_items
+    )
+
+    limiter = TokenBucket(requeue_rate)
+
+    counts = {'overdue': 0, 'requeued': 0, 'already_queued': 0, 'underway': 0, 'settled': 0, 'failed': 0}
+
+    for spelunk_rec in spelunk_recs:
+        counts['overdue'] += 1
+        spelunk_id = spelunk_rec['id']
+
+        try:
+            if spelunk_rec_is_settled(spelunk_rec):
+                remove_spelunk_from_work_index(spelunk_id)
+                counts['settled'] += 1
+            elif spelunk_rec_needs_processing(spelunk_rec):
+                limiter.acquire()
+                if enqueue_spelunk_processing(spelunk_rec):
+                    counts['requeued'] += 1
+                else:
+                    # queued by someone else since the index was written, check again when that lease runs out
+                    reschedule_spelunk_work(spelunk_id, max(int(spelunk_rec.get('enqueue_lease_expires') or 0), now + C_ENQUEUE_LEASE_SECS))
+                    counts['already_queued'] += 1
+            else:
+                # a worker is on it, check again when its lease runs out
+                reschedule_spelunk_work(spelunk_id, spelunk_rec_next_lease_expiry(spelunk_rec) or now + C_LENS_LEASE_SECS)
+                counts['underway'] += 1
+        except Exception as e:
+            logger.error('failed to reap spelunk', spelunk_id=spelunk_id, exc=e)
+            counts['failed'] += 1
+
+    logger.info('reap_stuck_spelunks', **counts)
+
+    return counts
+
+def add_signed_urls_to_spelunk_rec(spelunk_rec, transcript_url, summary_url):
+    # add the signed urls of the lenses that are ready
     if spelunk_rec['lenses']['transcript']['status'] == C_STATUS_READY:
-        spelunk_rec['lenses']['transcript']['url'] = get_youtube_transcript_url(spelunk_rec, s3_bucket)
+        spelunk_rec['lenses']['transcript']['url'] = transcript_url
 
-    # if the summary is ready, add a temporary url
     if spelunk_rec['lenses']['summary']['status'] == C_STATUS_READY:
-        spelunk_rec['lenses']['summary']['url'] = get_youtube_summary_url(spelunk_rec, s3_bucket)
+        spelunk_rec['lenses']['summary']['url'] = summary_url
+
+    return spelunk_rec
 
-    return spelunk_rec
\ No newline at end of file
+async def sign_spelunk_lens_urls_async(spelunk_id, s3_bucket):
+    # signing is local, so the urls can be made before we know the lenses are ready
+    return await asyncio.gather(
+        presign_s3_url_async(s3_bucket, get_transcript_s3_key(spelunk_id)),
+        presign_s3_url_async(s3_bucket, get_summary_s3_key(spelunk_id))
+    )
+
+# async variants, for the API handlers (see aio.py)
+get_spelunk_rec_async = to_async(get_spelunk_rec)
+get_spelunk_status_async = to_async(get_spelunk_status)
+create_spelunk_rec_from_url_async = to_async(create_spelunk_rec_from_url)
+enqueue_spelunk_processing_async = to_async(enqueue_spelunk_processing)
@@ -1,45 +1,81 @@
 from py_youtube import Data
 from youtube_transcript_api import YouTubeTranscriptApi
 from urllib.parse import urlparse, parse_qs
-import boto3
+from clients import get_client
+from aio import to_async
+from memo import cache_result
 import json
-from shared import exc_to_string
 import openai
 import os
+import re
+from log import get_logger
+
+logger = get_logger('youtube')
 
 openai.api_key = os.environ['openai_api_key']
 
+# youtube.com also covers www., m. and music.
+C_YOUTUBE_HOSTS = ('youtube.com', 'youtube-nocookie.com', 'youtu.be')
+C_YOUTUBE_SHORT_HOST = 'youtu.be'
+
+# paths that have the video id as their second segment, e.g. /shorts/HhHzCfrqsoE
+C_YOUTUBE_ID_PATHS = ('shorts', 'embed', 'live', 'v', 'e')
+
+C_YOUTUBE_ID_RE = re.compile(r'^[A-Za-z0-9_-]{11}$')
+
+def get_youtube_host(url):
+    # which of C_YOUTUBE_HOSTS the url is on, or None
+    hostname = (urlparse(url).hostname or '').lower()
+    for host in C_YOUTUBE_HOSTS:
+        if hostname == host or hostname.endswith('.' + host):
+            return host
+    return None
+
 def is_youtube_url(url):
     # is this an actual url?
     try:
         result = urlparse(url)
         is_real_url = all([result.scheme, result.netloc])
-        # deal with youtube.com and youtu.be
-        return is_real_url and (result.netloc.endswith('youtube.com') or result.netloc.endswith('youtu.be'))
+        return is_real_url and get_youtube_host(url) is not None
     except:
         return False
     
 def get_youtube_id(url):
+    '''
+    The video id in a youtube url, or None if there isn't one. These all give HhHzCfrqsoE:
+        https://www.youtube.com/watch?v=HhHzCfrqsoE&t=30s (also m., music., no www.)
+        https://youtu.be/HhHzCfrqsoE?t=30
+        https://www.youtube.com/shorts/HhHzCfrqsoE (also /embed/, /live/, /v/, /e/)
+        https://www.youtube-nocookie.com/embed/HhHzCfrqsoE
+    '''
     if not is_youtube_url(url):
         return None
 
-    # youtube.com format is https://www.youtube.com/watch?v=HhHzCfrqsoE
-    # youtu.be format is https://youtu.be/HhHzCfrqsoE
-
-    # let's parse the url properly
-        
     youtube_url = urlparse(url)
 
-    if youtube_url.netloc == 'youtu.be':
-        youtube_id = youtube_url.path[1:]
+    segments = [segment for segment in youtube_url.path.split('/') if segment]
+
+    if get_youtube_host(url) == C_YOUTUBE_SHORT_HOST:
+        youtube_id = segments[0] if segments else None
+    elif len(segments) >= 2 and segments[0].lower() in C_YOUTUBE_ID_PATHS:
+        youtube_id = segments[1]
     else:
-        # youtube.com
         # get the query string parameters as a dictionary
         query_params = parse_qs(youtube_url.query)
-        youtube_id = query_params['v'][0]
+        youtube_id = (query_params.get('v') or [None])[0]
+
+    if not youtube_id or not C_YOUTUBE_ID_RE.match(youtube_id):
+        return None
 
     return youtube_id
 
+def get_youtube_canonical_url(youtube_id):
+    # one url per video, so per-url caches (e.g. get_youtube_data) are shared by every form of it
+    return f'https://www.youtube.com/watch?v={youtube_id}'
+
+# video metadata rarely changes, and fetching it means scraping the watch page,
+# so results are shared between containers for a day
+@cache_result(max_size=256, ttl=3600, shared_ttl=86400)
 def get_youtube_data(url):
     '''
     format returned:
@@ -75,30 +111,58 @@ def get_youtube_transcript(youtube_url):
 
     youtube_id = get_youtube_id(youtube_url)
 
+    if not youtube_id:
+        return None
+
     languages = ('en', 'en-US', 'en-GB', 'en-CA', 'en-AU', 'en-NZ')
     transcript = YouTubeTranscriptApi.get_transcript(youtube_id, languages=languages)
 
     return transcript
 
 
+def get_transcript_s3_key(spelunk_id):
+    return f'transcripts/{spelunk_id}.json'
+
+def get_summary_s3_key(spelunk_id):
+    return f'youtube_summaries/{spelunk_id}.json'
+
+def presign_s3_url(s3_bucket, s3_key, expires_in=3600):
+    '''
+    Create a signed url to get an s3 object. This is signed locally, it doesn't check the object exists.
+    '''
+    s3 = get_client('s3')
+
+    try:
+        return s3.generate_presigned_url(
+            'get_object',
+            Params={
+                'Bucket': s3_bucket,
+                'Key': s3_key
+            },
+            ExpiresIn=expires_in
+        )
+    except Exception as e:
+        logger.error('failed to create signed url', s3_key=s3_key, exc=e)
+        raise
+
 def get_youtube_transcript_url(spelunk_rec, s3_bucket):
     ''' 
     This function checks whether the youtube transcript is already created and written to s3.
     If not, it creates the transcript and writes it to s3.
     Then it creates a signed url to the transcript and returns it.
     '''
-    print ('get_youtube_transcript')
+    logger.debug('get_youtube_transcript_url', spelunk_id=spelunk_rec.get('id'))
 
     spelunk_id = spelunk_rec['id']
-    s3_key = f'transcripts/{spelunk_id}.json'
+    s3_key = get_transcript_s3_key(spelunk_id)
 
     youtube_url = ((spelunk_rec.get('lenses') or {}).get('source') or {}).get('url')
 
     if not youtube_url:
-        print ('no youtube url')
+        logger.warning('no youtube url', spelunk_id=spelunk_rec.get('id'))
         return None
 
-    s3 = boto3.client('s3')
+    s3 = get_client('s3')
 
     object_exists = False
 
@@ -124,24 +188,11 @@ def get_youtube_transcript_url(spelunk_rec, s3_bucket):
                 Body=transcript_str
             )
         except Exception as e:
-            print ('failed to create transcript: ' + exc_to_string(e))
+            logger.error('failed to create transcript', spelunk_id=spelunk_id, exc=e)
             raise
     
     # create a signed url to the transcript
-    try:
-        signed_url = s3.generate_presigned_url(
-            'get_object',
-            Params={
-                'Bucket': s3_bucket,
-                'Key': s3_key
-            },
-            ExpiresIn=3600
-        )
-
-        return signed_url
-    except Exception as e:
-        print ('failed to create signed url: ' + exc_to_string(e))
-        raise
+    return presign_s3_url(s3_bucket, s3_key)
 
 
 def get_chunks_from_transcript(transcript, chunk_length_mins=10.0):
@@ -256,7 +307,7 @@ def get_chunks_from_transcript(transcript, chunk_length_mins=10.0):
     if len(current_chunk) > 0:
         chunks.append(current_chunk)
 
-    print(f"Found {len(chunks)} chunks")
+    logger.debug('found chunks', count=len(chunks))
 
     return chunks
 
@@ -269,9 +320,7 @@ def summarize_chunk(index, chunk, prompt_header, diagnostics=False):
 {prompt_header}Summarize this section of the transcript. Don't mention that this is a section in the summary."""
 
     if diagnostics:
-        # print each line of the prompt with a leading # so we can see it in the output
-        for line in prompt.split('\n'):
-            print(f"# {line}")
+        logger.info('summarize prompt', prompt=prompt)
 
     completion = openai.Completion.create(
         engine="text-davinci-003", 
@@ -284,7 +333,7 @@ def summarize_chunk(index, chunk, prompt_header, diagnostics=False):
     msg = completion.choices[0].text
 
     if diagnostics:
-        print(f"# Response: {msg}")
+        logger.info('summarize response', response=msg)
 
     return msg
 
@@ -301,9 +350,7 @@ def summarize_the_summaries(summaries, prompt_header, diagnostics=False):
 {prompt_header}Summarize the summaries."""
 
     if diagnostics:
-        # print each line of the prompt with a leading # so we can see it in the output
-        for line in prompt.split('\n'):
-            print(f"# {line}")
+        logger.info('summarize prompt', prompt=prompt)
 
     completion = openai.Completion.create(
         engine="text-davinci-003", 
@@ -316,7 +363,7 @@ def summarize_the_summaries(summaries, prompt_header, diagnostics=False):
     msg = completion.choices[0].text
 
     if diagnostics:
-        print(f"# Response: {msg}")
+        logger.info('summarize response', response=msg)
 
     return msg
 
@@ -326,12 +373,12 @@ def summarize_audio_transcript_chunks(chunks, prompt_header, chunk_len_mins):
 
     if len(chunks) == 0:
         output = "No chunks found"
-        print(output)
+        logger.debug('summary', summary=output)
         yield output
     elif len(chunks) == 1:
         summary = summarize_chunk(0, chunks[0], prompt_header)
         output = f"Summary: {summary}"
-        print(output)
+        logger.debug('summary', summary=output)
         yield output
     else:
         # Now we have the chunks, we can summarize each one
@@ -368,18 +415,18 @@ def get_youtube_summary_url(spelunk_rec, s3_bucket):
     If not, it creates the summary and writes it to s3.
     Then it creates a signed url to the summary and returns it.
     '''
-    print ('get_youtube_summary_url')
+    logger.debug('get_youtube_summary_url', spelunk_id=spelunk_rec.get('id'))
 
     spelunk_id = spelunk_rec['id']
-    s3_key = f'youtube_summaries/{spelunk_id}.json'
+    s3_key = get_summary_s3_key(spelunk_id)
 
     youtube_url = ((spelunk_rec.get('lenses') or {}).get('source') or {}).get('url')
 
     if not youtube_url:
-        print ('no youtube url')
+        logger.warning('no youtube url', spelunk_id=spelunk_rec.get('id'))
         return None
 
-    s3 = boto3.client('s3')
+    s3 = get_client('s3')
 
     object_exists = False
 
@@ -403,7 +450,7 @@ def get_youtube_summary_url(spelunk_rec, s3_bucket):
             chunks = get_chunks_from_transcript(transcript, chunk_len)
 
             if len(chunks) == 0:
-                print ('no chunks found')
+                logger.warning('no chunks found', spelunk_id=spelunk_id)
                 return None
             elif len(chunks) == 1:
                 chunk_len = 2
@@ -419,7 +466,7 @@ def get_youtube_summary_url(spelunk_rec, s3_bucket):
             # summarize_audio_transcript_chunks yields chunks. Get each one and write it.
             summaries = []
             for summary_chunk in summarize_audio_transcript_chunks(chunks, "", chunk_len):
-                print (summary_chunk)
+                logger.debug('summary chunk', summary=summary_chunk)
                 summaries.append(summary_chunk)
 
             summary_doc = json.dumps(summaries)
@@ -430,21 +477,11 @@ def get_youtube_summary_url(spelunk_rec, s3_bucket):
                 Body=summary_doc
             )
         except Exception as e:
-            print ('failed to create summary: ' + exc_to_string(e))
+            logger.error('failed to create summary', spelunk_id=spelunk_id, exc=e)
             raise
     
     # create a signed url to the summary
-    try:
-        signed_url = s3.generate_presigned_url(
-            'get_object',
-            Params={
-                'Bucket': s3_bucket,
-                'Key': s3_key
-            },
-            ExpiresIn=3600
-        )
+    return presign_s3_url(s3_bucket, s3_key)
 
-        return signed_url
-    except Exception as e:
-        print ('failed to create signed url: ' + exc_to_string(e))
-        raise
+# async variants, for the API handlers (see aio.py)
+presign_s3_url_async = to_async(presign_s3_url)
@@ -0,0 +1,24 @@
+'''
+The tests run the layer (lambda_layer/) and the API handlers (lambda/) against the in-memory
+dynamodb engine in ddb_memory.py, so they don't need AWS. Run them from the repo root with:
+    python -m pytest tests
+'''
+import os
+import sys
+
+C_REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+sys.path.insert(0, os.path.join(C_REPO_DIR, 'lambda_layer'))
+sys.path.insert(1, os.path.join(C_REPO_DIR, 'lambda'))
+
+C_TEST_ENV = {
+    'ddb_backend': 'memory',
+    'table_name': 'test-table',
+    'queue_url': 'test-queue',
+    'bucket_name': 'test-bucket',
+    'domain_name': 'test.example.com',
+    'openai_api_key': 'test-key',
+}
+
+for name, value in C_TEST_ENV.items():
+    os.environ.setdefault(name, value)
@@ -0,0 +1,68 @@
+'''
+Cursors have to come back as the key they were made from, and nothing else.
+'''
+import pytest
+
+from cursor import encode_cursor, decode_cursor, InvalidCursor
+
+C_KEY_NAMES = ['pkey', 'l2_pkey', 'l2_skey']
+C_CONTEXT = 'test-table|lookup2|l2_pkey|owner-1'
+C_KEY = {
+    'pkey': {'S': 'P*3f1c0b6e-0a2b-4c1d-9e8f-7a6b5c4d3e2f'},
+    'l2_pkey': {'S': 'owner-1'},
+    'l2_skey': {'S': 'my plugin*3f1c0b6e-0a2b-4c1d-9e8f-7a6b5c4d3e2f'},
+}
+
+@pytest.fixture(autouse=True)
+def cursor_secret(monkeypatch):
+    monkeypatch.setenv('cursor_secret', 'test-secret')
+
+def test_cursor_round_trips():
+    cursor = encode_cursor(C_KEY, C_KEY_NAMES, C_CONTEXT)
+
+    assert decode_cursor(cursor, C_KEY_NAMES, C_CONTEXT) == C_KEY
+
+def test_cursor_round_trips_other_key_shapes():
+    key = {'pkey': {'S': 'a'}, 'count': {'N': '12'}, 'blob': {'B': b'\x00\x01'}}
+    cursor = encode_cursor(key, C_KEY_NAMES, C_CONTEXT)
+
+    assert decode_cursor(cursor, C_KEY_NAMES, C_CONTEXT) == key
+
+def test_no_key_is_no_cursor():
+    assert encode_cursor(None, C_KEY_NAMES, C_CONTEXT) is None
+    assert decode_cursor(None, C_KEY_NAMES, C_CONTEXT) is None
+    assert decode_cursor('', C_KEY_NAMES, C_CONTEXT) is None
+
+@pytest.mark.parametrize('position', [0, 5, -1])
+def test_tampered_cursor_is_rejected(position):
+    cursor = encode_cursor(C_KEY, C_KEY_NAMES, C_CONTEXT)
+    position %= len(cursor)
+    flipped = 'A' if cursor[position] != 'A' else 'B'
+    tampered = cursor[:position] + flipped + cursor[position + 1:]
+
+    with pytest.raises(InvalidCursor):
+        decode_cursor(tampered, C_KEY_NAMES, C_CONTEXT)
+
+@pytest.mark.parametrize('cursor', ['not a cursor', '!!!!', 'A' * 4096, 12])
+def test_malformed_cursor_is_rejected(cursor):
+    with pytest.raises(InvalidCursor):
+        decode_cursor(cursor, C_KEY_NAMES, C_CONTEXT)
+
+def test_cursor_for_another_partition_is_rejected():
+    cursor = encode_cursor(C_KEY, C_KEY_NAMES, C_CONTEXT)
+
+    with pytest.raises(InvalidCursor):
+        decode_cursor(cursor, C_KEY_NAMES, 'test-table|lookup2|l2_pkey|owner-2')
+
+def test_cursor_signed_with_another_secret_is_rejected(monkeypatch):
+    cursor = encode_cursor(C_KEY, C_KEY_NAMES, C_CONTEXT)
+    monkeypatch.setenv('cursor_secret', 'other-secret')
+
+    with pytest.raises(InvalidCursor):
+        decode_cursor(cursor, C_KEY_NAMES, C_CONTEXT)
+
+def test_rotated_secret_still_verifies(monkeypatch):
+    cursor = encode_cursor(C_KEY, C_KEY_NAMES, C_CONTEXT)
+    monkeypatch.setenv('cursor_secret', 'new-secret,test-secret')
+
+    assert decode_cursor(cursor, C_KEY_NAMES, C_CONTEXT) == C_KEY
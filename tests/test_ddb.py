@@ -0,0 +1,339 @@
+'''
+The ddb layer's bulk and retrying calls, against the in-memory engine.
+'''
+import time
+import pytest
+
+botocore_exceptions = pytest.importorskip('botocore.exceptions')
+pytest.importorskip('boto3')
+
+import clients
+import ddb
+import metrics
+from ddb_memory import MemoryDynamoDBClient
+
+C_TABLE = 'test-table'
+
+class CountingClient(MemoryDynamoDBClient):
+    '''
+    The in-memory engine, counting calls per operation, and handing back every batch key
+    as unprocessed for the first unprocessed_calls batch calls.
+    '''
+    def __init__(self, unprocessed_calls=0, **kwargs):
+        super().__init__(**kwargs)
+        self.unprocessed_calls = unprocessed_calls
+        self.calls = {}
+
+    def count(self, operation):
+        self.calls[operation] = self.calls.get(operation, 0) + 1
+
+    def batch_call(self, operation, f, params):
+        with self.lock:
+            self.count(operation)
+            self.unprocessed_rate = 1.0 if self.unprocessed_calls > 0 else 0.0
+            self.unprocessed_calls -= 1
+            return f(**params)
+
+    def batch_get_item(self, **params):
+        return self.batch_call('BatchGetItem', super().batch_get_item, params)
+
+    def batch_write_item(self, **params):
+        return self.batch_call('BatchWriteItem', super().batch_write_item, params)
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    # retries are what's being tested, not how long they wait
+    monkeypatch.setattr(ddb, 'backoff_sleep', lambda attempt: None)
+    ddb.RATE_LIMITERS.clear()
+    yield
+    ddb.RATE_LIMITERS.clear()
+    clients.reset_clients()
+
+def use_client(client):
+    clients.set_client('dynamodb', client)
+    ddb.invalidate_cached_table(C_TABLE)
+    return client
+
+def put_items(count):
+    items = [{'pkey': f'item-{i:03}', 'n': i} for i in range(count)]
+    ddb.batch_write_items(C_TABLE, put_items=items)
+    return items
+
+def test_batch_get_splits_into_requests_of_100():
+    client = use_client(CountingClient())
+    items = put_items(250)
+    client.calls.clear()
+
+    result = ddb.batch_get_items(C_TABLE, [item['pkey'] for item in items])
+
+    assert sorted(result['Items'], key=lambda item: item['pkey']) == items
+    assert result['UnprocessedKeys'] == []
+    assert client.calls == {'BatchGetItem': 3}
+
+def test_batch_get_drops_duplicate_keys():
+    use_client(CountingClient())
+    put_items(3)
+
+    result = ddb.batch_get_items(C_TABLE, ['item-000', 'item-001', 'item-000', 'missing', 'item-001'])
+
+    assert sorted(item['pkey'] for item in result['Items']) == ['item-000', 'item-001']
+
+def test_batch_get_retries_unprocessed_keys():
+    client = use_client(CountingClient())
+    items = put_items(10)
+    client.unprocessed_calls = 2
+    client.calls.clear()
+
+    result = ddb.batch_get_items(C_TABLE, [item['pkey'] for item in items])
+
+    assert len(result['Items']) == 10
+    assert result['UnprocessedKeys'] == []
+    assert client.calls == {'BatchGetItem': 3}
+
+def test_batch_get_returns_keys_still_unprocessed_after_its_attempts():
+    client = use_client(CountingClient())
+    put_items(3)
+    client.unprocessed_calls = 100
+    client.calls.clear()
+
+    result = ddb.batch_get_items(C_TABLE, ['item-000', 'item-001', 'item-002'], max_attempts=3)
+
+    assert result['Items'] == []
+    assert sorted(result['UnprocessedKeys']) == ['item-000', 'item-001', 'item-002']
+    assert client.calls == {'BatchGetItem': 3}
+
+def test_batch_get_with_sort_keys_takes_and_returns_tuples():
+    client = use_client(CountingClient())
+    client.create_table(
+        TableName='sorted-table',
+        KeySchema=[{'AttributeName': 'pkey', 'KeyType': 'HASH'}, {'AttributeName': 'skey', 'KeyType': 'RANGE'}],
+        AttributeDefinitions=[
+            {'AttributeName': 'pkey', 'AttributeType': 'S'}, {'AttributeName': 'skey', 'AttributeType': 'S'}
+        ],
+        BillingMode='PAY_PER_REQUEST'
+    )
+    ddb.batch_write_items('sorted-table', put_items=[{'pkey': 'p', 'skey': s} for s in 'abc'], skey_name='skey')
+    client.unprocessed_calls = 100
+
+    result = ddb.batch_get_items('sorted-table', [('p', 'a'), ('p', 'b'), ('p', 'a')], skey_name='skey', max_attempts=1)
+
+    assert sorted(result['UnprocessedKeys']) == [('p', 'a'), ('p', 'b')]
+
+def test_batch_write_splits_into_requests_of_25():
+    client = use_client(CountingClient())
+
+    items = put_items(60)
+
+    assert client.calls == {'BatchWriteItem': 3}
+    assert sorted(ddb.batch_get_items(C_TABLE, [item['pkey'] for item in items])['Items'], key=lambda item: item['pkey']) == items
+
+def test_batch_write_puts_and_deletes_with_duplicate_deletes():
+    use_client(CountingClient())
+    put_items(5)
+
+    result = ddb.batch_write_items(
+        C_TABLE,
+        put_items=[{'pkey': 'new'}],
+        delete_keys=['item-000', 'item-001', 'item-000']
+    )
+
+    assert result == {'UnprocessedPutItems': [], 'UnprocessedDeleteKeys': []}
+    remaining = ddb.batch_get_items(C_TABLE, ['new'] + [f'item-{i:03}' for i in range(5)])['Items']
+    assert sorted(item['pkey'] for item in remaining) == ['item-002', 'item-003', 'item-004', 'new']
+
+def test_batch_write_retries_unprocessed_items():
+    client = use_client(CountingClient(unprocessed_calls=2))
+
+    items = put_items(10)
+
+    assert client.calls == {'BatchWriteItem': 3}
+    assert len(ddb.batch_get_items(C_TABLE, [item['pkey'] for item in items])['Items']) == 10
+
+def test_batch_write_returns_writes_still_unprocessed_after_its_attempts():
+    client = use_client(CountingClient())
+    put_items(1)
+    client.unprocessed_calls = 100
+
+    result = ddb.batch_write_items(C_TABLE, put_items=[{'pkey': 'new', 'n': 1}], delete_keys=['item-000'], max_attempts=2)
+
+    assert result == {'UnprocessedPutItems': [{'pkey': 'new', 'n': 1}], 'UnprocessedDeleteKeys': ['item-000']}
+
+class FailingScanClient(MemoryDynamoDBClient):
+    '''
+    The in-memory engine, failing scans of one segment.
+    '''
+    def __init__(self, failing_segment, **kwargs):
+        super().__init__(**kwargs)
+        self.failing_segment = failing_segment
+
+    def scan(self, **params):
+        if params.get('Segment') == self.failing_segment:
+            raise botocore_exceptions.ClientError({'Error': {'Code': 'ValidationException', 'Message': 'bad'}}, 'Scan')
+        return super().scan(**params)
+
+def test_parallel_scan_yields_every_item_once():
+    use_client(CountingClient())
+    items = put_items(200)
+
+    scanned = list(ddb.parallel_scan(C_TABLE, total_segments=4, page_size=7))
+
+    assert sorted(scanned, key=lambda item: item['pkey']) == items
+
+def test_parallel_scan_filters_and_projects():
+    use_client(CountingClient())
+    put_items(50)
+
+    scanned = list(ddb.parallel_scan(
+        C_TABLE, total_segments=3, page_size=5,
+        projection_expression='#pkey',
+        filter_expression='#n >= :min',
+        expression_attribute_names={'#pkey': 'pkey', '#n': 'n'},
+        expression_attribute_values={':min': 45}
+    ))
+
+    assert sorted(item['pkey'] for item in scanned) == [f'item-{i:03}' for i in range(45, 50)]
+    assert all(set(item) == {'pkey'} for item in scanned)
+
+def test_parallel_scan_of_a_sparse_index_sees_only_indexed_items():
+    use_client(CountingClient())
+    ddb.batch_write_items(C_TABLE, put_items=[
+        {'pkey': f'item-{i}', **({'l3_pkey': 'work', 'l3_skey': f'{i}'} if i % 2 else {})} for i in range(20)
+    ])
+
+    scanned = list(ddb.parallel_scan(C_TABLE, total_segments=4, index_name='lookup3'))
+
+    assert sorted(item['pkey'] for item in scanned) == sorted(f'item-{i}' for i in range(1, 20, 2))
+
+def test_parallel_scan_raises_a_failing_segment_error():
+    use_client(FailingScanClient(failing_segment=2))
+    put_items(20)
+
+    with pytest.raises(botocore_exceptions.ClientError):
+        list(ddb.parallel_scan(C_TABLE, total_segments=4))
+
+def test_parallel_scan_can_stop_early():
+    use_client(CountingClient())
+    put_items(200)
+
+    scan = ddb.parallel_scan(C_TABLE, total_segments=4, page_size=5)
+    first = next(scan)
+    scan.close()
+
+    assert first['pkey'].startswith('item-')
+
+def test_parallel_scan_keeps_to_its_capacity_budget():
+    use_client(CountingClient())
+    put_items(40)
+
+    # every page costs at least half a unit, so about 24 pages of 2 items run well past
+    # the 6 units the budget starts with
+    started = time.monotonic()
+    scanned = list(ddb.parallel_scan(C_TABLE, total_segments=4, page_size=2, max_capacity_per_second=6))
+
+    assert len(scanned) == 40
+    assert time.monotonic() - started >= 0.4
+
+class FailingClient(MemoryDynamoDBClient):
+    '''
+    The in-memory engine, failing the first failures get_item calls with code.
+    '''
+    def __init__(self, failures, code, **kwargs):
+        super().__init__(**kwargs)
+        self.failures = failures
+        self.code = code
+        self.attempts = 0
+
+    def get_item(self, **params):
+        self.attempts += 1
+        if self.attempts <= self.failures:
+            raise botocore_exceptions.ClientError({'Error': {'Code': self.code, 'Message': 'failed'}}, 'GetItem')
+        return super().get_item(**params)
+
+@pytest.fixture
+def flushed():
+    flushed = []
+    metrics.flush_metrics()
+    metrics.set_metrics_sink(flushed.extend)
+    yield flushed
+    metrics.set_metrics_sink(None)
+
+def test_throttled_calls_are_retried_and_slow_the_limiter(flushed):
+    client = use_client(FailingClient(3, 'ProvisionedThroughputExceededException'))
+    ddb.put_item(C_TABLE, {'pkey': 'a'})
+
+    assert ddb.get_item(C_TABLE, 'a')['Item'] == {'pkey': 'a'}
+    assert client.attempts == 4
+    assert ddb.rate_limiter_stats()[f'{C_TABLE}:read']['limiting'] is True
+    assert ddb.rate_limiter_stats()[f'{C_TABLE}:write']['limiting'] is False
+
+    metrics.flush_metrics()
+    (get,) = [aggregate for aggregate in flushed if aggregate['operation'] == 'GetItem']
+    assert (get['calls'], get['errors'], get['throttles']) == (4, 3, 3)
+
+def test_transient_errors_are_retried_without_slowing_the_limiter():
+    client = use_client(FailingClient(2, 'InternalServerError'))
+    ddb.put_item(C_TABLE, {'pkey': 'a'})
+
+    assert ddb.get_item(C_TABLE, 'a')['Item'] == {'pkey': 'a'}
+    assert client.attempts == 3
+    assert f'{C_TABLE}:read' not in ddb.rate_limiter_stats() or not ddb.rate_limiter_stats()[f'{C_TABLE}:read']['limiting']
+
+def test_other_errors_are_not_retried():
+    client = use_client(FailingClient(1, 'ValidationException'))
+
+    with pytest.raises(botocore_exceptions.ClientError):
+        ddb.get_item(C_TABLE, 'a')
+
+    assert client.attempts == 1
+
+def test_retries_give_up_after_the_max_attempts():
+    client = use_client(FailingClient(100, 'ThrottlingException'))
+
+    with pytest.raises(botocore_exceptions.ClientError) as excinfo:
+        ddb.get_item(C_TABLE, 'a')
+
+    assert excinfo.value.response['Error']['Code'] == 'ThrottlingException'
+    assert client.attempts == ddb.C_DDB_MAX_ATTEMPTS
+
+def put_timeline(owners, per_owner):
+    '''
+    Interleaved timelines: owner n's items are at times n, n + len(owners), ...
+    '''
+    items = [
+        {'pkey': f'{owner}*{i}', 'l2_pkey': owner, 'l2_skey': f'{i * len(owners) + n:04}'}
+        for n, owner in enumerate(owners)
+        for i in range(per_owner)
+    ]
+    ddb.batch_write_items(C_TABLE, put_items=items)
+    return sorted(item['l2_skey'] for item in items)
+
+def query_timeline(owners, **kwargs):
+    return [
+        item['l2_skey']
+        for item in ddb.query_many(C_TABLE, owners, pkey_name='l2_pkey', index_name='lookup2', page_size=2, **kwargs)
+    ]
+
+def test_query_many_merges_partitions_in_sort_key_order():
+    use_client(MemoryDynamoDBClient())
+    owners = ['owner-a', 'owner-b', 'owner-c']
+    times = put_timeline(owners, 5)
+
+    assert query_timeline(owners, sort_key='l2_skey') == times
+    assert query_timeline(owners, sort_key='l2_skey', forward=False) == times[::-1]
+
+def test_query_many_stops_at_max_items():
+    use_client(MemoryDynamoDBClient())
+    owners = ['owner-a', 'owner-b', 'owner-c']
+    times = put_timeline(owners, 20)
+
+    assert query_timeline(owners, sort_key='l2_skey', max_items=4) == times[:4]
+    assert query_timeline(owners, sort_key='l2_skey', forward=False, max_items=4) == times[::-1][:4]
+    assert len(query_timeline(owners, max_items=4)) == 4
+
+def test_query_many_without_a_sort_key_returns_every_item_once():
+    use_client(MemoryDynamoDBClient())
+    owners = ['owner-a', 'owner-b', 'owner-c']
+    times = put_timeline(owners, 5)
+
+    assert sorted(query_timeline(owners + ['owner-a', 'nobody'])) == times
+    assert query_timeline([]) == []
@@ -0,0 +1,40 @@
+'''
+Records have to read back as the same plain json they were written as.
+'''
+from decimal import Decimal
+import pytest
+
+from ddb_codec import encode_item, decode_item, decode_value
+
+@pytest.mark.parametrize('strval', ['100', '1E+2', '1e2', '100.0', '-1E+2', '0E-5'])
+def test_integral_numbers_decode_as_int(strval):
+    value = decode_value({'N': strval})
+
+    assert type(value) is int
+    assert value == Decimal(strval)
+
+def test_integral_numbers_decode_as_int_with_use_decimal():
+    assert type(decode_value({'N': '1E+2'}, use_decimal=True)) is int
+    assert decode_value({'N': '0.1'}, use_decimal=True) == Decimal('0.1')
+
+def test_fractions_decode_as_float():
+    assert decode_value({'N': '2.5'}) == 2.5
+    assert decode_value({'N': '25E-1'}) == 2.5
+
+def test_round_trip():
+    item = {
+        'id': 'a',
+        'count': 100,
+        'exponent': Decimal('1E+2'),
+        'ratio': 0.25,
+        'flag': True,
+        'nothing': None,
+        'lenses': {'summary': {'status': 'ready', 'started_at': 1700000000}},
+        'tags': ['x', 1, {'y': [2]}],
+    }
+
+    decoded = decode_item(encode_item(item))
+
+    assert decoded == item
+    assert type(decoded['exponent']) is int
+    assert type(decoded['lenses']['summary']['started_at']) is int
@@ -0,0 +1,285 @@
+'''
+The in-memory engine has to reject what dynamodb rejects, or tests pass that production fails.
+The ddb layer's update and versioned write expressions are checked against it here too.
+'''
+import threading
+import pytest
+
+botocore_exceptions = pytest.importorskip('botocore.exceptions')
+pytest.importorskip('boto3')
+
+import clients
+import ddb
+from cursor import InvalidCursor, encode_cursor
+from ddb_memory import MemoryDynamoDBClient
+
+C_TABLE = 'test-table'
+C_KEY = {'pkey': {'S': 'a'}}
+
+@pytest.fixture
+def client():
+    client = MemoryDynamoDBClient()
+    client.put_item(TableName=C_TABLE, Item={**C_KEY, 'm': {'M': {'x': {'N': '1'}}}, 'l3_pkey': {'S': 'p'}})
+    return client
+
+@pytest.fixture
+def memory_ddb():
+    # the ddb layer, running on a fresh in-memory engine
+    client = clients.use_memory_dynamodb()
+    ddb.invalidate_cached_table(C_TABLE)
+    yield client
+    clients.reset_clients()
+
+def stored_item(pkey='a'):
+    return ddb.get_item(C_TABLE, pkey, consistent=True).get('Item')
+
+def assert_validation_error(call, **params):
+    with pytest.raises(botocore_exceptions.ClientError) as excinfo:
+        call(**params)
+    assert excinfo.value.response['Error']['Code'] == 'ValidationException'
+
+def test_update_with_overlapping_paths_is_rejected(client):
+    assert_validation_error(
+        client.update_item, TableName=C_TABLE, Key=C_KEY,
+        UpdateExpression='SET #m.#x = :v REMOVE #m',
+        ExpressionAttributeNames={'#m': 'm', '#x': 'x'},
+        ExpressionAttributeValues={':v': {'N': '2'}}
+    )
+
+def test_update_of_the_same_path_twice_is_rejected(client):
+    assert_validation_error(
+        client.update_item, TableName=C_TABLE, Key=C_KEY,
+        UpdateExpression='SET #m = :v REMOVE #m',
+        ExpressionAttributeNames={'#m': 'm'},
+        ExpressionAttributeValues={':v': {'N': '2'}}
+    )
+
+def test_update_of_sibling_paths_is_allowed(client):
+    client.update_item(
+        TableName=C_TABLE, Key=C_KEY,
+        UpdateExpression='SET #m.#x = :v REMOVE #m.#y',
+        ExpressionAttributeNames={'#m': 'm', '#x': 'x', '#y': 'y'},
+        ExpressionAttributeValues={':v': {'N': '2'}}
+    )
+
+    item = client.get_item(TableName=C_TABLE, Key=C_KEY)['Item']
+    assert item['m'] == {'M': {'x': {'N': '2'}}}
+
+def test_get_item_with_unused_attribute_names_is_rejected(client):
+    assert_validation_error(
+        client.get_item, TableName=C_TABLE, Key=C_KEY,
+        ExpressionAttributeNames={'#m': 'm'}
+    )
+    assert_validation_error(
+        client.get_item, TableName=C_TABLE, Key=C_KEY,
+        ProjectionExpression='#m',
+        ExpressionAttributeNames={'#m': 'm', '#x': 'x'}
+    )
+
+def test_update_with_unused_attribute_values_is_rejected(client):
+    assert_validation_error(
+        client.update_item, TableName=C_TABLE, Key=C_KEY,
+        UpdateExpression='SET #m = :v',
+        ExpressionAttributeNames={'#m': 'm'},
+        ExpressionAttributeValues={':v': {'N': '2'}, ':w': {'N': '3'}}
+    )
+
+def test_size_in_key_condition_is_rejected(client):
+    assert_validation_error(
+        client.query, TableName=C_TABLE, IndexName='lookup3',
+        KeyConditionExpression='l3_pkey = :p AND size(l3_skey) > :n',
+        ExpressionAttributeValues={':p': {'S': 'p'}, ':n': {'N': '0'}}
+    )
+
+def test_typed_sets_come_back_typed(client):
+    client.update_item(
+        TableName=C_TABLE, Key=C_KEY,
+        UpdateExpression='ADD #s :v',
+        ExpressionAttributeNames={'#s': 's'},
+        ExpressionAttributeValues={':v': {'SS': ['b', 'a']}}
+    )
+
+    item = client.get_item(TableName=C_TABLE, Key=C_KEY)['Item']
+    assert sorted(item['s']['SS']) == ['a', 'b']
+
+def test_update_sets_and_removes_nested_paths(memory_ddb):
+    ddb.put_item(C_TABLE, {
+        'pkey': 'a',
+        'lenses': {
+            'summary': {'status': 'underway', 'owner': 'w1', 'lease_expires': 100},
+            'transcript': {'status': 'ready'},
+        },
+        'old': 'x',
+    })
+
+    ddb.update_item(
+        C_TABLE, 'a',
+        set_paths={('lenses', 'summary', 'status'): 'ready', ('lenses', 'summary', 'message'): 'done'},
+        remove_paths=[('lenses', 'summary', 'owner'), ('lenses', 'summary', 'lease_expires'), ('old',)]
+    )
+
+    assert stored_item() == {
+        'pkey': 'a',
+        'lenses': {
+            'summary': {'status': 'ready', 'message': 'done'},
+            'transcript': {'status': 'ready'},
+        },
+    }
+
+def test_update_paths_take_any_attribute_name(memory_ddb):
+    # reserved words and names with dots go through placeholders
+    ddb.put_item(C_TABLE, {'pkey': 'a', 'status': {'a.b': 1}, 'items': [1, 2, 3]})
+
+    ddb.update_item(
+        C_TABLE, 'a',
+        set_paths={('status', 'a.b'): 2, ('items', 1): 20, ('new',): {'size': 1}},
+        remove_paths=[('items', 2)]
+    )
+
+    assert stored_item() == {'pkey': 'a', 'status': {'a.b': 2}, 'items': [1, 20], 'new': {'size': 1}}
+
+def test_update_combines_set_add_and_remove(memory_ddb):
+    ddb.put_item(C_TABLE, {'pkey': 'a', 'count': 1, 'lenses': {'summary': {'status': 'preparing'}}, 'gone': True})
+
+    response = ddb.update_item(
+        C_TABLE, 'a',
+        set_value={'name': 'n'},
+        set_paths={('lenses', 'summary', 'status'): 'underway'},
+        add_value={'count': 2},
+        remove_list=['gone'],
+        return_values='ALL_NEW'
+    )
+
+    expected = {'pkey': 'a', 'name': 'n', 'count': 3, 'lenses': {'summary': {'status': 'underway'}}}
+    assert response['Attributes'] == expected
+    assert stored_item() == expected
+
+def test_update_params_name_each_attribute_once():
+    params = ddb.build_update_params(
+        'a',
+        set_value={'name': 'n'},
+        add_value={'count': 1},
+        set_paths={('lenses', 'summary', 'status'): 'ready', ('lenses', 'summary', 'url'): 'u'},
+        remove_paths=[('lenses', 'transcript')]
+    )
+
+    assert params['UpdateExpression'] == (
+        'SET #name = :name,#_p0.#_p1.#_p2 = :_p0,#_p0.#_p1.#_p3 = :_p1 ADD #count :count REMOVE #_p0.#_p4'
+    )
+    assert params['ExpressionAttributeNames'] == {
+        '#_p0': 'lenses', '#_p1': 'summary', '#_p2': 'status', '#_p3': 'url', '#_p4': 'transcript',
+        '#name': 'name', '#count': 'count',
+    }
+
+def test_fresh_versioned_put_sets_version_1(memory_ddb):
+    ddb.put_item(C_TABLE, {'pkey': 'a', 'name': 'n'}, versioned=True)
+
+    assert stored_item()[ddb.C_VERSION_ATTRIBUTE] == 1
+
+def test_versioned_put_over_an_existing_item_is_rejected(memory_ddb):
+    ddb.put_item(C_TABLE, {'pkey': 'a', 'name': 'first'}, versioned=True)
+
+    with pytest.raises(ddb.VersionConflictError):
+        ddb.put_item(C_TABLE, {'pkey': 'a', 'name': 'second'}, versioned=True)
+
+    assert stored_item()['name'] == 'first'
+
+def test_stale_versioned_update_is_rejected(memory_ddb):
+    ddb.put_item(C_TABLE, {'pkey': 'a', 'name': 'n'}, versioned=True)
+    ddb.update_item(C_TABLE, 'a', set_value={'name': 'fresh'}, versioned=True, expected_version=1)
+
+    with pytest.raises(ddb.VersionConflictError):
+        ddb.update_item(C_TABLE, 'a', set_value={'name': 'stale'}, versioned=True, expected_version=1)
+
+    item = stored_item()
+    assert item['name'] == 'fresh'
+    assert item[ddb.C_VERSION_ATTRIBUTE] == 2
+
+def test_versioned_update_of_a_missing_item_is_rejected(memory_ddb):
+    with pytest.raises(ddb.VersionConflictError):
+        ddb.update_item(C_TABLE, 'a', set_value={'name': 'n'}, versioned=True)
+
+    assert stored_item() is None
+
+def test_retrying_versioned_writes_converge(memory_ddb):
+    # concurrent read-modify-writes that retry on conflict lose no increments
+    ddb.put_item(C_TABLE, {'pkey': 'a', 'count': 0}, versioned=True)
+
+    def increment():
+        while True:
+            item = stored_item()
+            try:
+                ddb.update_item(
+                    C_TABLE, 'a', set_value={'count': item['count'] + 1},
+                    versioned=True, expected_version=item[ddb.C_VERSION_ATTRIBUTE]
+                )
+                return
+            except ddb.VersionConflictError:
+                pass
+
+    threads = [threading.Thread(target=lambda: [increment() for _ in range(5)]) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    item = stored_item()
+    assert item['count'] == 20
+    assert item[ddb.C_VERSION_ATTRIBUTE] == 21
+
+def put_listing(count, owner='owner-1'):
+    for i in range(count):
+        ddb.put_item(C_TABLE, {'pkey': f'P*{owner}*{i}', 'l2_pkey': owner, 'l2_skey': f'plugin {i:02}*{i}'})
+
+def list_page(cursor=None, owner='owner-1', limit=3):
+    response = ddb.query(C_TABLE, owner, pkey_name='l2_pkey', index_name='lookup2', cursor=cursor, limit=limit)
+    return [item['pkey'] for item in response.get('Items') or []], response.get('Cursor')
+
+def test_query_cursor_resumes_the_listing(memory_ddb):
+    put_listing(7)
+
+    pkeys, cursor = list_page()
+    while cursor:
+        page, cursor = list_page(cursor)
+        pkeys += page
+
+    assert pkeys == [f'P*owner-1*{i}' for i in range(7)]
+
+def test_query_iter_cursor_resumes_the_listing(memory_ddb):
+    put_listing(7)
+
+    iterator = ddb.query_iter(C_TABLE, 'owner-1', pkey_name='l2_pkey', index_name='lookup2', max_items=4, page_size=3)
+    first = [item['pkey'] for item in iterator]
+    rest = ddb.query_iter(C_TABLE, 'owner-1', pkey_name='l2_pkey', index_name='lookup2', cursor=iterator.cursor, page_size=3)
+
+    assert first + [item['pkey'] for item in rest] == [f'P*owner-1*{i}' for i in range(7)]
+
+def test_query_cursor_from_another_partition_is_rejected(memory_ddb, monkeypatch):
+    put_listing(5, owner='owner-1')
+    put_listing(5, owner='owner-2')
+    _, cursor = list_page(owner='owner-1')
+    assert cursor
+
+    calls = []
+    monkeypatch.setattr(ddb, 'call_dynamodb', lambda *args, **kwargs: calls.append(args))
+
+    with pytest.raises(InvalidCursor):
+        list_page(cursor, owner='owner-2')
+    with pytest.raises(InvalidCursor):
+        ddb.query_iter(C_TABLE, 'owner-2', pkey_name='l2_pkey', index_name='lookup2', cursor=cursor)
+
+    # rejected before anything was sent
+    assert calls == []
+
+def test_query_cursor_dynamodb_wont_start_from_is_rejected(memory_ddb):
+    put_listing(5)
+
+    # correctly signed for the listing, but missing the index key
+    cursor = encode_cursor({'pkey': {'S': 'P*owner-1*1'}}, ddb.default_key_names('l2_pkey', 'lookup2'), ddb.query_cursor_context(
+        ddb.build_query_params(C_TABLE, 'owner-1', pkey_name='l2_pkey', index_name='lookup2')
+    ))
+
+    with pytest.raises(InvalidCursor):
+        list_page(cursor)
+    with pytest.raises(InvalidCursor):
+        list(ddb.query_iter(C_TABLE, 'owner-1', pkey_name='l2_pkey', index_name='lookup2', cursor=cursor))
@@ -0,0 +1,172 @@
+'''
+The SQS enqueue buffer: batching, ordering, deduplication, retries and failure callbacks.
+'''
+import pytest
+
+pytest.importorskip('boto3')
+
+import clients
+import enqueue
+
+C_QUEUE_URL = 'https://sqs.example/queue.fifo'
+
+class BatchingSQS:
+    '''
+    Stands in for the sqs client, recording each batch sent. failures maps a message body to
+    the failure to report for it, each time it is sent (a list, one per attempt, or one for all).
+    '''
+    def __init__(self, failures=None):
+        self.batches = []
+        self.failures = failures or {}
+
+    def failure_for(self, body):
+        failure = self.failures.get(body)
+        if isinstance(failure, list):
+            return failure.pop(0) if failure else None
+        return failure
+
+    def send_message_batch(self, QueueUrl, Entries):
+        self.batches.append((QueueUrl, Entries))
+
+        successful = []
+        failed = []
+        for entry in Entries:
+            failure = self.failure_for(entry['MessageBody'])
+            if failure is None:
+                successful.append({'Id': entry['Id']})
+            else:
+                failed.append(dict(failure, Id=entry['Id']))
+
+        return {'Successful': successful, 'Failed': failed}
+
+    def sent_bodies(self):
+        return [entry['MessageBody'] for _, entries in self.batches for entry in entries]
+
+C_THROTTLED = {'SenderFault': False, 'Code': 'ThrottlingException'}
+C_REJECTED = {'SenderFault': True, 'Code': 'InvalidParameterValue'}
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    monkeypatch.setattr(enqueue, 'backoff_sleep', lambda attempt: None)
+    monkeypatch.setenv('queue_url', C_QUEUE_URL)
+    enqueue.PENDING.clear()
+    yield
+    enqueue.PENDING.clear()
+    clients.reset_clients()
+
+def use_sqs(sqs):
+    clients.set_client('sqs', sqs)
+    return sqs
+
+def test_messages_wait_for_the_flush():
+    sqs = use_sqs(BatchingSQS())
+
+    enqueue.enqueue_message('a', group_id='g')
+    enqueue.enqueue_message('b', group_id='g')
+    assert sqs.batches == []
+    assert enqueue.pending_count() == 2
+
+    assert enqueue.flush_enqueued() == []
+    assert enqueue.pending_count() == 0
+    ((queue_url, entries),) = sqs.batches
+    assert queue_url == C_QUEUE_URL
+    assert entries == [
+        {'MessageBody': 'a', 'MessageGroupId': 'g', 'Id': '0'},
+        {'MessageBody': 'b', 'MessageGroupId': 'g', 'Id': '1'},
+    ]
+
+def test_a_full_batch_is_sent_straight_away_in_order():
+    sqs = use_sqs(BatchingSQS())
+
+    for i in range(25):
+        enqueue.enqueue_message(f'm{i}', group_id=f'g{i % 3}')
+
+    assert [len(entries) for _, entries in sqs.batches] == [10, 10]
+    assert enqueue.pending_count() == 5
+
+    enqueue.flush_enqueued()
+    assert [len(entries) for _, entries in sqs.batches] == [10, 10, 5]
+    assert sqs.sent_bodies() == [f'm{i}' for i in range(25)]
+
+def test_batches_stay_under_the_size_limit():
+    big = 'x' * (100 * 1024)
+    batches = enqueue.make_batches([{'MessageBody': big} for _ in range(5)])
+
+    assert [len(batch) for batch in batches] == [2, 2, 1]
+
+def test_duplicates_in_the_same_group_are_dropped():
+    sqs = use_sqs(BatchingSQS())
+
+    enqueue.enqueue_message('a', group_id='g')
+    enqueue.enqueue_message('a', group_id='g')
+    enqueue.enqueue_message('a', group_id='other')
+    enqueue.enqueue_message('b', group_id='g', dedup_id='same')
+    enqueue.enqueue_message('c', group_id='g', dedup_id='same')
+    enqueue.flush_enqueued()
+
+    assert sqs.sent_bodies() == ['a', 'a', 'b']
+
+def test_queues_are_flushed_separately():
+    sqs = use_sqs(BatchingSQS())
+
+    enqueue.enqueue_message('a')
+    enqueue.enqueue_message('b', queue_url='https://sqs.example/other')
+    enqueue.flush_enqueued(C_QUEUE_URL)
+
+    assert sqs.sent_bodies() == ['a']
+    assert enqueue.pending_count('https://sqs.example/other') == 1
+
+def test_throttled_entries_are_retried():
+    sqs = use_sqs(BatchingSQS({'b': [C_THROTTLED, C_THROTTLED]}))
+    failed = []
+
+    enqueue.enqueue_message('a', on_failed=lambda: failed.append('a'))
+    enqueue.enqueue_message('b', on_failed=lambda: failed.append('b'))
+
+    assert enqueue.flush_enqueued() == []
+    assert [[entry['MessageBody'] for entry in entries] for _, entries in sqs.batches] == [['a', 'b'], ['b'], ['b']]
+    assert failed == []
+
+def test_failed_entries_run_their_callbacks():
+    sqs = use_sqs(BatchingSQS({'rejected': C_REJECTED, 'throttled': C_THROTTLED}))
+    failed = []
+
+    enqueue.enqueue_message('ok', on_failed=lambda: failed.append('ok'))
+    enqueue.enqueue_message('rejected', on_failed=lambda: failed.append('rejected'))
+    enqueue.enqueue_message('throttled', on_failed=lambda: failed.append('throttled'))
+    # a dropped duplicate's callback rides on the message that stands in for it
+    enqueue.enqueue_message('throttled', on_failed=lambda: failed.append('duplicate'))
+
+    result = enqueue.flush_enqueued(max_attempts=3)
+
+    assert [entry['MessageBody'] for entry in result] == ['rejected', 'throttled']
+    assert failed == ['rejected', 'throttled', 'duplicate']
+    # rejected entries aren't retried, throttled ones are until max_attempts
+    assert sqs.sent_bodies().count('rejected') == 1
+    assert sqs.sent_bodies().count('throttled') == 3
+
+def test_a_failing_callback_does_not_stop_the_others():
+    use_sqs(BatchingSQS({'a': C_REJECTED, 'b': C_REJECTED}))
+    failed = []
+
+    def explode():
+        raise RuntimeError('callback failed')
+
+    enqueue.enqueue_message('a', on_failed=explode)
+    enqueue.enqueue_message('b', on_failed=lambda: failed.append('b'))
+
+    assert len(enqueue.flush_enqueued()) == 2
+    assert failed == ['b']
+
+def test_flush_enqueued_after_flushes_when_the_handler_raises():
+    sqs = use_sqs(BatchingSQS())
+
+    @enqueue.flush_enqueued_after
+    def handler(event, context):
+        enqueue.enqueue_message('a')
+        raise ValueError('handler failed')
+
+    with pytest.raises(ValueError):
+        handler({}, None)
+
+    assert sqs.sent_bodies() == ['a']
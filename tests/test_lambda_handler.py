@@ -0,0 +1,122 @@
+'''
+The API middleware flushes queued ops after the response, and times the flush.
+'''
+import asyncio
+import json
+import os
+import pytest
+
+for module_name in ('boto3', 'fastapi', 'starlette', 'mangum', 'pydantic', 'openai', 'py_youtube', 'youtube_transcript_api'):
+    pytest.importorskip(module_name)
+
+import clients
+import ddb
+import enqueue
+import metrics
+import spelunk
+from lambda_handler import app
+
+C_URL = 'https://www.youtube.com/watch?v=dQw4w9WgXcQ'
+
+class RecordingSQS:
+    '''
+    Stands in for the sqs client, noting each send in the shared event list.
+    '''
+    def __init__(self, events, fail=False):
+        self.events = events
+        self.fail = fail
+
+    def send_message_batch(self, QueueUrl, Entries):
+        self.events.append('sqs')
+        if self.fail:
+            return {'Successful': [], 'Failed': [{'Id': entry['Id'], 'SenderFault': True, 'Code': 'Bad'} for entry in Entries]}
+        return {'Successful': [{'Id': entry['Id']} for entry in Entries], 'Failed': []}
+
+class SigningS3:
+    def generate_presigned_url(self, operation, Params, ExpiresIn):
+        return f"https://{Params['Bucket']}/{Params['Key']}"
+
+@pytest.fixture(autouse=True)
+def memory_ddb(monkeypatch):
+    client = clients.use_memory_dynamodb()
+    clients.set_client('s3', SigningS3())
+    ddb.invalidate_cached_table(os.environ['table_name'])
+    spelunk.resolve_spelunk_alias.cache_clear()
+    monkeypatch.setattr(spelunk, 'get_youtube_data', lambda url: {'title': 'A video'})
+    yield client
+    enqueue.PENDING.clear()
+    clients.reset_clients()
+
+@pytest.fixture
+def flushed_metrics():
+    flushed = []
+    metrics.set_metrics_sink(flushed.extend)
+    yield flushed
+    metrics.set_metrics_sink(None)
+
+def call_app(method, path, body, events):
+    # drive the app as an ASGI server would, noting what it sends back
+    scope = {
+        'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1',
+        'method': method, 'scheme': 'http', 'path': path, 'raw_path': path.encode('utf-8'),
+        'root_path': '', 'query_string': b'', 'headers': [(b'content-type', b'application/json')],
+        'client': ('test', 1), 'server': ('test', 80),
+    }
+    requests = [{'type': 'http.request', 'body': json.dumps(body).encode('utf-8'), 'more_body': False}]
+    responses = []
+
+    async def receive():
+        if requests:
+            return requests.pop(0)
+        # don't report a disconnect while the response is still being sent
+        await asyncio.sleep(3600)
+
+    async def send(message):
+        events.append(message['type'])
+        responses.append(message)
+
+    asyncio.run(app(scope, receive, send))
+
+    status = next(message['status'] for message in responses if message['type'] == 'http.response.start')
+    body = b''.join(message.get('body', b'') for message in responses if message['type'] == 'http.response.body')
+    return status, json.loads(body)
+
+def test_queued_ops_are_sent_after_the_response(flushed_metrics):
+    events = []
+    clients.set_client('sqs', RecordingSQS(events))
+
+    status, body = call_app('POST', '/api/v1/spelunk', {'url': C_URL}, events)
+
+    assert status == 200
+    assert body['id'] == spelunk.calc_spelunk_id('dQw4w9WgXcQ')
+    assert events.index('sqs') > max(index for index, event in enumerate(events) if event == 'http.response.body')
+    assert enqueue.pending_count() == 0
+
+    flushes = [aggregate for aggregate in flushed_metrics if aggregate['operation'] == 'FlushEnqueued']
+    assert len(flushes) == 1
+    assert flushes[0]['items'] == 1
+    assert flushes[0]['errors'] == 0
+    assert flushes[0]['latency_total_ms'] > 0
+
+def test_failed_flush_is_recorded_and_releases_the_lease(flushed_metrics):
+    events = []
+    clients.set_client('sqs', RecordingSQS(events, fail=True))
+
+    status, body = call_app('POST', '/api/v1/spelunk', {'url': C_URL}, events)
+
+    assert status == 200
+    flushes = [aggregate for aggregate in flushed_metrics if aggregate['operation'] == 'FlushEnqueued']
+    assert flushes[0]['errors'] == 1
+    assert 'enqueued_at' not in spelunk.get_spelunk_rec(body['id'])
+
+def test_requests_that_queue_nothing_record_no_flush(flushed_metrics):
+    events = []
+    clients.set_client('sqs', RecordingSQS(events))
+    call_app('POST', '/api/v1/spelunk', {'url': C_URL}, events)
+    flushed_metrics.clear()
+
+    # already queued, so the status check queues nothing
+    status, _ = call_app('GET', f"/api/v1/spelunk/{spelunk.calc_spelunk_id('dQw4w9WgXcQ')}/status", None, events)
+
+    assert status == 200
+    assert not [aggregate for aggregate in flushed_metrics if aggregate['operation'] == 'FlushEnqueued']
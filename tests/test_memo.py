@@ -0,0 +1,33 @@
+'''
+The shared tier's keys have to agree across containers.
+'''
+import os
+import subprocess
+import sys
+import pytest
+
+pytest.importorskip('boto3')
+
+from memo import make_key, SharedTier
+
+C_PKEY_SCRIPT = '''
+from memo import make_key, SharedTier
+print(SharedTier('f', 60).pkey(make_key(({'b', 'a', ('c', 1)},), {'tags': frozenset({'x', 'y', 'z'})})))
+'''
+
+def test_shared_tier_key_is_the_same_under_any_hash_seed():
+    pkeys = set()
+    for seed in ('1', '2', '3'):
+        result = subprocess.run(
+            [sys.executable, '-c', C_PKEY_SCRIPT],
+            env={**os.environ, 'PYTHONHASHSEED': seed, 'PYTHONPATH': os.pathsep.join(sys.path)},
+            capture_output=True, text=True, check=True
+        )
+        pkeys.add(result.stdout.strip())
+
+    assert len(pkeys) == 1
+
+def test_shared_tier_key_ignores_set_order():
+    shared = SharedTier('f', 60)
+
+    assert shared.pkey(make_key(({'a', 'b', 'c'},), {})) == shared.pkey(make_key(({'c', 'b', 'a'},), {}))
@@ -0,0 +1,112 @@
+'''
+Per-invocation ddb metrics: what's recorded, and what a flush writes.
+'''
+import json
+import pytest
+
+pytest.importorskip('boto3')
+
+import clients
+import ddb
+import metrics
+
+C_TABLE = 'test-table'
+
+@pytest.fixture(autouse=True)
+def memory_ddb():
+    client = clients.use_memory_dynamodb()
+    ddb.invalidate_cached_table(C_TABLE)
+    metrics.set_metrics_enabled(True)
+    metrics.flush_metrics()
+    yield client
+    metrics.set_metrics_sink(None)
+    clients.reset_clients()
+
+@pytest.fixture
+def flushed():
+    flushed = []
+    metrics.set_metrics_sink(flushed.extend)
+    return flushed
+
+def read_two_items():
+    ddb.get_item(C_TABLE, 'a', consistent=True)
+    ddb.get_item(C_TABLE, 'missing', consistent=True)
+
+def test_calls_are_aggregated_by_operation_table_and_call_site(flushed):
+    ddb.put_item(C_TABLE, {'pkey': 'a', 'name': 'n'})
+    read_two_items()
+
+    metrics.flush_metrics()
+
+    by_operation = {aggregate['operation']: aggregate for aggregate in flushed}
+    assert set(by_operation) == {'PutItem', 'GetItem'}
+
+    get = by_operation['GetItem']
+    assert get['table_name'] == C_TABLE
+    assert get['call_site'] == 'test_metrics.read_two_items'
+    assert get['calls'] == 2
+    assert get['items'] == 1
+    assert get['read_capacity_units'] == 2.0
+    assert get['write_capacity_units'] == 0.0
+    assert len(get['latencies_ms']) == 2
+
+    assert by_operation['PutItem']['write_capacity_units'] == 1.0
+
+def test_recording_capacity_doesnt_change_the_response():
+    ddb.put_item(C_TABLE, {'pkey': 'a'})
+
+    assert 'ConsumedCapacity' not in ddb.get_item(C_TABLE, 'a')
+    assert 'ConsumedCapacity' in ddb.get_item(C_TABLE, 'a', return_consumed_capacity='TOTAL')
+
+def test_flush_starts_afresh(flushed):
+    ddb.put_item(C_TABLE, {'pkey': 'a'})
+    metrics.flush_metrics()
+    metrics.flush_metrics()
+
+    assert len(flushed) == 1
+    assert metrics.metrics_snapshot() == []
+
+def test_nothing_is_recorded_when_switched_off(flushed):
+    metrics.set_metrics_enabled(False)
+    try:
+        ddb.put_item(C_TABLE, {'pkey': 'a'})
+        metrics.flush_metrics()
+    finally:
+        metrics.set_metrics_enabled(True)
+
+    assert flushed == []
+
+def test_latency_samples_are_capped(flushed):
+    for i in range(metrics.C_MAX_LATENCY_SAMPLES + 20):
+        metrics.record_ddb_call('GetItem', C_TABLE, None, 'here', elapsed_ms=1.0)
+
+    metrics.flush_metrics()
+
+    (aggregate,) = flushed
+    assert aggregate['calls'] == metrics.C_MAX_LATENCY_SAMPLES + 20
+    assert len(aggregate['latencies_ms']) == metrics.C_MAX_LATENCY_SAMPLES
+    assert aggregate['latency_total_ms'] == metrics.C_MAX_LATENCY_SAMPLES + 20
+
+def test_flush_writes_emf_lines(capsys):
+    metrics.record_ddb_call('Query', C_TABLE, 'lookup3', 'spelunk.reap_stuck_spelunks', item_count=3, elapsed_ms=2.5)
+
+    metrics.flush_metrics()
+
+    (line,) = capsys.readouterr().out.splitlines()
+    entry = json.loads(line)
+    assert entry['_aws']['CloudWatchMetrics'][0]['Namespace'] == 'spl/ddb'
+    assert {'Operation': 'Query', 'Table': C_TABLE, 'Index': 'lookup3', 'CallSite': 'spelunk.reap_stuck_spelunks'}.items() <= entry.items()
+    assert entry['Calls'] == 1
+    assert entry['Items'] == 3
+    assert entry['Latency'] == [2.5]
+
+def test_handlers_flush_even_when_they_fail(flushed):
+    @metrics.flush_metrics_after
+    def handler(event, context):
+        ddb.put_item(C_TABLE, {'pkey': 'a'})
+        raise ValueError('failed')
+
+    with pytest.raises(ValueError):
+        handler({}, None)
+
+    assert [aggregate['operation'] for aggregate in flushed] == ['PutItem']
@@ -0,0 +1,131 @@
+'''
+Attribute offloading, through the ddb layer against the in-memory engine.
+'''
+import gzip
+import hashlib
+import io
+import json
+import pytest
+
+pytest.importorskip('boto3')
+
+import clients
+import ddb
+import offload
+
+C_TABLE = 'test-table'
+
+class MemoryS3:
+    '''
+    Stands in for the s3 client, keeping objects in a dict and counting gets.
+    '''
+    def __init__(self):
+        self.objects = {}
+        self.gets = 0
+
+    def put_object(self, Bucket, Key, Body, ContentType=None):
+        self.objects[(Bucket, Key)] = Body
+
+    def get_object(self, Bucket, Key):
+        self.gets += 1
+        return {'Body': io.BytesIO(self.objects[(Bucket, Key)])}
+
+@pytest.fixture(autouse=True)
+def s3(monkeypatch):
+    monkeypatch.setattr(offload, 'POLICIES', {})
+    offload.SPILLED_VALUE_CACHE.clear()
+    clients.use_memory_dynamodb()
+    s3 = MemoryS3()
+    clients.set_client('s3', s3)
+    ddb.invalidate_cached_table(C_TABLE)
+    offload.register_offload_policy('body', compress_over=100, spill_over=2000, s3_bucket='offload-bucket')
+    yield s3
+    clients.reset_clients()
+    offload.SPILLED_VALUE_CACHE.clear()
+
+def stored(pkey):
+    '''
+    The item as dynamodb holds it, markers and all.
+    '''
+    response = clients.get_client('dynamodb').get_item(TableName=C_TABLE, Key={'pkey': {'S': pkey}})
+    return ddb.remove_ddb_format(response['Item'])
+
+def spillable_text():
+    # incompressible enough to stay over spill_over once gzipped
+    return ''.join(hashlib.sha256(str(i).encode()).hexdigest() for i in range(200))
+
+def test_small_values_are_stored_as_is():
+    ddb.put_item(C_TABLE, {'pkey': 'a', 'body': 'short'})
+
+    assert stored('a')['body'] == 'short'
+    assert ddb.get_item(C_TABLE, 'a')['Item']['body'] == 'short'
+
+def test_large_values_are_gzipped_into_a_binary(s3):
+    body = {'text': 'repeat ' * 200}
+    ddb.put_item(C_TABLE, {'pkey': 'a', 'body': body, 'other': 'repeat ' * 200})
+
+    raw = stored('a')
+    assert raw['body'][offload.C_OFFLOAD_MARKER] == offload.C_OFFLOAD_GZIP
+    assert json.loads(gzip.decompress(bytes(raw['body']['data']))) == body
+    # only policied attributes are offloaded
+    assert raw['other'] == 'repeat ' * 200
+    assert s3.objects == {}
+
+    item = ddb.get_item(C_TABLE, 'a')['Item']
+    assert type(item) is dict
+    assert item['body'] == body
+
+def test_very_large_values_spill_to_s3_and_load_lazily(s3):
+    body = spillable_text()
+    ddb.put_item(C_TABLE, {'pkey': 'a', 'body': body})
+
+    (key,) = s3.objects
+    assert key[0] == 'offload-bucket'
+    assert key[1].startswith(f'{offload.C_DEFAULT_S3_PREFIX}{C_TABLE}/a/body/')
+
+    item = ddb.get_item(C_TABLE, 'a')['Item']
+    assert isinstance(item, offload.OffloadedItem)
+    assert offload.is_spilled(dict.__getitem__(item, 'body'))
+    assert s3.gets == 0
+
+    assert item['body'] == body
+    assert item.get('body') == body
+    assert dict(item) == {'pkey': 'a', 'body': body}
+    assert s3.gets == 1
+
+def test_spilled_values_are_content_addressed(s3):
+    body = spillable_text()
+    ddb.put_item(C_TABLE, {'pkey': 'a', 'body': body})
+    ddb.put_item(C_TABLE, {'pkey': 'a', 'body': body})
+    assert len(s3.objects) == 1
+
+    ddb.update_item(C_TABLE, 'a', set_paths={'body': body + 'more'})
+    assert len(s3.objects) == 2
+    assert ddb.get_item(C_TABLE, 'a')['Item']['body'] == body + 'more'
+
+def test_spilled_values_are_checked_against_their_pointer(s3):
+    ddb.put_item(C_TABLE, {'pkey': 'a', 'body': spillable_text()})
+    (key,) = s3.objects
+    s3.objects[key] = gzip.compress(b'"tampered"')
+
+    with pytest.raises(ValueError):
+        ddb.get_item(C_TABLE, 'a')['Item']['body']
+
+def test_restore_item_unpacks_markers():
+    policy = offload.OffloadPolicy('body', compress_over=10)
+    packed = offload.offload_value(policy, C_TABLE, 'a', 'x' * 100)
+    assert offload.is_offloaded(packed)
+
+    restored = offload.restore_item({'pkey': 'a', 'body': packed})
+
+    assert type(restored) is dict
+    assert restored == {'pkey': 'a', 'body': 'x' * 100}
+
+def test_rehydrate_item_fetches_everything(s3):
+    body = spillable_text()
+    ddb.put_item(C_TABLE, {'pkey': 'a', 'body': body})
+
+    item = offload.rehydrate_item(ddb.get_item(C_TABLE, 'a')['Item'])
+
+    assert type(item) is dict
+    assert item == {'pkey': 'a', 'body': body}
@@ -0,0 +1,157 @@
+'''
+Rate limiting and backoff, on a fake clock.
+'''
+import pytest
+
+import ratelimit
+import retry
+from ratelimit import TokenBucket, AdaptiveRateLimiter
+
+class FakeClock:
+    '''
+    Stands in for the time module: sleeping moves the clock on.
+    '''
+    def __init__(self):
+        self.now = 1000.0
+        self.slept = []
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, secs):
+        # real sleeps overshoot a little, which is what gets a waiter past float rounding
+        self.slept.append(secs)
+        self.now += secs + 1e-9
+
+    def advance(self, secs):
+        self.now += secs
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(ratelimit, 'time', clock)
+    return clock
+
+def test_bucket_lets_a_second_of_tokens_through_then_waits(clock):
+    bucket = TokenBucket(10)
+
+    for _ in range(10):
+        bucket.acquire()
+    assert clock.slept == []
+
+    bucket.acquire()
+    assert sum(clock.slept) == pytest.approx(0.1)
+
+def test_bucket_refills_at_its_rate_up_to_capacity(clock):
+    bucket = TokenBucket(10, capacity=5)
+    for _ in range(5):
+        bucket.acquire()
+
+    clock.advance(10)
+
+    assert bucket.wait_time(5) == 0
+    assert bucket.wait_time(6) == pytest.approx(0.1)
+
+def test_bucket_debt_is_waited_off(clock):
+    bucket = TokenBucket(4)
+
+    bucket.consume(12)
+    bucket.wait()
+
+    # 4 to start with, 8 in debt at 4 a second
+    assert sum(clock.slept) == pytest.approx(2.0)
+
+def test_set_rate_with_drain_empties_the_bucket(clock):
+    bucket = TokenBucket(10)
+
+    bucket.set_rate(2, drain=True)
+    bucket.acquire()
+
+    assert sum(clock.slept) == pytest.approx(0.5)
+
+def send(limiter, clock, count, rate):
+    # count requests at rate a second, as far as the limiter lets us
+    for _ in range(count):
+        limiter.acquire()
+        clock.advance(1.0 / rate)
+
+def test_limiter_doesnt_limit_until_throttled(clock):
+    limiter = AdaptiveRateLimiter()
+
+    send(limiter, clock, 1000, 100)
+
+    assert clock.slept == []
+    assert limiter.stats()['limiting'] is False
+
+def test_throttle_cuts_to_a_fraction_of_the_sending_rate(clock):
+    limiter = AdaptiveRateLimiter(backoff_factor=0.5, recovery_rate=0)
+    send(limiter, clock, 200, 100)
+
+    limiter.on_throttle()
+
+    assert limiter.stats()['rate'] == pytest.approx(50, rel=0.05)
+
+    # the bucket was drained, so the next 50 requests take about a second
+    started = clock.now
+    for _ in range(50):
+        limiter.acquire()
+    assert clock.now - started == pytest.approx(1.0, rel=0.05)
+
+def test_throttles_in_flight_at_the_old_rate_dont_cut_again(clock):
+    limiter = AdaptiveRateLimiter(backoff_factor=0.5, recovery_rate=0, decrease_interval=1.0)
+    send(limiter, clock, 200, 100)
+
+    limiter.on_throttle()
+    rate = limiter.stats()['rate']
+    clock.advance(0.5)
+    limiter.on_throttle()
+
+    assert limiter.stats()['rate'] == rate
+
+    clock.advance(1.0)
+    limiter.on_throttle()
+
+    assert limiter.stats()['rate'] < rate
+
+def test_rate_never_drops_below_min_rate(clock):
+    limiter = AdaptiveRateLimiter(min_rate=5, backoff_factor=0.1, recovery_rate=0, decrease_interval=0)
+    send(limiter, clock, 20, 10)
+
+    for _ in range(10):
+        limiter.on_throttle()
+        clock.advance(1)
+
+    assert limiter.stats()['rate'] == 5
+
+def test_limiter_recovers_then_stops_limiting(clock):
+    limiter = AdaptiveRateLimiter(backoff_factor=0.5, recovery_rate=10, max_rate=100, reset_after=60)
+    send(limiter, clock, 200, 100)
+    limiter.on_throttle()
+
+    clock.advance(2)
+    limiter.acquire()
+    assert limiter.stats()['rate'] == pytest.approx(70, rel=0.05)
+
+    clock.advance(5)
+    limiter.acquire()
+    assert limiter.stats()['limiting'] is False
+
+def test_limiter_stops_limiting_after_reset_after(clock):
+    limiter = AdaptiveRateLimiter(recovery_rate=0, reset_after=30)
+    send(limiter, clock, 200, 100)
+    limiter.on_throttle()
+
+    clock.advance(31)
+    limiter.acquire()
+
+    assert limiter.stats()['limiting'] is False
+
+@pytest.mark.parametrize('attempt, ceiling', [(0, 0.05), (1, 0.1), (3, 0.4), (20, 5.0)])
+def test_backoff_is_full_jitter_up_to_the_cap(monkeypatch, attempt, ceiling):
+    slept = []
+    monkeypatch.setattr(retry.time, 'sleep', slept.append)
+    monkeypatch.setattr(retry.random, 'uniform', lambda low, high: (low, high))
+
+    retry.backoff_sleep(attempt)
+
+    assert slept == [(0, pytest.approx(ceiling))]
@@ -0,0 +1,274 @@
+'''
+Spelunk creation, deduplication and the enqueue and lens leases, against the in-memory engine.
+'''
+import json
+import os
+import threading
+import time
+import pytest
+
+for module_name in ('boto3', 'pydantic', 'openai', 'py_youtube', 'youtube_transcript_api'):
+    pytest.importorskip(module_name)
+
+import clients
+import ddb
+import enqueue
+import spelunk
+from shared import calc_spelunk_pkey
+
+C_VIDEO_ID = 'dQw4w9WgXcQ'
+C_URL = f'https://www.youtube.com/watch?v={C_VIDEO_ID}'
+C_SHORT_URL = f'https://youtu.be/{C_VIDEO_ID}?t=30'
+
+class RecordingSQS:
+    '''
+    Stands in for the sqs client, keeping the messages sent.
+    '''
+    def __init__(self):
+        self.messages = []
+
+    def send_message_batch(self, QueueUrl, Entries):
+        self.messages.extend(json.loads(entry['MessageBody']) for entry in Entries)
+        return {'Successful': [{'Id': entry['Id']} for entry in Entries], 'Failed': []}
+
+@pytest.fixture(autouse=True)
+def memory_ddb(monkeypatch):
+    client = clients.use_memory_dynamodb()
+    ddb.invalidate_cached_table(os.environ['table_name'])
+    spelunk.resolve_spelunk_alias.cache_clear()
+    monkeypatch.setattr(spelunk, 'get_youtube_data', lambda url: {'title': 'A video'})
+    yield client
+    enqueue.PENDING.clear()
+
+@pytest.fixture
+def sqs():
+    sqs = RecordingSQS()
+    clients.set_client('sqs', sqs)
+    yield sqs
+    clients.reset_clients()
+
+def stored_spelunk(spelunk_id):
+    return ddb.get_item(os.environ['table_name'], calc_spelunk_pkey(spelunk_id), consistent=True).get('Item')
+
+def stored_pkeys(client, prefix):
+    table = client.table(os.environ['table_name'])
+    return sorted(item['pkey'] for item in table.items.values() if item['pkey'].startswith(prefix))
+
+def set_spelunk_values(spelunk_id, **values):
+    ddb.update_item(os.environ['table_name'], calc_spelunk_pkey(spelunk_id), set_value=values)
+
+def process_messages(sqs):
+    enqueue.flush_enqueued()
+    return [message for message in sqs.messages if message['op'] == 'process_spelunk']
+
+def test_create_makes_one_spelunk_per_video(memory_ddb):
+    spelunk_rec = spelunk.create_spelunk_rec_from_url(C_URL)
+
+    assert spelunk_rec['id'] == spelunk.calc_spelunk_id(C_VIDEO_ID)
+    assert {name: lens['status'] for name, lens in spelunk_rec['lenses'].items()} == {
+        'source': spelunk.C_STATUS_READY,
+        'transcript': spelunk.C_STATUS_PREPARING,
+        'summary': spelunk.C_STATUS_PREPARING,
+    }
+
+    again = spelunk.create_spelunk_rec_from_url(C_SHORT_URL)
+
+    assert again['id'] == spelunk_rec['id']
+    assert stored_pkeys(memory_ddb, 'S*') == [calc_spelunk_pkey(spelunk_rec['id'])]
+
+def test_old_style_id_finds_the_spelunk():
+    spelunk_rec = spelunk.create_spelunk_rec_from_url(C_URL)
+
+    found = spelunk.get_spelunk_rec(spelunk.calc_legacy_spelunk_id(C_URL))
+
+    assert found['id'] == spelunk_rec['id']
+
+def test_spelunk_made_before_video_ids_is_adopted(memory_ddb):
+    legacy_id = spelunk.calc_legacy_spelunk_id(C_URL)
+    ddb.put_item(os.environ['table_name'], {
+        'pkey': calc_spelunk_pkey(legacy_id),
+        'id': legacy_id,
+        'lenses': {'source': {'status': spelunk.C_STATUS_READY, 'url': C_URL, 'type': 'youtube'}},
+    })
+
+    spelunk_rec = spelunk.create_spelunk_rec_from_url(C_URL)
+
+    assert spelunk_rec['id'] == legacy_id
+    assert spelunk.get_spelunk_rec(spelunk.calc_spelunk_id(C_VIDEO_ID))['id'] == legacy_id
+    assert stored_pkeys(memory_ddb, 'S*') == [calc_spelunk_pkey(legacy_id)]
+
+def test_new_spelunk_is_in_the_work_index():
+    spelunk_rec = spelunk.create_spelunk_rec_from_url(C_URL)
+
+    stored = stored_spelunk(spelunk_rec['id'])
+
+    assert stored['l3_pkey'] == 'SW*pending'
+
+def test_processing_is_queued_once_per_lease(sqs):
+    spelunk_rec = spelunk.create_spelunk_rec_from_url(C_URL)
+    spelunk_id = spelunk_rec['id']
+
+    assert spelunk.enqueue_spelunk_processing(spelunk_rec)
+    # a stale copy of the record doesn't show the lease, but the conditional claim still loses
+    assert not spelunk.enqueue_spelunk_processing(spelunk_rec)
+    assert not spelunk.enqueue_spelunk_processing(spelunk.get_spelunk_status(spelunk_id, consistent=True))
+
+    assert process_messages(sqs) == [{'op': 'process_spelunk', 'detail': {'spelunk_id': spelunk_id}}]
+
+    set_spelunk_values(spelunk_id, enqueue_lease_expires=int(time.time()) - 1)
+
+    assert spelunk.enqueue_spelunk_processing(spelunk.get_spelunk_status(spelunk_id, consistent=True))
+    assert len(process_messages(sqs)) == 2
+
+def test_concurrent_enqueues_queue_once(sqs):
+    spelunk_rec = spelunk.create_spelunk_rec_from_url(C_URL)
+
+    results = []
+    threads = [
+        threading.Thread(target=lambda: results.append(spelunk.enqueue_spelunk_processing(spelunk_rec)))
+        for _ in range(10)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert results.count(True) == 1
+    assert len(process_messages(sqs)) == 1
+
+def test_only_one_worker_claims_a_lens():
+    spelunk_id = spelunk.create_spelunk_rec_from_url(C_URL)['id']
+
+    claims = []
+    threads = [
+        threading.Thread(target=lambda owner=owner: claims.append(spelunk.claim_spelunk_lens(spelunk_id, 'transcript', owner)))
+        for owner in range(10)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len([claim for claim in claims if claim is not None]) == 1
+
+def test_expired_lens_lease_is_taken_over():
+    spelunk_id = spelunk.create_spelunk_rec_from_url(C_URL)['id']
+
+    assert spelunk.claim_spelunk_lens(spelunk_id, 'transcript', 'first') is not None
+    assert spelunk.claim_spelunk_lens(spelunk_id, 'transcript', 'second') is None
+
+    ddb.update_item(
+        os.environ['table_name'], calc_spelunk_pkey(spelunk_id),
+        set_paths={('lenses', 'transcript', 'lease_expires'): int(time.time()) - 1}
+    )
+
+    assert spelunk.claim_spelunk_lens(spelunk_id, 'transcript', 'second') is not None
+    # the first owner has lost the lens, so can't finish it
+    assert spelunk.finish_spelunk_lens(spelunk_id, 'transcript', 'first', spelunk.C_STATUS_READY) is None
+
+    spelunk_rec = spelunk.finish_spelunk_lens(spelunk_id, 'transcript', 'second', spelunk.C_STATUS_READY)
+
+    assert spelunk_rec['lenses']['transcript']['status'] == spelunk.C_STATUS_READY
+    assert 'owner' not in spelunk_rec['lenses']['transcript']
+
+def test_heartbeat_keeps_the_lens_lease():
+    spelunk_id = spelunk.create_spelunk_rec_from_url(C_URL)['id']
+
+    # leases are in whole seconds, so one of 2 seconds has at least 1 second left after a beat
+    with spelunk.SpelunkLensLease(spelunk_id, 'summary', lease_secs=2, heartbeat_secs=0.1) as lease:
+        assert lease.spelunk_rec is not None
+
+        with spelunk.SpelunkLensLease(spelunk_id, 'summary') as other:
+            assert other.spelunk_rec is None
+
+        time.sleep(2.5)
+
+        assert not spelunk.spelunk_rec_needs_summary(spelunk.get_spelunk_status(spelunk_id, consistent=True))
+        assert lease.finish(spelunk.C_STATUS_READY) is not None
+        assert not lease.lost
+
+def test_settled_spelunk_leaves_the_work_index():
+    spelunk_id = spelunk.create_spelunk_rec_from_url(C_URL)['id']
+
+    for lens_name in ('transcript', 'summary'):
+        assert spelunk.claim_spelunk_lens(spelunk_id, lens_name, 'worker') is not None
+        assert 'l3_pkey' in stored_spelunk(spelunk_id)
+        spelunk.finish_spelunk_lens(spelunk_id, lens_name, 'worker', spelunk.C_STATUS_READY)
+
+    assert 'l3_pkey' not in stored_spelunk(spelunk_id)
+
+def test_reaper_requeues_overdue_spelunks(sqs):
+    spelunk_id = spelunk.create_spelunk_rec_from_url(C_URL)['id']
+    spelunk.reschedule_spelunk_work(spelunk_id, int(time.time()) - 1)
+
+    counts = spelunk.reap_stuck_spelunks()
+
+    assert counts['requeued'] == 1
+    assert process_messages(sqs) == [{'op': 'process_spelunk', 'detail': {'spelunk_id': spelunk_id}}]
+
+def test_status_leaves_out_lens_messages():
+    spelunk_id = spelunk.create_spelunk_rec_from_url(C_URL)['id']
+    spelunk.claim_spelunk_lens(spelunk_id, 'summary', 'worker')
+    spelunk.finish_spelunk_lens(spelunk_id, 'summary', 'worker', spelunk.C_STATUS_ERROR, message='Traceback ...')
+
+    status_rec = spelunk.get_spelunk_status(spelunk_id, consistent=True)
+
+    assert status_rec['lenses']['summary']['status'] == spelunk.C_STATUS_ERROR
+    assert 'message' not in status_rec['lenses']['summary']
+    assert stored_spelunk(spelunk_id)['lenses']['summary']['message'] == 'Traceback ...'
+
+class FailingSQS:
+    '''
+    Stands in for an sqs client that can't take messages.
+    '''
+    def send_message_batch(self, QueueUrl, Entries):
+        return {'Successful': [], 'Failed': [{'Id': entry['Id'], 'SenderFault': True, 'Code': 'Broken'} for entry in Entries]}
+
+def test_unsent_processing_can_be_queued_again(sqs):
+    spelunk_rec = spelunk.create_spelunk_rec_from_url(C_URL)
+    spelunk_id = spelunk_rec['id']
+
+    clients.set_client('sqs', FailingSQS())
+    assert spelunk.enqueue_spelunk_processing(spelunk_rec)
+    assert len(enqueue.flush_enqueued()) == 1
+
+    status_rec = spelunk.get_spelunk_status(spelunk_id, consistent=True)
+    assert not spelunk.spelunk_rec_has_enqueue_lease(status_rec)
+
+    clients.set_client('sqs', sqs)
+    assert spelunk.enqueue_spelunk_processing(status_rec)
+    assert process_messages(sqs) == [{'op': 'process_spelunk', 'detail': {'spelunk_id': spelunk_id}}]
+
+def test_backfill_aliases_legacy_spelunks():
+    legacy_id = spelunk.calc_legacy_spelunk_id(C_SHORT_URL)
+    ddb.put_item(os.environ['table_name'], {
+        'pkey': calc_spelunk_pkey(legacy_id),
+        'id': legacy_id,
+        'lenses': {'source': {'status': spelunk.C_STATUS_READY, 'url': C_SHORT_URL, 'type': 'youtube'}},
+    })
+
+    assert spelunk.alias_legacy_spelunks() == {'scanned': 1, 'aliased': 1, 'skipped': 0}
+    # another form of the url now finds it, rather than making a new spelunk
+    assert spelunk.create_spelunk_rec_from_url(C_URL)['id'] == legacy_id
+    assert spelunk.alias_legacy_spelunks() == {'scanned': 1, 'aliased': 0, 'skipped': 1}
+
+def test_backfill_indexes_unsettled_spelunks(sqs):
+    for video_id, status in (('AAAAAAAAAAA', spelunk.C_STATUS_PREPARING), ('BBBBBBBBBBB', spelunk.C_STATUS_READY)):
+        spelunk_id = spelunk.calc_spelunk_id(video_id)
+        ddb.put_item(os.environ['table_name'], {
+            'pkey': calc_spelunk_pkey(spelunk_id),
+            'id': spelunk_id,
+            'lenses': {'transcript': {'status': status}, 'summary': {'status': status}},
+        })
+    indexed_id = spelunk.create_spelunk_rec_from_url(C_URL)['id']
+
+    assert spelunk.index_unsettled_spelunks() == {'scanned': 2, 'indexed': 1, 'settled': 1, 'skipped': 0}
+
+    # the unsettled one is due now, the one made with the index isn't yet
+    counts = spelunk.reap_stuck_spelunks()
+
+    assert counts['requeued'] == 1
+    assert process_messages(sqs) == [
+        {'op': 'process_spelunk', 'detail': {'spelunk_id': spelunk.calc_spelunk_id('AAAAAAAAAAA')}}
+    ]
+    assert 'l3_pkey' in stored_spelunk(indexed_id)
@@ -0,0 +1,66 @@
+'''
+The spelunk API handlers, against the in-memory engine.
+'''
+import asyncio
+import os
+import pytest
+
+for module_name in ('boto3', 'fastapi', 'pydantic', 'openai', 'py_youtube', 'youtube_transcript_api'):
+    pytest.importorskip(module_name)
+
+import clients
+import ddb
+import spelunk
+from shared import calc_spelunk_pkey
+from spelunk_handler import get_spelunk
+
+C_VIDEO_ID = 'dQw4w9WgXcQ'
+C_URL = f'https://www.youtube.com/watch?v={C_VIDEO_ID}'
+
+class SigningS3:
+    '''
+    Stands in for the s3 client, "signing" a url that shows the key it was signed for.
+    '''
+    def generate_presigned_url(self, operation, Params, ExpiresIn):
+        return f"https://{Params['Bucket']}/{Params['Key']}"
+
+@pytest.fixture(autouse=True)
+def memory_ddb(monkeypatch):
+    client = clients.use_memory_dynamodb()
+    clients.set_client('s3', SigningS3())
+    ddb.invalidate_cached_table(os.environ['table_name'])
+    spelunk.resolve_spelunk_alias.cache_clear()
+    monkeypatch.setattr(spelunk, 'get_youtube_data', lambda url: {'title': 'A video'})
+    yield client
+    clients.reset_clients()
+
+def make_ready_spelunk():
+    spelunk_rec = spelunk.create_spelunk_rec_from_url(C_URL)
+    ddb.update_item(
+        os.environ['table_name'], calc_spelunk_pkey(spelunk_rec['id']),
+        set_paths={
+            ('lenses', 'transcript', 'status'): spelunk.C_STATUS_READY,
+            ('lenses', 'summary', 'status'): spelunk.C_STATUS_READY,
+        }
+    )
+    return spelunk_rec['id']
+
+def test_get_spelunk_signs_urls_for_the_spelunk():
+    spelunk_id = make_ready_spelunk()
+
+    result = asyncio.run(get_spelunk(spelunk_id))
+
+    assert result.id == spelunk_id
+    assert result.lenses['transcript'].url == f"https://{os.environ['bucket_name']}/transcripts/{spelunk_id}.json"
+    assert result.lenses['summary'].url == f"https://{os.environ['bucket_name']}/youtube_summaries/{spelunk_id}.json"
+
+def test_get_aliased_spelunk_signs_urls_for_the_record_it_resolves_to():
+    spelunk_id = make_ready_spelunk()
+    legacy_id = spelunk.calc_legacy_spelunk_id(C_URL)
+    assert legacy_id != spelunk_id
+
+    result = asyncio.run(get_spelunk(legacy_id))
+
+    assert result.id == spelunk_id
+    assert result.lenses['transcript'].url.endswith(f'/transcripts/{spelunk_id}.json')
+    assert result.lenses['summary'].url.endswith(f'/youtube_summaries/{spelunk_id}.json')